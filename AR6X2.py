@@ -1,5 +1,9 @@
+import threading
+import time
 import minimalmodbus
 import numpy as np
+import serial
+from Diagnostics import BusDiagnostics, get_bus
 
 
 class AR6X2(minimalmodbus.Instrument):
@@ -32,6 +36,22 @@ class AR6X2(minimalmodbus.Instrument):
     PARAM_RAMPING_OFF = 0
     PARAM_RAMPING_AUTO = 2
 
+    # Contiguous register ranges covering every register above, each read with a single transaction
+    # (function code 3), as (first register, number of registers)
+    READ_BLOCKS = [(0x00, 0x1A - 0x00 + 1), (0x2C, 0x2E - 0x2C + 1)]
+
+    # Number of decimals of temperatures and gradients, enum values (output and ramp state) have none.
+    # Given by each setter and not looked up by address, REGISTER_OUT1_STATE and REGISTER_RAMP_GRADIENT
+    # share an address in the register map above
+    TEMPERATURE_DECIMALS = 1
+
+    # Names of the modbus functions in the diagnostics
+    FUNCTION_NAMES = {
+        3: "Read registers",
+        6: "Write register",
+        16: "Write registers"
+    }
+
     def __init__(self, port, address):
         # A serial connection. The default values match the AR6x2 datasheet
         # However, the AR6x2 unit should have the baudrate set to 19200
@@ -40,52 +60,143 @@ class AR6X2(minimalmodbus.Instrument):
         self.__rangeHigh = 850.0
         self.__currentOutTemp = 100.0
 
+        # The instrument is used both by the GUI and by the polling thread,
+        # the lock keeps their request/response pairs from interleaving on the bus
+        self.lock = threading.RLock()
+
+        # Shadow of the device registers: register -> raw value last written or read back.
+        # Writes of the value already in the shadow are skipped
+        self.__shadow = {}
+        self.writes = 0
+        self.skippedWrites = 0
+        self.verifyMismatches = 0
+
+        self.diagnostics = get_bus(f"AR6X2 {port}")
+
+    # Every transaction is recorded in the diagnostics of the port, under the function code
+    def _perform_command(self, functioncode, payload_to_slave):
+        name = self.FUNCTION_NAMES.get(functioncode, f"Function {functioncode}")
+        with self.lock:
+            start = time.monotonic()
+            try:
+                response = minimalmodbus.Instrument._perform_command(self, functioncode, payload_to_slave)
+            except minimalmodbus.NoResponseError:
+                self.diagnostics.record(name, start, BusDiagnostics.TIMEOUT)
+                raise
+            except (minimalmodbus.InvalidResponseError, minimalmodbus.LocalEchoError):
+                self.diagnostics.record(name, start, BusDiagnostics.UNEXPECTED)
+                raise
+            except (minimalmodbus.ModbusException, serial.SerialException):
+                self.diagnostics.record(name, start, BusDiagnostics.ERROR)
+                raise
+            self.diagnostics.record(name, start)
+            return response
+
+    # Raw 16 bit register value of a number with `decimals` decimals, rounded (minimalmodbus truncates)
+    @staticmethod
+    def to_raw(value, decimals=0):
+        return int(round(float(value) * 10 ** decimals))
+
+    # Write a register unless the shadow says the device already holds this value
+    # Returns True if a transaction took place
+    def write_cached(self, register, value, decimals=0):
+        raw = self.to_raw(value, decimals)
+        with self.lock:
+            if self.__shadow.get(register) == raw:
+                self.skippedWrites += 1
+                return False
+            self.write_register(register, raw, 0, signed=True)
+            self.__shadow[register] = raw
+            self.writes += 1
+        return True
+
+    # Forget the shadow, so the next write of every register goes to the device
+    def invalidate_cache(self):
+        with self.lock:
+            self.__shadow = {}
+
+    # Compare registers read back from the device with the shadow. A register that differs (a write that did not
+    # take effect, or a change made on the device itself) is counted and the shadow takes the device value,
+    # so the next write of the wanted value is not skipped
+    def verify_registers(self, registers):
+        with self.lock:
+            for register, raw in self.__shadow.items():
+                if register in registers and registers[register] != raw:
+                    self.verifyMismatches += 1
+                    self.__shadow[register] = registers[register]
+
     def turn_off(self):
-        self.write_register(AR6X2.REGISTER_OUT1_STATE, AR6X2.PARAM_OUTPUT_OFF, 1)
+        self.write_cached(AR6X2.REGISTER_OUT1_STATE, AR6X2.PARAM_OUTPUT_OFF)
 
     def turn_on(self):
-        self.write_register(AR6X2.REGISTER_OUT1_STATE, AR6X2.PARAM_OUTPUT_HEATING, 1)
+        self.write_cached(AR6X2.REGISTER_OUT1_STATE, AR6X2.PARAM_OUTPUT_HEATING)
 
     def set_temperature(self, temperature):
-        temperature = np.clip(temperature, self.__rangeLow, self.__rangeHigh)
-        self.write_register(AR6X2.REGISTER_OUT1_TEMP, temperature, 1)
+        temperature = float(np.clip(temperature, self.__rangeLow, self.__rangeHigh))
+        self.write_cached(AR6X2.REGISTER_OUT1_TEMP, temperature, AR6X2.TEMPERATURE_DECIMALS)
         self.__currentOutTemp = temperature
 
     # Set the operation temperature range
     # If Low1 is bigger than High1 then "we get an inverse curve"
     # Manual page 13, note (2)
+    # The setpoint is clipped to the new range, it is only written if clipping changed it
     def set_range_low(self, value):
-        value = np.clip(value, -199.9, 1800.0)[0]
+        value = float(np.clip(value, -199.9, 1800.0))
         self.__rangeLow = value
-        self.write_register(AR6X2.REGISTER_OUT1_LOW, value, 1)
-        newTemp = np.clip(self.__currentOutTemp, self.__rangeLow, self.__rangeHigh)
-        self.write_register(AR6X2.REGISTER_OUT1_TEMP, newTemp)
-        return newTemp
+        self.write_cached(AR6X2.REGISTER_OUT1_LOW, value, AR6X2.TEMPERATURE_DECIMALS)
+        self.set_temperature(self.__currentOutTemp)
+        return self.__currentOutTemp
 
     def set_range_high(self, value):
-        value = np.clip(value, -199.9, 1800.0)[0]
+        value = float(np.clip(value, -199.9, 1800.0))
         self.__rangeHigh = value
-        self.write_register(AR6X2.REGISTER_OUT1_HIGH, value, 1)
-        newTemp = np.clip(self.__currentOutTemp, self.__rangeLow, self.__rangeHigh)[0]
-        self.write_register(AR6X2.REGISTER_OUT1_TEMP, newTemp)
-        return newTemp
+        self.write_cached(AR6X2.REGISTER_OUT1_HIGH, value, AR6X2.TEMPERATURE_DECIMALS)
+        self.set_temperature(self.__currentOutTemp)
+        return self.__currentOutTemp
 
     # register 0, 1 decimal (thermocouple resolution 0.1 deg C)
     def read_temperature(self):
-        return self.read_register(AR6X2.REGISTER_TEMP_PROBE, 1)
+        return self.read_register(AR6X2.REGISTER_TEMP_PROBE, 1, signed=True)
+
+    # Read all READ_BLOCKS, returns a dictionary of register address -> raw signed value
+    def read_blocks(self):
+        registers = {}
+        for start, count in AR6X2.READ_BLOCKS:
+            values = np.array(self.read_registers(start, count), dtype=np.uint16).view(np.int16)
+            registers.update(zip(range(start, start + count), values.tolist()))
+        return registers
+
+    # Probe temperature, setpoint, output and ramp state in two transactions instead of one per value.
+    # The registers read are also used to verify the write cache.
+    # Note that REGISTER_OUT1_STATE and REGISTER_RAMP_GRADIENT share an address in the register map above,
+    # so both entries show the same register, once as a raw enum and once as a gradient
+    def read_state(self):
+        registers = self.read_blocks()
+        self.verify_registers(registers)
+
+        def value(register, decimals=AR6X2.TEMPERATURE_DECIMALS):
+            return registers[register] / 10 ** decimals
+        return {'probe': value(AR6X2.REGISTER_TEMP_PROBE),
+                'setpoint': value(AR6X2.REGISTER_OUT1_TEMP),
+                'rangeLow': value(AR6X2.REGISTER_OUT1_LOW),
+                'rangeHigh': value(AR6X2.REGISTER_OUT1_HIGH),
+                'outputState': registers[AR6X2.REGISTER_OUT1_STATE],
+                'rampState': registers[AR6X2.REGISTER_RAMP_STATE],
+                'rampGradient': value(AR6X2.REGISTER_RAMP_GRADIENT),
+                'rampTimehold': registers[AR6X2.REGISTER_RAMP_TIMEHOLD]}
 
     # Set the gradient of 2 stage ramping
     # To hold set1 indefinitely we set th1 to 0
     # Page 18, section 12.7
     # Values between 1 and 300 are mapped between 1.0 and 30.0
     def set_gradient(self, gradient):
-        gradient = np.clip(gradient, 1.0, 30.0)[0]
-        self.write_register(AR6X2.REGISTER_RAMP_GRADIENT, gradient*10, 1)
-        self.write_register(AR6X2.REGISTER_RAMP_TIMEHOLD, 0, 1)
+        gradient = float(np.clip(gradient, 1.0, 30.0))
+        self.write_cached(AR6X2.REGISTER_RAMP_GRADIENT, gradient, AR6X2.TEMPERATURE_DECIMALS)
+        self.write_cached(AR6X2.REGISTER_RAMP_TIMEHOLD, 0)
 
     # Setting the ramping mode to auto will start the process immediately
     def ramping_on(self):
-        self.write_register(AR6X2.REGISTER_RAMP_STATE, AR6X2.PARAM_RAMPING_AUTO, 1)
+        self.write_cached(AR6X2.REGISTER_RAMP_STATE, AR6X2.PARAM_RAMPING_AUTO)
 
     def ramping_off(self):
-        self.write_register(AR6X2.REGISTER_RAMP_STATE, AR6X2.PARAM_RAMPING_OFF, 1)
+        self.write_cached(AR6X2.REGISTER_RAMP_STATE, AR6X2.PARAM_RAMPING_OFF)
@@ -1,8 +1,9 @@
 from PyQt5 import QtCore
-from PyQt5.QtCore import QRegExp, pyqtSignal, QTimer
+from PyQt5.QtCore import QRegExp, pyqtSignal
 from PyQt5.QtGui import QRegExpValidator, QIcon
 from PyQt5.QtWidgets import QDialog, QFormLayout, QPushButton, QLineEdit, QComboBox
 from serial.tools.list_ports import comports
+from Scheduler import ScheduledTimer
 import resources
 
 
@@ -53,7 +54,7 @@ class AR6X2ConfigDialog(QDialog):
         self.buttonCancel = QPushButton("Cancel")
         self.buttonCancel.clicked.connect(self.cancel_pressed)
 
-        self.timer = QTimer()
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_BACKGROUND)
         self.timer.timeout.connect(self.refresh_devices)
         self.timer.start(1000)
 
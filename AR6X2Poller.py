@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from AR6X2 import AR6X2
+
+
+# Reads the state of an AR6X2 controller every `interval` seconds in a dedicated thread,
+# so a slow or missing device never blocks the GUI. Every successful poll is stored in `readings`
+# as a (timestamp, state) tuple, where state is the dictionary returned by AR6X2.read_state()
+class AR6X2Poller:
+    def __init__(self, device: AR6X2, interval=1.0, bufferSize=4096):
+        self.device = device
+        self.interval = interval
+        self.readings = deque(maxlen=bufferSize)
+        # Newest (timestamp, state) tuple, None until the first successful poll
+        self.latest = None
+
+        # Statistics, written only by the polling thread
+        self.polls = 0
+        self.errors = 0
+        self.lastError = None
+        self.lastLatency = None
+
+        self.__stopEvent = threading.Event()
+        self.__wakeEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"AR6X2 poller {device.serial.port}", daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        self.__stopEvent.set()
+        self.__wakeEvent.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join(self.device.serial.timeout * len(AR6X2.READ_BLOCKS) + 1.0)
+
+    # Change the polling interval (in seconds), takes effect immediately
+    def set_interval(self, value):
+        self.interval = value
+        self.__wakeEvent.set()
+
+    # Remove and return all readings gathered since the last call
+    def drain(self):
+        readings = []
+        try:
+            while True:
+                readings.append(self.readings.popleft())
+        except IndexError:
+            return readings
+
+    def __run(self):
+        lastPoll = None
+        while not self.__stopEvent.is_set():
+            if lastPoll is not None:
+                remaining = lastPoll + self.interval - time.monotonic()
+                if remaining > 0:
+                    self.__wakeEvent.wait(remaining)
+                    self.__wakeEvent.clear()
+                    continue
+
+            lastPoll = time.monotonic()
+            self.polls += 1
+            try:
+                state = self.device.read_state()
+            except (IOError, ValueError) as e:
+                # No response or a corrupted one, the next poll is tried as usual
+                self.errors += 1
+                self.lastError = e
+                continue
+            self.lastLatency = time.monotonic() - lastPoll
+            self.latest = (datetime.now(), state)
+            self.readings.append(self.latest)
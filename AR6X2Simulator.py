@@ -0,0 +1,224 @@
+import argparse
+import math
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+from AR6X2 import AR6X2
+
+
+# Modbus RTU slave imitating an AR6X2 controller on a pseudo terminal, for testing and benchmarking
+# the driver without a device (Linux only). The port name to pass to AR6X2 is in `port`.
+# Implements reading holding registers (function code 3) and writing single (6) and multiple (16) registers
+# at the addresses AR6X2 uses. The probe register follows a first-order thermal model: with the output on,
+# the temperature approaches the setpoint with time constant `timeConstant` (seconds), otherwise the ambient
+# temperature. With ramping on, the setpoint the model follows moves towards OUT1 temperature at the ramp gradient.
+# Every response is delayed by `latency` seconds.
+# Since REGISTER_OUT1_STATE and REGISTER_RAMP_GRADIENT share an address in AR6X2, the output counts as on
+# whenever that register is not PARAM_OUTPUT_OFF
+class AR6X2Simulator:
+    REGISTER_COUNT = 0x100
+
+    FUNCTION_READ_REGISTERS = 3
+    FUNCTION_WRITE_REGISTER = 6
+    FUNCTION_WRITE_REGISTERS = 16
+
+    EXCEPTION_ILLEGAL_FUNCTION = 1
+    EXCEPTION_ILLEGAL_ADDRESS = 2
+    EXCEPTION_ILLEGAL_VALUE = 3
+
+    # Longest step of the thermal model integration, in seconds
+    MODEL_STEP = 0.1
+
+    def __init__(self, address=1, latency=0.0, timeConstant=120.0, ambient=22.0):
+        self.address = address
+        self.latency = latency
+        self.timeConstant = timeConstant
+        self.ambient = ambient
+
+        self.registers = [0] * self.REGISTER_COUNT
+        self.temperature = ambient
+        self.rampSetpoint = None
+        self.__set(AR6X2.REGISTER_OUT1_LOW, -199.9)
+        self.__set(AR6X2.REGISTER_OUT1_HIGH, 850.0)
+        self.__set(AR6X2.REGISTER_OUT1_TEMP, 100.0)
+        self.__set(AR6X2.REGISTER_TEMP_PROBE, ambient)
+
+        # Statistics
+        self.requests = 0
+        self.reads = 0
+        self.writes = 0
+        self.crcErrors = 0
+
+        self.__modelTime = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__master, self.__slave = pty.openpty()
+        tty.setraw(self.__slave)
+        self.port = os.ttyname(self.__slave)
+
+        self.__stopEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="AR6X2 simulator", daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        self.__stopEvent.set()
+        self.__thread.join(1.0)
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    # Modbus CRC-16 (polynomial 0xA001 reflected, initialization 0xFFFF), sent low byte first
+    @staticmethod
+    def crc16(data):
+        crc = 0xFFFF
+        for byte in data:
+            crc ^= byte
+            for bit in range(8):
+                crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        return struct.pack('<H', crc)
+
+    # Temperatures and gradients, the only registers the model reads or writes as numbers
+    def __get(self, register):
+        raw = self.registers[register]
+        raw = raw - 0x10000 if raw & 0x8000 else raw
+        return raw / 10 ** AR6X2.TEMPERATURE_DECIMALS
+
+    def __set(self, register, value):
+        self.registers[register] = AR6X2.to_raw(value, AR6X2.TEMPERATURE_DECIMALS) & 0xFFFF
+
+    # Advance the thermal model to now
+    def __update_model(self):
+        now = time.monotonic()
+        elapsed = now - self.__modelTime
+        self.__modelTime = now
+
+        setpoint = self.__get(AR6X2.REGISTER_OUT1_TEMP)
+        heating = self.registers[AR6X2.REGISTER_OUT1_STATE] != AR6X2.PARAM_OUTPUT_OFF
+        ramping = self.registers[AR6X2.REGISTER_RAMP_STATE] == AR6X2.PARAM_RAMPING_AUTO
+        if not ramping or self.rampSetpoint is None:
+            self.rampSetpoint = self.temperature if ramping else setpoint
+
+        steps = max(1, math.ceil(elapsed / self.MODEL_STEP))
+        dt = elapsed / steps
+        for i in range(steps):
+            if ramping:
+                # Gradient is given in degrees per minute
+                change = self.__get(AR6X2.REGISTER_RAMP_GRADIENT) * dt / 60
+                self.rampSetpoint += max(-change, min(change, setpoint - self.rampSetpoint))
+            target = self.rampSetpoint if heating else self.ambient
+            self.temperature = target + (self.temperature - target) * math.exp(-dt / self.timeConstant)
+        self.__set(AR6X2.REGISTER_TEMP_PROBE, self.temperature)
+
+    def __run(self):
+        buffer = b''
+        while not self.__stopEvent.is_set():
+            ready, _, _ = select.select([self.__master], [], [], 0.05)
+            if len(ready) == 0:
+                # Silence on the line ends a frame, anything incomplete is garbage
+                buffer = b''
+                continue
+            buffer += os.read(self.__master, 256)
+
+            while len(buffer) >= 8:
+                length = self.__frame_length(buffer)
+                if len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                response = self.__handle(frame)
+                if response is not None:
+                    if self.latency > 0:
+                        time.sleep(self.latency)
+                    os.write(self.__master, response + self.crc16(response))
+
+    @staticmethod
+    def __frame_length(buffer):
+        if buffer[1] == AR6X2Simulator.FUNCTION_WRITE_REGISTERS and len(buffer) >= 7:
+            return 9 + buffer[6]
+        return 8
+
+    # Returns the response without its CRC, or None if the frame is not meant for this slave or is corrupted
+    def __handle(self, frame):
+        if self.crc16(frame[:-2]) != frame[-2:]:
+            self.crcErrors += 1
+            return None
+        if frame[0] != self.address:
+            return None
+        self.requests += 1
+        function = frame[1]
+
+        with self.__lock:
+            self.__update_model()
+            if function == self.FUNCTION_READ_REGISTERS:
+                start, count = struct.unpack('>HH', frame[2:6])
+                if count == 0 or count > 125 or start + count > self.REGISTER_COUNT:
+                    return self.__exception(function, self.EXCEPTION_ILLEGAL_ADDRESS)
+                self.reads += 1
+                values = self.registers[start:start + count]
+                return bytes([self.address, function, 2 * count]) + struct.pack(f'>{count}H', *values)
+
+            if function == self.FUNCTION_WRITE_REGISTER:
+                register, value = struct.unpack('>HH', frame[2:6])
+                values = [value]
+            elif function == self.FUNCTION_WRITE_REGISTERS:
+                register, count = struct.unpack('>HH', frame[2:6])
+                if frame[6] != 2 * count:
+                    return self.__exception(function, self.EXCEPTION_ILLEGAL_VALUE)
+                values = list(struct.unpack(f'>{count}H', frame[7:7 + 2 * count]))
+            else:
+                return self.__exception(function, self.EXCEPTION_ILLEGAL_FUNCTION)
+
+            # The probe register is a measurement, it can not be written
+            if register <= AR6X2.REGISTER_TEMP_PROBE < register + len(values) or \
+                    register + len(values) > self.REGISTER_COUNT:
+                return self.__exception(function, self.EXCEPTION_ILLEGAL_ADDRESS)
+            self.writes += 1
+            self.registers[register:register + len(values)] = values
+            self.__update_model()
+            return frame[:6]
+
+    def __exception(self, function, code):
+        return bytes([self.address, function | 0x80, code])
+
+
+# Benchmark of the AR6X2 driver against the simulator: one transaction per value versus block reads,
+# and plain versus cached setpoint writes
+def benchmark(latency, count):
+    simulator = AR6X2Simulator(latency=latency)
+    device = AR6X2(simulator.port, simulator.address)
+    device.serial.baudrate = 19200
+    registers = [AR6X2.REGISTER_TEMP_PROBE, AR6X2.REGISTER_OUT1_TEMP, AR6X2.REGISTER_OUT1_LOW,
+                 AR6X2.REGISTER_OUT1_HIGH, AR6X2.REGISTER_OUT1_STATE, AR6X2.REGISTER_RAMP_STATE,
+                 AR6X2.REGISTER_RAMP_GRADIENT, AR6X2.REGISTER_RAMP_TIMEHOLD]
+
+    def measure(name, function):
+        requests = simulator.requests
+        start = time.perf_counter()
+        for i in range(count):
+            function(i)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<32} {1000 * elapsed / count:8.2f} ms/call {(simulator.requests - requests) / count:6.2f} "
+              f"transactions/call")
+
+    print(f"{count} calls, simulated latency {1000 * latency:.1f} ms")
+    measure("State, register by register", lambda i: [device.read_register(register, signed=True)
+                                                       for register in registers])
+    measure("State, block reads", lambda i: device.read_state())
+    # A slow slider drag, the same setpoint is sent several times in a row
+    measure("Setpoint, plain writes", lambda i: device.write_register(AR6X2.REGISTER_OUT1_TEMP, 1000 + i // 5,
+                                                                      0, signed=True))
+    measure("Setpoint, cached writes", lambda i: device.set_temperature(100 + (i // 5) / 10))
+    print(f"Device writes: {device.writes}, skipped: {device.skippedWrites}, "
+          f"simulator CRC errors: {simulator.crcErrors}")
+
+    device.serial.close()
+    simulator.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the AR6X2 driver against a simulated controller")
+    parser.add_argument("--latency", type=float, default=0.005, help="response latency of the simulator, seconds")
+    parser.add_argument("--count", type=int, default=200, help="calls per measurement")
+    arguments = parser.parse_args()
+    benchmark(arguments.latency, arguments.count)
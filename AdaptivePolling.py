@@ -0,0 +1,170 @@
+import time
+from Diagnostics import get_bus
+
+
+# Polling rate of one controller that follows what the flow does: the controller is polled at the baseline
+# interval while the flow is steady, and BOOST_FACTOR times faster (at most every MAX_BOOST_INTERVAL seconds,
+# at least every MIN_INTERVAL) after a boost. A boost is triggered by a setpoint write, or by the PV changing
+# faster than `threshold` units per second. The boosted interval is kept for HOLD_TIME seconds,
+# then stretched back to the baseline geometrically over DECAY_TIME seconds.
+# The derivative is taken over at least DERIVATIVE_SPAN seconds, so the resolution of the PV in dense polls
+# does not look like a transient.
+# Boosted intervals are granted by the PollingBudget of the bus, the baseline is never slowed down
+class AdaptivePolicy:
+    BOOST_FACTOR = 10
+    MIN_INTERVAL = 0.05
+    MAX_BOOST_INTERVAL = 1.0
+    HOLD_TIME = 10.0
+    DECAY_TIME = 30.0
+    DERIVATIVE_SPAN = 1.0
+
+    # Intervals in seconds, `threshold` in PV units per second (None disables the derivative trigger)
+    def __init__(self, baseline, threshold=None, budget=None):
+        self.baseline = baseline
+        self.threshold = threshold
+        self.budget = budget
+        # Monotonic time of the last boost, None if the policy is at its baseline
+        self.boostTime = None
+        # Interval last handed out, the budget counts the load of the policy with it
+        self.applied = baseline
+        self.boosts = 0
+        self.reference = None
+        if self.budget is not None:
+            self.budget.register(self)
+
+    def close(self):
+        if self.budget is not None:
+            self.budget.unregister(self)
+
+    def set_baseline(self, seconds):
+        self.baseline = seconds
+
+    def boosted_interval(self):
+        return min(self.baseline, max(min(self.baseline / self.BOOST_FACTOR, self.MAX_BOOST_INTERVAL),
+                                      self.MIN_INTERVAL))
+
+    def boost(self):
+        self.boostTime = time.monotonic()
+        self.boosts += 1
+
+    # Take a new sample, `timestamp` in seconds. Returns True if it triggered a boost
+    def observe(self, timestamp, pv):
+        if self.threshold is None:
+            return False
+        if self.reference is None or timestamp < self.reference[0]:
+            self.reference = (timestamp, pv)
+            return False
+        elapsed = timestamp - self.reference[0]
+        if elapsed < self.DERIVATIVE_SPAN:
+            return False
+        derivative = (pv - self.reference[1]) / elapsed
+        self.reference = (timestamp, pv)
+        if abs(derivative) > self.threshold:
+            self.boost()
+            return True
+        return False
+
+    # Interval the policy asks for, before the budget
+    def requested_interval(self, now=None):
+        if self.boostTime is None:
+            return self.baseline
+        elapsed = (now if now is not None else time.monotonic()) - self.boostTime
+        boosted = self.boosted_interval()
+        if elapsed < self.HOLD_TIME:
+            return boosted
+        progress = (elapsed - self.HOLD_TIME) / self.DECAY_TIME
+        if progress >= 1:
+            self.boostTime = None
+            return self.baseline
+        return boosted * (self.baseline / boosted) ** progress
+
+    def is_boosted(self):
+        return self.applied < self.baseline
+
+    # Interval to poll at now, in seconds
+    def interval(self):
+        requested = self.requested_interval()
+        if self.budget is None or requested >= self.baseline:
+            self.applied = requested
+        else:
+            self.applied = self.budget.allowed_interval(self, requested)
+        return self.applied
+
+
+# Ceiling on the share of time a bus spends on commands, kept by limiting the boosts of the AdaptivePolicies
+# polling it. The load of the bus is measured over the last WINDOW seconds from its diagnostics, so it includes
+# every command on it: polls of all channels (adaptive or not), setpoint writes and configuration.
+# Baseline polls and the other traffic are always let through, the rest of the ceiling is shared between
+# the boosted policies in proportion to the extra polls they ask for
+class PollingBudget:
+    DEFAULT_CEILING = 0.5
+    # Seconds, assumed for a poll until one was timed
+    DEFAULT_POLL_TIME = 0.02
+    POLL_COMMAND = "K poll"
+    WINDOW = 2.0
+
+    def __init__(self, diagnostics, ceiling=DEFAULT_CEILING):
+        self.diagnostics = diagnostics
+        self.ceiling = ceiling
+        self.policies = []
+        # Share of the extra polls granted the last time the boosts did not fit, 1.0 when they did
+        self.granted = 1.0
+        self.load = 0.0
+        self.__windowStart = (time.monotonic(), diagnostics.busyTime)
+
+    def register(self, policy):
+        if policy not in self.policies:
+            self.policies.append(policy)
+
+    def unregister(self, policy):
+        if policy in self.policies:
+            self.policies.remove(policy)
+
+    def set_ceiling(self, share):
+        self.ceiling = share
+
+    # Mean time of a poll on the bus, in seconds
+    def poll_time(self):
+        histogram = self.diagnostics.histograms.get(self.POLL_COMMAND)
+        if histogram is None or histogram.count == 0:
+            return self.DEFAULT_POLL_TIME
+        return histogram.mean()
+
+    # Share of the last window the bus was busy, the window is moved on once it is WINDOW seconds long
+    def measured_load(self):
+        now = time.monotonic()
+        start, busyTime = self.__windowStart
+        if busyTime > self.diagnostics.busyTime:
+            # The diagnostics were reset
+            self.__windowStart = (now, self.diagnostics.busyTime)
+        elif now - start >= self.WINDOW:
+            self.load = min((self.diagnostics.busyTime - busyTime) / (now - start), 1.0)
+            self.__windowStart = (now, self.diagnostics.busyTime)
+        return self.load
+
+    def allowed_interval(self, policy, requested):
+        now = time.monotonic()
+        pollTime = self.poll_time()
+        policies = self.policies if policy in self.policies else self.policies + [policy]
+
+        # Traffic other than the polls of the policies, as last measured
+        other = max(self.measured_load() - sum(pollTime / p.applied for p in policies), 0.0)
+        available = self.ceiling - other - sum(pollTime / p.baseline for p in policies)
+        extra = 0.0
+        for p in policies:
+            interval = requested if p is policy else p.requested_interval(now)
+            extra += max(pollTime / interval - pollTime / p.baseline, 0.0)
+
+        self.granted = 1.0 if extra <= available else max(available, 0.0) / extra
+        return 1 / (1 / policy.baseline + self.granted * (1 / requested - 1 / policy.baseline))
+
+
+_budget = None
+
+
+# Budget of the Brooks bus, shared by all controller tabs
+def get_budget():
+    global _budget
+    if _budget is None:
+        _budget = PollingBudget(get_bus("Brooks"))
+    return _budget
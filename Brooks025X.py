@@ -134,3 +134,8 @@ class Brooks025X:
             return response[4]
         else:
             return None
+
+    # Lock of the connection shared by all controllers, held for every query.
+    # Holding it keeps other threads off the bus, e.g. to send several commands back-to-back
+    def get_bus_lock(self):
+        return self.__connection.lock
@@ -0,0 +1,165 @@
+import re
+import threading
+import time
+import pyvisa
+from Controller import Controller
+from Diagnostics import BusDiagnostics, get_bus
+
+
+# Reentrant lock of a bus that is handed over by priority instead of in arrival order.
+# On release the bus goes to the waiting thread with the lowest priority number, the earliest one among equals.
+# Waiters of a priority above `agingLimit` are promoted to it once they waited `agingTime` seconds,
+# so a steady stream of polls can not starve configuration reads. A holder is never preempted:
+# the worst-case wait of the highest priority is the exchange in progress (bounded by the connection timeout)
+# plus the commands of the same priority queued before it.
+# Used as a context manager, the lock is acquired with `defaultPriority`
+class BusArbiter:
+    def __init__(self, defaultPriority, agingLimit, agingTime):
+        self.defaultPriority = defaultPriority
+        self.agingLimit = agingLimit
+        self.agingTime = agingTime
+        self.__condition = threading.Condition(threading.Lock())
+        self.__owner = None
+        self.__count = 0
+        self.__sequence = 0
+        # (priority, sequence, thread, monotonic time it was queued) of the waiting threads
+        self.__waiting = []
+
+    # Returns the time in seconds the caller waited, None if it already held the lock
+    def acquire(self, priority=None):
+        if priority is None:
+            priority = self.defaultPriority
+        thread = threading.get_ident()
+        with self.__condition:
+            if self.__owner == thread:
+                self.__count += 1
+                return None
+            requested = time.monotonic()
+            if self.__owner is None and len(self.__waiting) == 0:
+                self.__owner = thread
+                self.__count = 1
+                return 0.0
+            self.__sequence += 1
+            self.__waiting.append((priority, self.__sequence, thread, requested))
+            # The releasing thread hands the lock over, so a thread arriving later can not barge in
+            while self.__owner != thread:
+                self.__condition.wait()
+            return time.monotonic() - requested
+
+    def release(self):
+        with self.__condition:
+            if self.__owner != threading.get_ident():
+                raise RuntimeError("Bus lock released by a thread that does not hold it")
+            self.__count -= 1
+            if self.__count > 0:
+                return
+            if len(self.__waiting) == 0:
+                self.__owner = None
+                return
+            now = time.monotonic()
+            entry = min(self.__waiting, key=lambda waiter: (self.effective_priority(waiter, now), waiter[1]))
+            self.__waiting.remove(entry)
+            self.__owner = entry[2]
+            self.__count = 1
+            self.__condition.notify_all()
+
+    def effective_priority(self, waiter, now):
+        priority, sequence, thread, requested = waiter
+        if priority > self.agingLimit and now - requested >= self.agingTime:
+            return self.agingLimit
+        return priority
+
+    # Number of threads waiting for the bus
+    def queue_depth(self):
+        return len(self.__waiting)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+
+# Wrapper around the pyvisa connection to the Brooks device, shared by all controllers.
+# The GUI, sensor and dosing threads all send queries, so each query/response pair is done holding the bus,
+# otherwise a response could be read by the thread that did not ask for it.
+# Queries waiting for the bus are sent by priority: valve override writes first, then setpoint writes,
+# then polls, then the other configuration reads and writes. Holding `lock` (e.g. to send several setpoint
+# writes back-to-back) counts as a setpoint write.
+# Every query is recorded in the "Brooks" bus diagnostics, as a K poll, P read or P write,
+# and the time it waited for the bus under its priority.
+# Anything other than query() is passed to the connection unchanged
+class BrooksTransport:
+    PRIORITY_SAFETY = 0
+    PRIORITY_SETPOINT = 1
+    PRIORITY_POLL = 2
+    PRIORITY_CONFIG = 3
+    PRIORITY_NAMES = ["Safety", "Setpoint", "Poll", "Config"]
+    # Seconds a configuration query waits before it is sent like a poll
+    AGING_TIME = 1.0
+
+    WRITE_PATTERN = re.compile(r"P(\d+)=")
+
+    def __init__(self, pyvisaConnection):
+        self.connection = pyvisaConnection
+        self.lock = BusArbiter(self.PRIORITY_SETPOINT, self.PRIORITY_POLL, self.AGING_TIME)
+        self.diagnostics = get_bus("Brooks")
+        self.waits = [self.diagnostics.wait_histogram(name) for name in self.PRIORITY_NAMES]
+
+        # Statistics, in seconds
+        self.queries = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def query(self, command, priority=None):
+        if priority is None:
+            priority = self.command_priority(command)
+        wait = self.lock.acquire(priority)
+        try:
+            # Queries sent while already holding the bus did not wait for it
+            if wait is not None:
+                self.waits[priority].record(wait)
+                self.queries += 1
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+
+            start = time.monotonic()
+            try:
+                response = self.connection.query(command)
+            except pyvisa.errors.VisaIOError as e:
+                timedOut = e.error_code == pyvisa.constants.StatusCode.error_timeout
+                self.diagnostics.record(self.command_kind(command), start,
+                                        BusDiagnostics.TIMEOUT if timedOut else BusDiagnostics.ERROR)
+                raise
+            fields = response.split(sep=',')
+            valid = len(fields) > 2 and fields[2] == Controller.TYPE_RESPONSE
+            self.diagnostics.record(self.command_kind(command), start,
+                                    BusDiagnostics.OK if valid else BusDiagnostics.UNEXPECTED)
+            return response
+        finally:
+            self.lock.release()
+
+    # Name the query is recorded under
+    @staticmethod
+    def command_kind(command):
+        if command.endswith('K'):
+            return "K poll"
+        if '=' in command:
+            return "P write"
+        return "P read"
+
+    @staticmethod
+    def command_priority(command):
+        if command.endswith('K'):
+            return BrooksTransport.PRIORITY_POLL
+        write = BrooksTransport.WRITE_PATTERN.search(command)
+        if write is not None:
+            if int(write.group(1)) == Controller.PARAM_SP_VOR:
+                return BrooksTransport.PRIORITY_SAFETY
+            if int(write.group(1)) == Controller.PARAM_SP_RATE:
+                return BrooksTransport.PRIORITY_SETPOINT
+        return BrooksTransport.PRIORITY_CONFIG
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
@@ -140,6 +140,10 @@ class Controller:
         "day": 4
     })
 
+    # Limits of the values the setters accept (they assert them), datasheet section C-5-4
+    SETPOINT_LIMIT = 999.999
+    GAS_FACTOR_LIMIT = 999.999
+
     # Polled Message types - datasheet (C-4-5-2 Message Format)
     TYPE_RESPONSE = '4'
     TYPE_BATCH_CONTROL_STATUS = '5'
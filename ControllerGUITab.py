@@ -1,29 +1,49 @@
 import sys
 import pyqtgraph
-from PyQt5.QtCore import Qt, QTimer, QRegExp, pyqtSignal
+from PyQt5.QtCore import Qt, QRegExp, pyqtSignal
 from PyQt5.QtGui import QRegExpValidator, QIntValidator, QIcon
 from PyQt5.QtWidgets import (
     QCheckBox,
     QLineEdit,
     QVBoxLayout,
-    QWidget, QHBoxLayout, QGridLayout, QGroupBox, QSlider, QLabel, QPushButton, QFormLayout, QComboBox, QErrorMessage
+    QWidget, QHBoxLayout, QGridLayout, QGroupBox, QSlider, QLabel, QPushButton, QFormLayout, QComboBox, QErrorMessage,
+    QFileDialog
 )
-from pyqtgraph import PlotWidget
+from pyqtgraph import PlotWidget, ViewBox
 import numpy as np
 from Controller import Controller
 from AR6X2ConfigDialog import AR6X2ConfigDialog
 from AR6X2 import AR6X2
+from AR6X2Poller import AR6X2Poller
+from ControllerPoller import ControllerPoller
+from AdaptivePolling import AdaptivePolicy, get_budget
+from WriteCoalescer import WriteCoalescer
+from DosingScheduler import DosingScheduler
+from DosingProfile import load_profiles
+from VolumeDoser import VolumeDoser
+from DosingSimulation import DosingSimulation, TIME_BASE_SECONDS
 from SensorConfigDialog import SensorConfigDialog
 from Sensor import Sensor
+from CsvWriter import ByteCounter, CsvWriter
+from Scheduler import ScheduledTimer
 from datetime import datetime
 from numpy_ringbuffer import RingBuffer
 from serial import SerialException
 import re
+import time
+import pyvisa
 import resources
 
 
 class ControllerGUITab(QWidget):
     LEFT_COLUMN_MAX_WIDTH = 400
+    LATE_POLL_FACTOR = 1.5
+    # In high-rate mode the intervals are in milliseconds and the controller is polled by its own thread,
+    # the samples are drawn and logged in batches every RENDER_INTERVAL milliseconds
+    HIGH_RATE_INTERVAL = 100
+    RENDER_INTERVAL = 200
+    # PV change per second that boosts adaptive polling, as a share of the PV full scale
+    DERIVATIVE_THRESHOLD = 0.01
 
     # This signal tells the global tab if is not possible to start dosing for this tab
     # False is sent out when the dosing vectors are incorrect or when the process is already started
@@ -34,6 +54,8 @@ class ControllerGUITab(QWidget):
     
     # Signal when a sample is ready for the combined plot
     sampleReady = pyqtSignal(int, np.float16)
+    # Samples gathered in high-rate mode since the last batch, as a numpy array
+    sampleBatchReady = pyqtSignal(int, object)
 
     def __init__(self, controller: Controller):
         super().__init__()
@@ -42,6 +64,9 @@ class ControllerGUITab(QWidget):
         self.graph = None
         self.controller = controller
         self.temperatureController = None
+        self.temperaturePoller = None
+        # Sends the setpoint of the temperature controller without blocking the GUI, None while not connected
+        self.temperatureWriter = None
         self.tempControllerGroup = None
         self.sensor1 = None
         self.sensor2 = None
@@ -64,19 +89,34 @@ class ControllerGUITab(QWidget):
 
         self.bufferSizeEdit = None
         self.intervalEdit = None
+        self.intervalUnitsLabel = None
+        self.highRateCheckbox = None
+        self.adaptiveCheckbox = None
+        # Adapts the polling interval to the flow, None while adaptive polling is off
+        self.pollingPolicy = None
+        # Polls the controller in high-rate mode, None otherwise
+        self.poller = None
+        self.renderTimer = None
+        # Interval in minutes to return to when high-rate mode is left
+        self.lowRateInterval = "1"
         self.setpointEdit = None
         self.setpointUnitsLabel = None
         self.saveCsvButton = None
 
         self.sensor1Timer = None
         self.sensor1SampleIntervalEdit = None
+        self.sensor1IntervalUnitsLabel = None
         self.sensor1BufferSizeEdit = None
+        self.sensor1StatusLabel = None
 
         self.sensor2Timer = None
         self.sensor2SampleIntervalEdit = None
+        self.sensor2IntervalUnitsLabel = None
         self.sensor2BufferSizeEdit = None
+        self.sensor2StatusLabel = None
 
         self.temperatureSlider = None
+        self.temperatureWriteTimer = None
         self.temperatureLabel = None
         self.tempReadoutLabel = None
         self.rangeLowEdit = None
@@ -86,9 +126,26 @@ class ControllerGUITab(QWidget):
         self.tempControlButton = None
 
         self.dosingTimesEdit = None
+        self.dosingTimesLabel = None
         self.dosingTimes = None
+        # With volume steps the times edit holds the volume of every step, delivered according to the totalizer
+        self.dosingVolumeCheckbox = None
+        self.dosingVolumes = None
+        self.dosingTimesUnitsLabel = None
         self.dosingValuesEdit = None
         self.dosingValues = None
+        self.dosingRampsEdit = None
+        self.dosingRamps = None
+        self.dosingRateEdit = None
+        self.dosingRate = None
+        # Profile loaded from a file, used instead of the vectors typed in until they are edited
+        self.dosingProfile = None
+        self.dosingProfileButton = None
+        # Expected course of the dosing process from the last dry run, drawn over the graph until the process starts
+        self.dosingPreview = None
+        self.dosingDryRunButton = None
+        # Response time of the flow to setpoint changes assumed by dry runs, in seconds
+        self.dryRunTimeConstant = 1.0
         self.dosingUnitsLabel = None
         self.dosingLabel = None
         self.dosingVorStateLabel = None
@@ -100,6 +157,9 @@ class ControllerGUITab(QWidget):
         self.samplesPV = RingBuffer(capacity=self.sampleBufferSize, dtype=np.float16)
         self.samplesTotalizer = RingBuffer(capacity=self.sampleBufferSize, dtype=np.float32)
         self.sampleTimestamps = RingBuffer(capacity=self.sampleBufferSize, dtype=datetime)
+        # Probe temperature of the temperature controller at the time of each sample, NaN if not connected
+        self.samplesTemperature = RingBuffer(capacity=self.sampleBufferSize, dtype=np.float32)
+        self.temperatureViewBox = None
 
         # Nest the inner layouts into the outer layout
         outerLayout.addLayout(self.create_left_column())
@@ -109,20 +169,52 @@ class ControllerGUITab(QWidget):
 
         # Generic timer that calls generic_update every second
         # Used to update a few labels
-        self.genericTimer = QTimer()
+        self.genericTimer = ScheduledTimer(ScheduledTimer.PRIORITY_DISPLAY)
         self.genericTimer.timeout.connect(self.update_generic)
         self.genericTimer.start(1000)
 
-        self.graphTimer = QTimer()
+        # Polls the controller, the polls of all tabs run together at the start of a scheduler cycle
+        self.graphTimer = ScheduledTimer(ScheduledTimer.PRIORITY_IO, precise=True)
         self.graphTimer.timeout.connect(self.update_plot)
         self.graphTimer.start(int(60*1000*float(self.intervalEdit.text())))
 
+        self.renderTimer = ScheduledTimer(ScheduledTimer.PRIORITY_DISPLAY)
+        self.renderTimer.timeout.connect(self.render_samples)
+
+        # Interactive edits of the controller parameters are written in the background, only the newest value
+        # of a parameter is sent if it is edited again before the bus was free
+        self.controllerWriter = WriteCoalescer(f"Controller {self.controller.channel}")
+        self.controllerWriter.writeFinished.connect(self.write_finished)
+
         self.dosingValue = None
-        self.dosingTimer = QTimer()
-        self.dosingTimer.timeout.connect(self.dosing_process)
+        # Runs the dosing process in the background, None while dosing is disabled
+        self.dosingScheduler = None
+        # Timing of the last finished dosing process, shown while dosing is disabled
+        self.dosingSummary = None
 
         self.csvFile = None
         self.csvIterator = 1
+        # Bytes written to all csv files of this tab, every file adds to it
+        self.csvBytes = ByteCounter()
+
+        # Acquisition statistics, plain attributes so the metrics server can read them from its thread.
+        # A poll is dropped when the device gave no valid measurement,
+        # and late when it came more than LATE_POLL_FACTOR intervals after the previous one
+        self.samplesAcquired = 0
+        self.droppedPolls = 0
+        self.latePolls = 0
+        self.lastPollTime = None
+        self.lastPV = None
+        # Counters of the high-rate poller already added to the ones above
+        self.pollerErrors = 0
+        self.pollerLate = 0
+        # Last setpoint the device confirmed, None until the first confirmed write
+        self.setpoint = None
+        # Edits of the parameters written through controllerWriter, and their text as last confirmed by the device.
+        # A rejected write puts its edit back to that text
+        self.parameterEdits = {"setpoint": self.setpointEdit, "gas factor": self.gasFactorEdit,
+                               "PV full scale": self.pvFullScaleEdit}
+        self.confirmedTexts = {parameter: edit.text() for parameter, edit in self.parameterEdits.items()}
 
         self.defaultStyleSheet = QLineEdit().styleSheet()
 
@@ -130,20 +222,45 @@ class ControllerGUITab(QWidget):
         # text correctly after a process shutdown
         self.spValue = 1.0
 
-        # Get initial dosing values from the text inside
+        # Get initial dosing values from the text inside, times are in seconds
         self.dosingValues = [float(x) for x in self.dosingValuesEdit.text().split(sep=',') if x.strip() != '']
-        self.dosingTimes = [float(x) * 60 * 1000 for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
-        self.dosingValues.reverse()
-        self.dosingTimes.reverse()
+        self.dosingTimes = [float(x) * 60 for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingVolumes = [float(x) for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingRamps = [x.strip() for x in self.dosingRampsEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingRate = float(self.dosingRateEdit.text())
 
+    # Returns True if a sample was added to the buffers
     def get_measurement(self):
+        now = time.monotonic()
+        if self.lastPollTime is not None and \
+                now - self.lastPollTime > self.LATE_POLL_FACTOR * self.graphTimer.interval() / 1000:
+            self.latePolls += 1
+        self.lastPollTime = now
+
         # Proper implementation that gets the data from the device over serial
-        current, total, timestamp = self.controller.get_measurements()
-        if total is not None:
-            self.samplesTotalizer.append(total)
-            self.samplesPV.append(current)
-            self.sampleTimestamps.append(timestamp)
-            self.sampleReady.emit(self.controller.channel, current)
+        try:
+            measurements = self.controller.get_measurements()
+        except (pyvisa.errors.VisaIOError, IndexError) as e:
+            print(f"Controller {self.controller.channel}: measurement failed: {e}")
+            measurements = None
+        if measurements is None or measurements[1] is None:
+            self.droppedPolls += 1
+            return False
+
+        current, total, timestamp = measurements
+        self.samplesAcquired += 1
+        self.lastPV = float(current)
+        self.samplesTotalizer.append(total)
+        self.samplesPV.append(current)
+        self.sampleTimestamps.append(timestamp)
+        if self.temperaturePoller is not None and self.temperaturePoller.latest is not None:
+            self.samplesTemperature.append(self.temperaturePoller.latest[1]['probe'])
+        else:
+            self.samplesTemperature.append(np.nan)
+        self.sampleReady.emit(self.controller.channel, current)
+        if self.pollingPolicy is not None:
+            self.pollingPolicy.observe(now, float(current))
+        return True
 
     # Save samples to a csv file, named after the current time and controller number it is coming from
     # After this function saving is continued by update_plot function, which calls append_to_csv
@@ -154,7 +271,7 @@ class ControllerGUITab(QWidget):
             self.save_to_csv_stop()
         filename = datetime.now().strftime(f"controller{self.controller.channel}_%Y-%m-%d_%H-%M-%S.csv")
 
-        self.csvFile = open(filename, 'w')
+        self.csvFile = CsvWriter(filename, self.csvBytes)
         self.csvFile.write(
             f"Gas factor:{self.controller.get_gas()}\tDecimal point:{self.controller.get_decimal_point()},\tUnits:{self.controller.get_measurement_units()}/{self.controller.get_time_base()}\n")
         self.csvFile.write("{:<15} {:^18} {:>19}\n".format("Measurement", "Totalizer", "Time of measurement"))
@@ -170,22 +287,32 @@ class ControllerGUITab(QWidget):
         self.savingSignal.emit(True)
 
     def append_to_csv(self):
+        self.rotate_csv_file()
+        self.csvFile.write("{:<15},{:^18},{:>19}\n".format(self.samplesPV[len(self.samplesPV) - 1],
+                                                           self.samplesTotalizer[len(self.samplesPV) - 1],
+                                                           self.sampleTimestamps[len(self.samplesPV) - 1].strftime(
+                                                               "%Y/%m/%d,%H:%M:%S")))
+
+    # Log the samples of a high-rate batch with one write, the timestamps have microseconds
+    def append_batch_to_csv(self, readings):
+        self.rotate_csv_file()
+        self.csvFile.write("".join("{:<15},{:^18},{:>26}\n".format(current, total,
+                                                                   timestamp.strftime("%Y/%m/%d,%H:%M:%S.%f"))
+                                   for timestamp, current, total, pollTime in readings))
+
+    def rotate_csv_file(self):
         # check if file is bigger than ~8MB
         if self.csvFile.tell() > 8192000:
             name = re.sub(r"(|_[0-9]+).csv", f"_{self.csvIterator}.csv",
                           self.csvFile.name.split("\\")[len(self.csvFile.name.split("\\")) - 1])
             self.csvIterator += 1
             self.append_sensor()
-            self.csvFile.close()
-            self.csvFile = open(name, 'w')
-        self.csvFile.write("{:<15},{:^18},{:>19}\n".format(self.samplesPV[len(self.samplesPV) - 1],
-                                                           self.samplesTotalizer[len(self.samplesPV) - 1],
-                                                           self.sampleTimestamps[len(self.samplesPV) - 1].strftime(
-                                                               "%Y/%m/%d,%H:%M:%S")))
+            self.close_csv_file()
+            self.csvFile = CsvWriter(name, self.csvBytes)
 
     def save_to_csv_stop(self):
         self.append_sensor()
-        self.csvFile.close()
+        self.close_csv_file()
         self.csvFile = None
         self.saveCsvButton.clicked.disconnect()
         self.saveCsvButton.clicked.connect(self.save_to_csv_start)
@@ -193,20 +320,36 @@ class ControllerGUITab(QWidget):
         self.csvIterator = 1
         self.savingSignal.emit(False)
 
+    # Waits until everything queued for the current file was written
+    def close_csv_file(self):
+        self.csvFile.close()
+
     def append_sensor(self):
         # if available, append data from sensors
+        # the buffers are filled by the sensor reader threads, so they are drained instead of iterated
+        # parsed numeric data is saved next to the csv file in numpy binary format
+        if self.sensor1 is not None:
+            self.sensor1.save_columns(self.csvFile.name.replace(".csv", "_sensor1.npz"))
+        if self.sensor2 is not None:
+            self.sensor2.save_columns(self.csvFile.name.replace(".csv", "_sensor2.npz"))
+
         if self.sensor1 is not None and len(self.sensor1.buffer) > 0:
             self.csvFile.write(f"Sensor 1 header: {self.sensor1.header}\n")
-            for i in range(0, len(self.sensor1.buffer)):
-                self.csvFile.write(str(self.sensor1.buffer[i]))
-            self.sensor1.buffer.clear()
+            for timestamp, line in self.sensor1.drain():
+                self.csvFile.write(f"{timestamp.strftime('%Y/%m/%d,%H:%M:%S.%f')},{line}\n")
             self.csvFile.write('\n')
 
         if self.sensor2 is not None and len(self.sensor2.buffer) > 0:
             self.csvFile.write(f"Sensor 2 header: {self.sensor2.header}\n")
-            for i in range(0, len(self.sensor2.buffer)):
-                self.csvFile.write(str(self.sensor2.buffer[i]))
-            self.sensor2.buffer.clear()
+            for timestamp, line in self.sensor2.drain():
+                self.csvFile.write(f"{timestamp.strftime('%Y/%m/%d,%H:%M:%S.%f')},{line}\n")
+
+        if self.temperaturePoller is not None and len(self.temperaturePoller.readings) > 0:
+            self.csvFile.write('\n')
+            self.csvFile.write("Temperature controller: probe,setpoint,output state,ramp state\n")
+            for timestamp, state in self.temperaturePoller.drain():
+                self.csvFile.write(f"{timestamp.strftime('%Y/%m/%d,%H:%M:%S.%f')},{state['probe']},"
+                                   f"{state['setpoint']},{state['outputState']},{state['rampState']}\n")
 
     # Handler functions for UI elements
     # TODO: react to returned value from functions
@@ -235,11 +378,59 @@ class ControllerGUITab(QWidget):
             self.dosingVorStateLabel.setText("VOR is open")
             self.dosingVorStateLabel.setStyleSheet("color: red;")
 
+    # Confirmation of a write, the device echoes the value it took
+    @staticmethod
+    def echoes(value, tolerance):
+        return lambda echo: echo is not None and abs(float(echo) - value) <= tolerance
+
+    # A value is only taken as applied once the device confirmed it. A rejected one is marked red on its edit,
+    # which goes back to the last confirmed value unless a newer value is already waiting to be sent
+    def write_finished(self, parameter, value, confirmed):
+        edit = self.parameterEdits.get(parameter)
+        if confirmed:
+            if parameter == "setpoint":
+                self.setpoint = value
+            if edit is not None:
+                self.confirmedTexts[parameter] = str(value)
+                edit.setStyleSheet(self.defaultStyleSheet)
+                edit.setToolTip("")
+            return
+
+        print(f"Controller {self.controller.channel}: {parameter} {value} was not confirmed by the device")
+        if edit is None or self.controllerWriter.is_pending(parameter):
+            return
+        # The setpoint edit shows the dosing value while a process runs
+        if edit.isEnabled():
+            edit.setText(self.confirmedTexts[parameter])
+        edit.setStyleSheet("color: red;")
+        edit.setToolTip(f"{value} was not confirmed by the device, {self.confirmedTexts[parameter]} is applied")
+
+    # Show an error and return False if `value` is outside the range the controller accepts
+    @staticmethod
+    def check_range(name, value, low, high):
+        if low <= value <= high:
+            return True
+        dg = QErrorMessage()
+        dg.setWindowIcon(QIcon(':/icon.png'))
+        dg.setWindowTitle("Error")
+        dg.showMessage(f"The {name} must be between {low} and {high}, {value} was not written")
+        dg.exec_()
+        return False
+
     def update_gas_factor(self):
-        self.controller.set_gas_factor(float(self.gasFactorEdit.text()))
+        value = float(self.gasFactorEdit.text())
+        if not self.check_range("gas factor", value, 0, Controller.GAS_FACTOR_LIMIT):
+            return
+        self.controllerWriter.submit("gas factor", self.controller.set_gas_factor, value, self.echoes(value, 0.001))
 
     def update_pv_full_scale(self):
-        self.controller.set_pv_full_scale(float(self.pvFullScaleEdit.text()))
+        value = float(self.pvFullScaleEdit.text())
+        if not self.check_range("PV full scale", value, -Controller.SETPOINT_LIMIT, Controller.SETPOINT_LIMIT):
+            return
+        self.controllerWriter.submit("PV full scale", self.controller.set_pv_full_scale, value,
+                                     self.echoes(value, 10 ** -self.controller.decimalPoint))
+        if self.pollingPolicy is not None:
+            self.pollingPolicy.threshold = self.derivative_threshold()
 
     def update_pv_signal_type(self):
         self.controller.set_pv_signal_type(self.pvSigtypeDropdown.currentText())
@@ -257,6 +448,8 @@ class ControllerGUITab(QWidget):
         self.controller.set_decimal_point(self.decimalDropdown.currentText())
 
     def update_measure_units(self):
+        if self.dosingVolumeCheckbox is not None and self.dosingVolumeCheckbox.isChecked():
+            self.dosingTimesUnitsLabel.setText(self.measureUnitsDropdown.currentText())
         if self.dosingUnitsLabel is not None:
             self.dosingUnitsLabel.setText(
                 f"{self.measureUnitsDropdown.currentText()}/{self.timebaseDropdown.currentText()}")
@@ -278,28 +471,87 @@ class ControllerGUITab(QWidget):
         self.change_buffer_size(int(self.bufferSizeEdit.text()))
         self.sampleBufferSize = int(self.bufferSizeEdit.text())
 
+    # Seconds per unit of the interval edits, milliseconds in high-rate mode and minutes otherwise
+    def interval_unit(self):
+        return 0.001 if self.poller is not None else 60
+
     def update_graph_timer(self):
-        self.graphTimer.setInterval(float(self.intervalEdit.text()) * 60 * 1000)
+        interval = float(self.intervalEdit.text()) * self.interval_unit()
+        if self.poller is not None:
+            interval = max(interval, 0.001)
+        if self.pollingPolicy is not None:
+            self.pollingPolicy.set_baseline(interval)
+            interval = self.pollingPolicy.interval()
+        self.set_polling_interval(interval)
+        # The gap to the next poll depends on the old interval, it is not counted as late
+        self.lastPollTime = None
+
+    # Poll every `seconds` from now on, the graph timer is only restarted if the interval changed
+    def set_polling_interval(self, seconds):
+        if self.poller is not None:
+            self.poller.set_interval(seconds)
+        elif int(seconds * 1000) != self.graphTimer.interval():
+            self.graphTimer.setInterval(seconds * 1000)
+
+    def derivative_threshold(self):
+        try:
+            return self.DERIVATIVE_THRESHOLD * abs(float(self.pvFullScaleEdit.text()))
+        except ValueError:
+            return None
+
+    def update_adaptive_polling(self):
+        if self.adaptiveCheckbox.isChecked():
+            self.pollingPolicy = AdaptivePolicy(float(self.intervalEdit.text()) * self.interval_unit(),
+                                                self.derivative_threshold(), get_budget())
+        elif self.pollingPolicy is not None:
+            self.pollingPolicy.close()
+            self.pollingPolicy = None
+        self.update_graph_timer()
+
+    # Boost adaptive polling after a setpoint change, so the response is sampled densely
+    def boost_polling(self):
+        if self.pollingPolicy is not None:
+            self.pollingPolicy.boost()
+            self.set_polling_interval(self.pollingPolicy.interval())
+
+    # Called after every poll, follows the boost and decay of adaptive polling
+    def adapt_polling_interval(self):
+        if self.pollingPolicy is not None:
+            self.set_polling_interval(self.pollingPolicy.interval())
 
     def update_setpoint(self):
         value = float(self.setpointEdit.text())
-        self.controller.set_setpoint(value)
+        if not self.check_range("setpoint", value, -Controller.SETPOINT_LIMIT, Controller.SETPOINT_LIMIT):
+            return
+        self.controllerWriter.submit("setpoint", self.controller.set_setpoint, value,
+                                     self.echoes(value, 10 ** -self.controller.decimalPoint))
+        self.boost_polling()
 
     def update_sensor1_timer(self):
-        self.sensor1Timer.setInterval(float(self.sensor1SampleIntervalEdit.text()) * 60 * 1000)
+        if self.sensor1 is not None:
+            self.sensor1.set_interval(float(self.sensor1SampleIntervalEdit.text()) * self.interval_unit())
 
     def update_sensor1_buffer(self):
         self.sensor1.change_buffer_size(int(self.sensor1BufferSizeEdit.text()))
 
     def update_sensor2_timer(self):
-        self.sensor2Timer.setInterval(float(self.sensor2SampleIntervalEdit.text()) * 60 * 1000)
+        if self.sensor2 is not None:
+            self.sensor2.set_interval(float(self.sensor2SampleIntervalEdit.text()) * self.interval_unit())
 
     def update_sensor2_buffer(self):
         self.sensor2.change_buffer_size(int(self.sensor2BufferSizeEdit.text()))
 
+    # Slider movement only restarts the write timer, so dragging the slider ends in a single write
     def update_temperature(self):
-        self.temperatureController.set_temperature(float(self.temperatureSlider.value()))
-        self.temperatureLabel.setText(self.temperatureSlider.value())
+        self.temperatureLabel.setText(str(self.temperatureSlider.value()))
+        self.temperatureWriteTimer.start()
+
+    # The AR6X2 checks the echo of a register write itself, a write that raised no error is confirmed
+    def write_temperature(self):
+        self.temperatureWriteTimer.stop()
+        if self.temperatureWriter is not None:
+            self.temperatureWriter.submit("temperature", self.temperatureController.set_temperature,
+                                          float(self.temperatureSlider.value()))
 
     def update_range_low(self):
         newTemp = self.temperatureController.set_range_low(float(self.rangeLowEdit.text()))
@@ -318,104 +570,301 @@ class ControllerGUITab(QWidget):
             self.temperatureController.ramping_off()
 
     def update_gradient(self):
-        self.temperatureController.set_gradient(float())
+        self.temperatureController.set_gradient(float(self.gradientEdit.text()))
 
     def update_temp_control_enable(self):
         if self.tempControlButton.isChecked():
-            self.temperatureController.ramping_on()
+            self.temperatureController.turn_on()
             self.tempControlButton.setText("Disable output")
         else:
-            self.temperatureController.ramping_off()
+            self.temperatureController.turn_off()
             self.tempControlButton.setText("Enable output")
 
+    # Ramps are optional, steps without one (or with "step") change the setpoint at once.
+    # Editing the vectors replaces a loaded profile
     def update_dosing_vectors(self):
-        self.dosingValues = [float(x) for x in self.dosingValuesEdit.text().split(sep=',') if x.strip() != '']
-        self.dosingTimes = [float(x) * 1000 * 60 for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
-
-        # Since we will be using pop() to get the next values, we reverse the arrays
-        self.dosingValues.reverse()
-        self.dosingTimes.reverse()
+        if self.dosingProfile is not None:
+            self.dosingProfile = None
+            self.dosingTimesEdit.setPlaceholderText("")
+            self.dosingValuesEdit.setPlaceholderText("")
+            self.dosingRampsEdit.setPlaceholderText("step, linear, exp, cubic")
 
-        if len(self.dosingTimes) != len(self.dosingValues) or len(self.dosingTimes) * len(self.dosingValues) == 0:
+        self.dosingValues = [float(x) for x in self.dosingValuesEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingTimes = [float(x) * 60 for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingVolumes = [float(x) for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingRamps = [x.strip() for x in self.dosingRampsEdit.text().split(sep=',') if x.strip() != '']
+        self.dosingPreview = None
+        self.update_dosing_validity()
+
+    # Volume steps are delivered one after another as measured by the totalizer, they have no ramps.
+    # A loaded profile is given in times, so it is dropped
+    def update_dosing_volume_mode(self):
+        volumeMode = self.dosingVolumeCheckbox.isChecked()
+        self.dosingTimesLabel.setText("Volumes" if volumeMode else "Times")
+        self.dosingTimesUnitsLabel.setText(self.measureUnitsDropdown.currentText() if volumeMode else "minutes")
+        self.dosingRampsEdit.setEnabled(not volumeMode)
+        self.dosingRateEdit.setEnabled(not volumeMode)
+        self.dosingProfileButton.setEnabled(not volumeMode)
+        self.update_dosing_vectors()
+
+    def update_dosing_validity(self):
+        try:
+            self.dosingRate = float(self.dosingRateEdit.text())
+        except ValueError:
+            self.dosingRate = 0
+
+        rampsValid = self.dosingProfile is not None or self.dosingVolumeCheckbox.isChecked() or \
+            (len(self.dosingRamps) <= len(self.dosingValues) and
+             all(ramp in DosingScheduler.RAMPS for ramp in self.dosingRamps))
+        rateValid = 0 < self.dosingRate <= DosingScheduler.MAX_RATE
+        # Profiles are checked when they are loaded. Volume steps need a positive setpoint to ever reach their volume
+        valuesValid = self.dosingProfile is not None or \
+            all(abs(value) <= Controller.SETPOINT_LIMIT for value in self.dosingValues)
+        if self.dosingVolumeCheckbox.isChecked():
+            valuesValid = valuesValid and all(value > 0 for value in self.dosingValues)
+        self.dosingRampsEdit.setStyleSheet(self.defaultStyleSheet if rampsValid else "color: red;")
+        self.dosingRateEdit.setStyleSheet(self.defaultStyleSheet if rateValid else "color: red;")
+
+        if self.dosingProfile is None and (len(self.dosingTimes) != len(self.dosingValues) or
+                                           len(self.dosingTimes) * len(self.dosingValues) == 0 or
+                                           self.dosingVolumeCheckbox.isChecked() and
+                                           not all(volume > 0 for volume in self.dosingVolumes)):
             self.dosingTimesEdit.setStyleSheet("color: red;")
             self.dosingValuesEdit.setStyleSheet("color: red;")
             self.dosingControlButton.setEnabled(False)
             self.dosingSignal.emit(True)
+        elif not valuesValid:
+            self.dosingTimesEdit.setStyleSheet(self.defaultStyleSheet)
+            self.dosingValuesEdit.setStyleSheet("color: red;")
+            self.dosingControlButton.setEnabled(False)
+            self.dosingSignal.emit(True)
+        elif not rampsValid or not rateValid:
+            self.dosingTimesEdit.setStyleSheet(self.defaultStyleSheet)
+            self.dosingValuesEdit.setStyleSheet(self.defaultStyleSheet)
+            self.dosingControlButton.setEnabled(False)
+            self.dosingSignal.emit(True)
         else:
             self.dosingTimesEdit.setStyleSheet(self.defaultStyleSheet)
             self.dosingValuesEdit.setStyleSheet(self.defaultStyleSheet)
             self.dosingControlButton.setEnabled(True)
             self.dosingSignal.emit(False)
 
+    # Load the dosing process of this controller from a CSV or JSON file, see DosingProfile.load_profiles
+    def load_dosing_profile(self):
+        filename, _ = QFileDialog.getOpenFileName(self, "Load dosing profile", "", "Dosing profiles (*.csv *.json)")
+        if filename == '':
+            return
+        try:
+            profiles = load_profiles(filename)
+            if self.controller.channel in profiles:
+                self.set_dosing_profile(profiles[self.controller.channel])
+            elif None in profiles:
+                self.set_dosing_profile(profiles[None])
+            else:
+                raise ValueError(f"The file holds no profile for controller {self.controller.channel}")
+        except ValueError as e:
+            errorMessage = QErrorMessage(self)
+            errorMessage.setWindowIcon(QIcon(':/icon.png'))
+            errorMessage.setWindowTitle("Error")
+            errorMessage.showMessage(f"Loading the dosing profile failed: {e}")
+            errorMessage.exec_()
+
+    def set_dosing_profile(self, profile):
+        self.dosingProfile = profile
+        # The vectors are cleared without signals, editing them later drops the profile
+        for edit in [self.dosingTimesEdit, self.dosingValuesEdit, self.dosingRampsEdit]:
+            edit.blockSignals(True)
+            edit.clear()
+            edit.blockSignals(False)
+            edit.setPlaceholderText(f"Loaded from {profile.name}")
+        self.dosingPreview = None
+        self.update_dosing_validity()
+        self.update_generic()
+
+    # Expected course of the dosing process as it is set up now, starting from the current flow.
+    # Volume steps are simulated as steps lasting the time the setpoint needs to deliver the volume.
+    # Raises ValueError if the process can not be simulated
+    def simulate_dosing(self):
+        timeBase = self.timebaseDropdown.currentText()
+        current = float(self.samplesPV[len(self.samplesPV) - 1]) if len(self.samplesPV) > 0 else 0.0
+        if self.dosingVolumeCheckbox.isChecked():
+            if len(self.dosingValues) != len(self.dosingVolumes) or \
+                    not all(value > 0 for value in self.dosingValues + self.dosingVolumes):
+                raise ValueError("Volume steps need a setpoint above 0 for every volume above 0")
+            durations = np.array(self.dosingVolumes) / np.array(self.dosingValues) * TIME_BASE_SECONDS[timeBase]
+            return DosingSimulation(self.dosingValues, durations, decimals=self.controller.decimalPoint,
+                                    timeConstant=self.dryRunTimeConstant, initialFlow=current, timeBase=timeBase)
+        if self.dosingProfile is not None:
+            return DosingSimulation(self.dosingProfile.values, self.dosingProfile.durations,
+                                    self.dosingProfile.ramp_names(), self.dosingRate, self.controller.decimalPoint,
+                                    self.dryRunTimeConstant, current, timeBase)
+        if len(self.dosingTimes) != len(self.dosingValues) or len(self.dosingValues) == 0 or \
+                len(self.dosingRamps) > len(self.dosingValues) or \
+                not all(ramp in DosingScheduler.RAMPS for ramp in self.dosingRamps) or \
+                not 0 < self.dosingRate <= DosingScheduler.MAX_RATE:
+            raise ValueError("The dosing vectors are not valid")
+        return DosingSimulation(self.dosingValues, self.dosingTimes, self.dosingRamps, self.dosingRate,
+                                self.controller.decimalPoint, self.dryRunTimeConstant, current, timeBase)
+
+    # Simulate the dosing process and draw its expected flow over the graph, returns the simulation or None
+    def dry_run_dosing(self):
+        try:
+            self.dosingPreview = self.simulate_dosing()
+        except ValueError as e:
+            errorMessage = QErrorMessage(self)
+            errorMessage.setWindowIcon(QIcon(':/icon.png'))
+            errorMessage.setWindowTitle("Error")
+            errorMessage.showMessage(f"Dry run failed: {e}")
+            errorMessage.exec_()
+            return None
+        self.plot_dosing_preview()
+        self.update_generic()
+        return self.dosingPreview
+
+    # The preview starts at the newest sample, as if the process was started now
+    def plot_dosing_preview(self):
+        if self.dosingPreview is None:
+            return
+        secondsPerSample = float(self.intervalEdit.text()) * self.interval_unit()
+        self.graph.addItem(pyqtgraph.PlotDataItem(len(self.samplesPV) - 1 + self.dosingPreview.times / secondsPerSample,
+                                                  self.dosingPreview.flows, autoDownsample=True,
+                                                  pen=pyqtgraph.mkPen((0, 127, 255), width=1.25, style=Qt.DashLine)))
+
     def update_dosing_state(self):
         if self.dosingControlButton.isChecked():
-            self.dosingValuesEdit.setEnabled(False)
-            self.dosingValuesEdit.setStyleSheet("color: grey")
-            self.dosingTimesEdit.setEnabled(False)
-            self.dosingTimesEdit.setStyleSheet("color: grey")
-            self.dosingControlButton.setText("Disable dosing")
-            self.setpointEdit.setEnabled(False)
-            self.dosingEnabled = True
-            self.dosingSignal.emit(True)
-            # Set VOR to normal for dosing
-            self.vorNormalButton.setChecked(True)
-            self.update_vor_normal()
-            self.dosing_process()
+            self.start_dosing_process()
         else:
             self.dosingValuesEdit.setEnabled(True)
             self.dosingValuesEdit.setStyleSheet(self.defaultStyleSheet)
             self.dosingTimesEdit.setEnabled(True)
             self.dosingTimesEdit.setStyleSheet(self.defaultStyleSheet)
+            self.dosingRampsEdit.setEnabled(not self.dosingVolumeCheckbox.isChecked())
+            self.dosingRampsEdit.setStyleSheet(self.defaultStyleSheet)
+            self.dosingRateEdit.setEnabled(not self.dosingVolumeCheckbox.isChecked())
+            self.dosingRateEdit.setStyleSheet(self.defaultStyleSheet)
             self.dosingControlButton.setText("Enable dosing")
             self.setpointEdit.setEnabled(True)
             self.dosingEnabled = False
             self.end_dosing_process()
 
-    # This function sets the setpoint to those values that were set when "Enable dosing" was pressed
-    # and iterates over them
-    def dosing_process(self):
-        self.spValue = self.dosingValues.pop()
-        spTime = self.dosingTimes.pop()
-
+    # Start setting the setpoints that were set when "Enable dosing" was pressed, at their scheduled times.
+    # A coordinated process is only prepared here, it is started together with other channels by a DosingCoordinator.
+    # The process is created before anything else is changed, returns False if it was not valid
+    def start_dosing_process(self, coordinated=False):
+        try:
+            if self.dosingVolumeCheckbox.isChecked():
+                # Volume steps can not be put on a common timeline, they are always started right away
+                scheduler = VolumeDoser(self.controller, self.dosingValues, self.dosingVolumes)
+                coordinated = False
+            elif self.dosingProfile is not None:
+                scheduler = DosingScheduler(self.controller, self.dosingProfile.values, self.dosingProfile.durations,
+                                            self.dosingProfile.ramp_names(), self.dosingRate)
+            else:
+                scheduler = DosingScheduler(self.controller, self.dosingValues, self.dosingTimes, self.dosingRamps,
+                                            self.dosingRate)
+        except ValueError as e:
+            self.dosingControlButton.setChecked(False)
+            errorMessage = QErrorMessage(self)
+            errorMessage.setWindowIcon(QIcon(':/icon.png'))
+            errorMessage.setWindowTitle("Error")
+            errorMessage.showMessage(f"Dosing was not started: {e}")
+            errorMessage.exec_()
+            return False
+
+        self.dosingControlButton.setChecked(True)
+        self.dosingValuesEdit.setEnabled(False)
+        self.dosingValuesEdit.setStyleSheet("color: grey")
+        self.dosingTimesEdit.setEnabled(False)
+        self.dosingTimesEdit.setStyleSheet("color: grey")
+        self.dosingRampsEdit.setEnabled(False)
+        self.dosingRampsEdit.setStyleSheet("color: grey")
+        self.dosingRateEdit.setEnabled(False)
+        self.dosingRateEdit.setStyleSheet("color: grey")
+        self.dosingProfileButton.setEnabled(False)
+        self.dosingVolumeCheckbox.setEnabled(False)
+        self.dosingDryRunButton.setEnabled(False)
+        self.dosingPreview = None
+        self.dosingControlButton.setText("Disable dosing")
+        self.setpointEdit.setEnabled(False)
+        self.dosingEnabled = True
+        self.dosingSignal.emit(True)
+        # Set VOR to normal for dosing
+        self.vorNormalButton.setChecked(True)
+        self.update_vor_normal()
+        # A setpoint typed in before and not sent yet must not be written over the first dosing value.
+        # One already in flight holds the bus, the dosing writes queue behind it
+        self.controllerWriter.cancel("setpoint")
+
+        self.dosingScheduler = scheduler
+        self.dosingScheduler.setpointWritten.connect(self.dosing_setpoint_written)
+        self.dosingScheduler.finished.connect(self.end_dosing_process)
+        if not coordinated:
+            self.dosingScheduler.start()
+        return True
+
+    def dosing_setpoint_written(self, step, value):
+        if value != self.setpoint:
+            self.boost_polling()
+        self.spValue = value
+        self.setpoint = value
+        self.confirmedTexts["setpoint"] = str(value)
         self.setpointEdit.setText(f"{str(self.spValue)} - dosing is enabled")
-        self.controller.set_setpoint(self.spValue)
-
-        if len(self.dosingTimes) == 0:
-            self.dosingTimer.timeout.disconnect()
-            self.dosingTimer.singleShot(spTime, self.end_dosing_process)
-
-        self.dosingTimer.setInterval(spTime)
-        self.dosingTimer.start()
 
     def update_generic(self):
-        if self.dosingTimer.isActive() and len(self.dosingValues) > 0:
-            if self.dosingTimer.remainingTime() / 1000 > 60:
-                self.dosingLabel.setText(
-                    f"{int(self.dosingTimer.remainingTime() / (1000 * 60))} minutes {int(self.dosingTimer.remainingTime() / 1000) % 60} seconds until next dosing value: {self.dosingValues[-1]}")
+        if isinstance(self.dosingScheduler, VolumeDoser) and self.dosingScheduler.is_running():
+            delivered, volume, nextValue = self.dosingScheduler.progress()
+            units = self.measureUnitsDropdown.currentText()
+            if nextValue is None:
+                self.dosingLabel.setText(f"{delivered:.2f}/{volume} {units} delivered until end of process")
             else:
+                self.dosingLabel.setText(f"{delivered:.2f}/{volume} {units} delivered until next dosing value: "
+                                         f"{nextValue}")
+        elif self.dosingScheduler is not None and self.dosingScheduler.is_running():
+            remaining, nextValue = self.dosingScheduler.time_to_next_step()
+            if nextValue is None:
+                self.dosingLabel.setText(f"{int(remaining)} seconds until end of process")
+            elif remaining > 60:
                 self.dosingLabel.setText(
-                    f"{int(self.dosingTimer.remainingTime() / 1000)} seconds until next dosing value: {self.dosingValues[-1]}")
-        elif self.dosingTimer.isActive() and len(self.dosingValues) == 0:
-            self.dosingLabel.setText(f"{int(self.dosingTimer.remainingTime() / 1000)} seconds until end of process")
-        else:
-            self.dosingLabel.setText("Dosing disabled")
-
-        if self.temperatureController is not None:
-            self.tempReadoutLabel.setText(f"Readout: {self.temperatureController.read_temperature()} ℃")
+                    f"{int(remaining / 60)} minutes {int(remaining) % 60} seconds until next dosing value: {nextValue}")
+            else:
+                self.dosingLabel.setText(f"{int(remaining)} seconds until next dosing value: {nextValue}")
+        elif self.dosingScheduler is None:
+            self.dosingLabel.setText(self.dosing_disabled_text())
+
+        # The controller is read by its polling thread, only the newest reading is shown here
+        if self.temperaturePoller is not None and self.temperaturePoller.latest is not None:
+            self.tempReadoutLabel.setText(f"Readout: {self.temperaturePoller.latest[1]['probe']:.1f} ℃")
+            self.tempReadoutLabel.setToolTip(f"Writes: {self.temperatureController.writes}, "
+                                             f"skipped: {self.temperatureController.skippedWrites}, "
+                                             f"read-back mismatches: {self.temperatureController.verifyMismatches}")
         else:
             self.tempReadoutLabel.setText("Readout: None ℃")
 
+    def dosing_disabled_text(self):
+        if self.dosingPreview is not None:
+            return f"Dry run: {self.dosingPreview.description()}"
+        if self.dosingProfile is not None:
+            return f"Dosing disabled, profile {self.dosingProfile.description()}"
+        if self.dosingSummary is not None:
+            return f"Dosing disabled, last process: {self.dosingSummary}"
+        return "Dosing disabled"
+
     def end_dosing_process(self):
         self.dosingControlButton.setChecked(False)
         self.dosingControlButton.setText("Enable dosing")
-        self.dosingLabel.setText("Dosing disabled")
-        self.dosingTimer.stop()
 
-        # Since all the values have been popped and the text is unchanged, we fill the vectors again
-        self.dosingValues = [float(x) for x in self.dosingValuesEdit.text().split(sep=',') if x.strip() != '']
-        self.dosingTimes = [float(x) * 60 * 1000 for x in self.dosingTimesEdit.text().split(sep=',') if x.strip() != '']
-        self.dosingValues.reverse()
-        self.dosingTimes.reverse()
+        # Keep the timing of the finished process, it is logged and shown until the next one
+        if self.dosingScheduler is not None:
+            self.dosingScheduler.stop()
+            self.dosingSummary = self.dosingScheduler.summary()
+            print(f"Dosing {self.controller.channel}: {self.dosingSummary}")
+            if self.csvFile is not None:
+                self.csvFile.write('\n')
+                self.dosingScheduler.write_record(self.csvFile)
+                self.csvFile.write('\n')
+            self.dosingScheduler = None
+            self.dosingLabel.setToolTip(f"Last process: {self.dosingSummary}")
+        self.dosingLabel.setText(self.dosing_disabled_text())
 
         # Remove the string portion from setpoint field
         self.setpointEdit.setText(str(self.spValue))
@@ -424,16 +873,22 @@ class ControllerGUITab(QWidget):
         self.setpointEdit.setEnabled(True)
         self.dosingValuesEdit.setEnabled(True)
         self.dosingTimesEdit.setEnabled(True)
+        self.dosingRampsEdit.setEnabled(not self.dosingVolumeCheckbox.isChecked())
+        self.dosingRateEdit.setEnabled(not self.dosingVolumeCheckbox.isChecked())
+        self.dosingProfileButton.setEnabled(not self.dosingVolumeCheckbox.isChecked())
+        self.dosingVolumeCheckbox.setEnabled(True)
+        self.dosingDryRunButton.setEnabled(True)
 
         # Return to normal stylesheet
         self.dosingValuesEdit.setStyleSheet(self.defaultStyleSheet)
         self.dosingTimesEdit.setStyleSheet(self.defaultStyleSheet)
+        self.dosingRampsEdit.setStyleSheet(self.defaultStyleSheet)
+        self.dosingRateEdit.setStyleSheet(self.defaultStyleSheet)
 
-        # reconnect the dosing_process function to the timer
-        self.dosingTimer.timeout.connect(self.dosing_process)
-
-        # Set the setpoint to 0 and close valve at the end
-        self.controller.set_setpoint(0)
+        # Set the setpoint to 0 and close valve at the end.
+        # Written through the coalescer, so it replaces any setpoint still pending there instead of racing it
+        self.controllerWriter.submit("setpoint", self.controller.set_setpoint, 0.0,
+                                     self.echoes(0.0, 10 ** -self.controller.decimalPoint))
         self.setpointEdit.setText("0")
 
         self.vorClosedButton.setChecked(True)
@@ -441,12 +896,86 @@ class ControllerGUITab(QWidget):
         self.update_vor_closed()
 
     def update_plot(self):
+        acquired = self.get_measurement()
+        self.adapt_polling_interval()
+        self.redraw_plot()
+        if self.csvFile is not None and acquired:
+            self.append_to_csv()
+
+    def redraw_plot(self):
         self.graph.clear()
-        self.get_measurement()
         self.graph.plot(self.samplesPV, pen=pyqtgraph.mkPen((255, 127, 0), width=1.25), symbolBrush=(255, 127, 0),
                         symbolPen=pyqtgraph.mkPen((255, 127, 0)), symbol='o', symbolSize=5, name="symbol ='o'")
+        self.plot_dosing_preview()
+        self.temperatureViewBox.clear()
+        if self.temperaturePoller is not None:
+            self.temperatureViewBox.addItem(pyqtgraph.PlotDataItem(np.array(self.samplesTemperature),
+                                                                   pen=pyqtgraph.mkPen((255, 32, 0), width=1.25),
+                                                                   connect='finite'))
+
+    def update_high_rate_mode(self):
+        highRate = self.highRateCheckbox.isChecked()
+        if highRate == (self.poller is not None):
+            return
+        # The sensors keep their rate, only the units of their intervals change
+        sensorIntervals = [float(edit.text()) * self.interval_unit()
+                           for edit in [self.sensor1SampleIntervalEdit, self.sensor2SampleIntervalEdit]]
+
+        if highRate:
+            self.lowRateInterval = self.intervalEdit.text()
+            self.graphTimer.stop()
+            self.poller = ControllerPoller(self.controller, self.HIGH_RATE_INTERVAL / 1000)
+            self.pollerErrors = 0
+            self.pollerLate = 0
+            self.intervalEdit.setText(str(self.HIGH_RATE_INTERVAL))
+            self.renderTimer.start(self.RENDER_INTERVAL)
+        else:
+            self.poller.close()
+            self.render_samples()
+            self.renderTimer.stop()
+            self.poller = None
+            self.intervalEdit.setText(self.lowRateInterval)
+            self.graphTimer.start(int(60 * 1000 * float(self.lowRateInterval)))
+
+        units = "ms" if highRate else "minutes"
+        for edit, interval in zip([self.sensor1SampleIntervalEdit, self.sensor2SampleIntervalEdit], sensorIntervals):
+            edit.setText(f"{interval / self.interval_unit():g}")
+        for label in [self.intervalUnitsLabel, self.sensor1IntervalUnitsLabel, self.sensor2IntervalUnitsLabel]:
+            label.setText(units)
+        # The baseline of adaptive polling follows the mode
+        self.update_graph_timer()
+
+    # Take the readings of the high-rate poller into the buffers, then draw and log them at once
+    def render_samples(self):
+        readings = self.poller.drain()
+        self.droppedPolls += self.poller.errors - self.pollerErrors
+        self.latePolls += self.poller.late - self.pollerLate
+        self.pollerErrors = self.poller.errors
+        self.pollerLate = self.poller.late
+        if self.pollingPolicy is not None:
+            for timestamp, current, total, pollTime in readings:
+                self.pollingPolicy.observe(pollTime, float(current))
+        self.adapt_polling_interval()
+        if len(readings) == 0:
+            return
+
+        self.samplesAcquired += len(readings)
+        latest = readings[-self.sampleBufferSize:]
+        pvs = np.array([current for timestamp, current, total, pollTime in latest], dtype=np.float16)
+        self.lastPV = float(pvs[-1])
+        self.samplesPV.extend(pvs)
+        self.samplesTotalizer.extend(np.array([total for timestamp, current, total, pollTime in latest], dtype=np.float32))
+        self.sampleTimestamps.extend(np.array([timestamp for timestamp, current, total, pollTime in latest], dtype=object))
+        if self.temperaturePoller is not None and self.temperaturePoller.latest is not None:
+            self.samplesTemperature.extend(np.full(len(latest), self.temperaturePoller.latest[1]['probe'],
+                                                   dtype=np.float32))
+        else:
+            self.samplesTemperature.extend(np.full(len(latest), np.nan, dtype=np.float32))
+
+        self.redraw_plot()
         if self.csvFile is not None:
-            self.append_to_csv()
+            self.append_batch_to_csv(readings)
+        self.sampleBatchReady.emit(self.controller.channel, pvs)
 
     def update_sensor1_group(self):
         if self.sensor1Group.isChecked():
@@ -459,25 +988,39 @@ class ControllerGUITab(QWidget):
             self.sensor1.close()
             self.sensor1Timer.stop()
             self.sensor1 = None
+            self.sensor1StatusLabel.setText("Not connected")
 
     # connect to sensor instance 1 using values returned by the dialog
+    # the sensor polls itself from its reader thread, the timer only watches its state from the GUI side
     def connect_sensor1(self, values):
-        self.sensor1 = Sensor(comport=values['port'],
-                              baudrate=values['baudrate'],
-                              databits=values['databits'],
-                              parity=values['paritybits'],
-                              stopbits=values['stopbits'],
-                              dataHeader=values['header'])
-        self.sensor1Timer = QTimer()
-        self.sensor1Timer.setInterval(float(self.sensor1SampleIntervalEdit.text()) * 1000 * 60)
-        self.sensor1Timer.timeout.connect(self.sensor1_get_data)
+        try:
+            self.sensor1 = Sensor(comport=values['port'],
+                                  baudrate=values['baudrate'],
+                                  databits=values['databits'],
+                                  parity=values['paritybits'],
+                                  stopbits=values['stopbits'],
+                                  dataHeader=values['header'],
+                                  interval=float(self.sensor1SampleIntervalEdit.text()) * self.interval_unit(),
+                                  streaming=values['streaming'],
+                                  parser=values['parser'])
+        except (ValueError, SerialException) as e:
+            dg = QErrorMessage()
+            dg.setWindowIcon(QIcon(':/icon.png'))
+            dg.setWindowTitle("Sensor 1 Exception")
+            dg.showMessage(f"Could not create sensor 1: {e}")
+            dg.exec_()
+            self.sensor1Group.setChecked(False)
+            return
+        self.sensor1Timer = ScheduledTimer(ScheduledTimer.PRIORITY_DISPLAY)
+        self.sensor1Timer.setInterval(1000)
+        self.sensor1Timer.timeout.connect(self.sensor1_check_status)
         self.sensor1Timer.start()
 
-    # Wrapper function to handle exceptions from GUI level
-    def sensor1_get_data(self):
-        try:
-            self.sensor1.getData()
-        except SerialException as se:
+    # Wrapper function to handle exceptions of the reader thread from GUI level
+    def sensor1_check_status(self):
+        self.sensor1StatusLabel.setText(self.sensor_status(self.sensor1))
+        se = self.sensor1.error
+        if se is not None:
             dg = QErrorMessage()
             dg.setWindowIcon(QIcon(':/icon.png'))
             dg.setWindowTitle("Sensor 1 Exception")
@@ -486,8 +1029,8 @@ class ControllerGUITab(QWidget):
             dumpFile = open(filename, 'w')
 
             dumpFile.write(f"Sensor 1 header: {self.sensor1.header}\n")
-            for i in range(0, len(self.sensor1.buffer)):
-                self.csvFile.write(str(self.sensor1.buffer[i]))
+            for timestamp, line in self.sensor1.drain():
+                dumpFile.write(f"{timestamp.strftime('%Y/%m/%d,%H:%M:%S.%f')},{line}\n")
             dumpFile.close()
 
             self.sensor1Group.setChecked(False)
@@ -495,6 +1038,22 @@ class ControllerGUITab(QWidget):
             dg.showMessage(f"Sensor 1 has encountered an exception: {se}")
             dg.exec_()
 
+    # Short summary of the reader thread statistics of a sensor
+    @staticmethod
+    def sensor_status(sensor: Sensor):
+        if sensor.streaming:
+            status = f"Streaming, lines received: {sensor.received}"
+        else:
+            latency = sensor.mean_latency()
+            latency = "?" if latency is None else f"{latency * 1000:.0f}"
+            status = f"Requests: {sensor.requests}, timeouts: {sensor.timeouts}, latency: {latency} ms"
+
+        timestamps, columns = sensor.get_columns()
+        if timestamps is not None and len(timestamps) > 0:
+            status += "\n" + ", ".join(f"{name}: {values[-1]:g}" for name, values in columns.items())
+            status += f" (parse errors: {sensor.parseErrors})"
+        return status
+
     def update_sensor2_group(self):
         if self.sensor2Group.isChecked():
             dg = SensorConfigDialog()
@@ -506,25 +1065,39 @@ class ControllerGUITab(QWidget):
             self.sensor2.close()
             self.sensor2Timer.stop()
             self.sensor2 = None
+            self.sensor2StatusLabel.setText("Not connected")
 
     # connect to sensor instance 2 using values returned by the dialog
+    # the sensor polls itself from its reader thread, the timer only watches its state from the GUI side
     def connect_sensor2(self, values):
-        self.sensor2 = Sensor(comport=values['port'],
-                              baudrate=values['baudrate'],
-                              databits=values['databits'],
-                              parity=values['paritybits'],
-                              stopbits=values['stopbits'],
-                              dataHeader=values['header'])
-        self.sensor2Timer = QTimer()
-        self.sensor2Timer.setInterval(float(self.sensor2SampleIntervalEdit.text()) * 1000 * 60)
-        self.sensor2Timer.timeout.connect(self.sensor2_get_data)
+        try:
+            self.sensor2 = Sensor(comport=values['port'],
+                                  baudrate=values['baudrate'],
+                                  databits=values['databits'],
+                                  parity=values['paritybits'],
+                                  stopbits=values['stopbits'],
+                                  dataHeader=values['header'],
+                                  interval=float(self.sensor2SampleIntervalEdit.text()) * self.interval_unit(),
+                                  streaming=values['streaming'],
+                                  parser=values['parser'])
+        except (ValueError, SerialException) as e:
+            dg = QErrorMessage()
+            dg.setWindowIcon(QIcon(':/icon.png'))
+            dg.setWindowTitle("Sensor 2 Exception")
+            dg.showMessage(f"Could not create sensor 2: {e}")
+            dg.exec_()
+            self.sensor2Group.setChecked(False)
+            return
+        self.sensor2Timer = ScheduledTimer(ScheduledTimer.PRIORITY_DISPLAY)
+        self.sensor2Timer.setInterval(1000)
+        self.sensor2Timer.timeout.connect(self.sensor2_check_status)
         self.sensor2Timer.start()
 
-    # Wrapper function to handle exceptions from GUI level
-    def sensor2_get_data(self):
-        try:
-            self.sensor2.getData()
-        except SerialException as se:
+    # Wrapper function to handle exceptions of the reader thread from GUI level
+    def sensor2_check_status(self):
+        self.sensor2StatusLabel.setText(self.sensor_status(self.sensor2))
+        se = self.sensor2.error
+        if se is not None:
             dg = QErrorMessage()
             dg.setWindowIcon(QIcon(':/icon.png'))
             dg.setWindowTitle("Sensor 2 Exception")
@@ -533,8 +1106,8 @@ class ControllerGUITab(QWidget):
             dumpFile = open(filename, 'w')
 
             dumpFile.write(f"Sensor 2 header: {self.sensor2.header}\n")
-            for i in range(0, len(self.sensor2.buffer)):
-                self.csvFile.write(str(self.sensor2.buffer[i]))
+            for timestamp, line in self.sensor2.drain():
+                dumpFile.write(f"{timestamp.strftime('%Y/%m/%d,%H:%M:%S.%f')},{line}\n")
             dumpFile.close()
 
             self.sensor2Group.setChecked(False)
@@ -550,12 +1123,33 @@ class ControllerGUITab(QWidget):
             if dg.exec_() == 0:
                 self.tempControllerGroup.setChecked(False)
         else:
+            if self.temperaturePoller is not None:
+                self.temperaturePoller.close()
+                self.temperaturePoller = None
+            if self.temperatureWriter is not None:
+                self.temperatureWriter.close()
+                self.temperatureWriter = None
+            if self.temperatureController is not None:
+                self.temperatureController.serial.close()
             self.temperatureController = None
             self.tempControlButton.setText("Enable output")
+            self.graph.getPlotItem().hideAxis('right')
 
-    # Connect to the AR6X2 controller using given parameters
+    # Connect to the AR6X2 controller using given parameters, it is polled in the background from then on
     def connect_temp_controller(self, values):
-        self.temperatureController = AR6X2(port=values['port'], address=values['address'])
+        try:
+            self.temperatureController = AR6X2(port=values['port'], address=values['address'])
+        except SerialException as e:
+            dg = QErrorMessage()
+            dg.setWindowIcon(QIcon(':/icon.png'))
+            dg.setWindowTitle("Temperature controller Exception")
+            dg.showMessage(f"Could not connect to the temperature controller: {e}")
+            dg.exec_()
+            self.tempControllerGroup.setChecked(False)
+            return
+        self.temperaturePoller = AR6X2Poller(self.temperatureController)
+        self.temperatureWriter = WriteCoalescer(f"AR6X2 {values['port']}")
+        self.graph.getPlotItem().showAxis('right')
 
     def create_left_column(self):
         # Create a vertical layout for the left column
@@ -694,9 +1288,20 @@ class ControllerGUITab(QWidget):
         self.intervalEdit.setValidator(QRegExpValidator(QRegExp("[0-9]*(|\\.[0-9]*)")))
         self.intervalEdit.editingFinished.connect(self.update_graph_timer)
 
+        self.intervalUnitsLabel = QLabel("minutes")
+        self.highRateCheckbox = QCheckBox("High rate")
+        self.highRateCheckbox.setToolTip("Poll the controller from a separate thread, with intervals in milliseconds")
+        self.highRateCheckbox.stateChanged.connect(self.update_high_rate_mode)
+        self.adaptiveCheckbox = QCheckBox("Adaptive")
+        self.adaptiveCheckbox.setToolTip("Poll faster after setpoint changes and fast PV changes, "
+                                         "within the bus load ceiling set in the diagnostics tab")
+        self.adaptiveCheckbox.stateChanged.connect(self.update_adaptive_polling)
+
         layout.addWidget(QLabel("Data update interval"))
         layout.addWidget(self.intervalEdit)
-        layout.addWidget(QLabel("minutes"))
+        layout.addWidget(self.intervalUnitsLabel)
+        layout.addWidget(self.highRateCheckbox)
+        layout.addWidget(self.adaptiveCheckbox)
 
         runtimeLayout.addLayout(layout)
 
@@ -758,8 +1363,9 @@ class ControllerGUITab(QWidget):
         label = QLabel('Sampling interval')
         label.setFixedWidth(90)
         layout.addWidget(label)
+        self.sensor1IntervalUnitsLabel = QLabel('minutes')
         layout.addWidget(self.sensor1SampleIntervalEdit)
-        layout.addWidget(QLabel('minutes'))
+        layout.addWidget(self.sensor1IntervalUnitsLabel)
         layout.setStretch(2, 10)
         sensor1Layout.addLayout(layout)
 
@@ -778,6 +1384,9 @@ class ControllerGUITab(QWidget):
         layout.addWidget(QLabel('samples'))
         layout.setStretch(2, 10)
         sensor1Layout.addLayout(layout)
+
+        self.sensor1StatusLabel = QLabel("Not connected")
+        sensor1Layout.addWidget(self.sensor1StatusLabel)
         self.sensor1Group.setLayout(sensor1Layout)
 
         # Creation of sensor 2 and sub-elements
@@ -798,8 +1407,9 @@ class ControllerGUITab(QWidget):
         label = QLabel('Sampling interval')
         label.setFixedWidth(90)
         layout.addWidget(label)
+        self.sensor2IntervalUnitsLabel = QLabel('minutes')
         layout.addWidget(self.sensor2SampleIntervalEdit)
-        layout.addWidget(QLabel('minutes'))
+        layout.addWidget(self.sensor2IntervalUnitsLabel)
         layout.setStretch(2, 10)
         sensor2Layout.addLayout(layout)
 
@@ -818,6 +1428,9 @@ class ControllerGUITab(QWidget):
         layout.addWidget(QLabel('samples'))
         layout.setStretch(2, 10)
         sensor2Layout.addLayout(layout)
+
+        self.sensor2StatusLabel = QLabel("Not connected")
+        sensor2Layout.addWidget(self.sensor2StatusLabel)
         self.sensor2Group.setLayout(sensor2Layout)
 
         self.tempControllerGroup = QGroupBox("Temperature controller")
@@ -836,6 +1449,11 @@ class ControllerGUITab(QWidget):
         self.temperatureSlider.setMaximum(850.0)
         self.temperatureSlider.setValue(100)
         self.temperatureSlider.sliderMoved.connect(self.update_temperature)
+        self.temperatureSlider.sliderReleased.connect(self.write_temperature)
+        self.temperatureWriteTimer = ScheduledTimer(ScheduledTimer.PRIORITY_IO)
+        self.temperatureWriteTimer.setSingleShot(True)
+        self.temperatureWriteTimer.setInterval(250)
+        self.temperatureWriteTimer.timeout.connect(self.write_temperature)
         self.temperatureLabel = QLabel("100")
         layout.addWidget(QLabel("Temperature"), alignment=Qt.AlignLeft)
         layout.addWidget(self.temperatureSlider, alignment=Qt.AlignLeft)
@@ -918,12 +1536,19 @@ class ControllerGUITab(QWidget):
         self.dosingTimesEdit.setValidator(QRegExpValidator(QRegExp("(([0-9]+|[0-9]+\\.[0-9]+),(| ))+")))
         self.dosingTimesEdit.textChanged.connect(self.update_dosing_vectors)
 
-        label = QLabel("Times")
-        label.setFixedWidth(55)
+        self.dosingTimesLabel = QLabel("Times")
+        self.dosingTimesLabel.setFixedWidth(55)
+        self.dosingTimesUnitsLabel = QLabel("minutes")
 
-        layout.addWidget(label)
+        self.dosingVolumeCheckbox = QCheckBox("Volumes")
+        self.dosingVolumeCheckbox.setToolTip("Give the volume of every step instead of its time, "
+                                             "the step ends once the totalizer has counted it")
+        self.dosingVolumeCheckbox.stateChanged.connect(self.update_dosing_volume_mode)
+
+        layout.addWidget(self.dosingTimesLabel)
         layout.addWidget(self.dosingTimesEdit)
-        layout.addWidget(QLabel("minutes"))
+        layout.addWidget(self.dosingTimesUnitsLabel)
+        layout.addWidget(self.dosingVolumeCheckbox)
         dosingLayout.addLayout(layout)
 
         layout = QHBoxLayout()
@@ -943,6 +1568,29 @@ class ControllerGUITab(QWidget):
         layout.addWidget(self.dosingUnitsLabel)
         dosingLayout.addLayout(layout)
 
+        # Ramp from each setpoint to the next one during the step, the setpoint is updated at the given rate
+        layout = QHBoxLayout()
+        self.dosingRampsEdit = QLineEdit()
+        self.dosingRampsEdit.setMinimumWidth(100)
+        self.dosingRampsEdit.setPlaceholderText("step, linear, exp, cubic")
+        self.dosingRampsEdit.setValidator(QRegExpValidator(QRegExp("(([a-z]+),(| ))*[a-z]*")))
+        self.dosingRampsEdit.textChanged.connect(self.update_dosing_vectors)
+
+        self.dosingRateEdit = QLineEdit()
+        self.dosingRateEdit.setMaximumWidth(40)
+        self.dosingRateEdit.setText("5")
+        self.dosingRateEdit.setValidator(QRegExpValidator(QRegExp("[0-9]{1,2}(|\\.[0-9]{1,2})")))
+        self.dosingRateEdit.textChanged.connect(self.update_dosing_validity)
+
+        label = QLabel("Ramps")
+        label.setFixedWidth(55)
+
+        layout.addWidget(label)
+        layout.addWidget(self.dosingRampsEdit)
+        layout.addWidget(self.dosingRateEdit)
+        layout.addWidget(QLabel("Hz"))
+        dosingLayout.addLayout(layout)
+
         self.dosingLabel = QLabel("Dosing disabled")
 
         self.dosingVorStateLabel = QLabel(f"VOR is {self.controller.get_valve_override().lower()}")
@@ -956,17 +1604,27 @@ class ControllerGUITab(QWidget):
         self.dosingControlButton.setCheckable(True)
         self.dosingControlButton.clicked.connect(self.update_dosing_state)
 
+        self.dosingProfileButton = QPushButton("Load profile")
+        self.dosingProfileButton.clicked.connect(self.load_dosing_profile)
+
+        self.dosingDryRunButton = QPushButton("Dry run")
+        self.dosingDryRunButton.setToolTip("Draw the expected flow of the dosing process over the graph")
+        self.dosingDryRunButton.clicked.connect(self.dry_run_dosing)
+
         dosingLayout.addWidget(self.dosingLabel, alignment=Qt.AlignLeft)
         layout = QHBoxLayout()
         layout.addWidget(self.dosingVorStateLabel, alignment=Qt.AlignLeft)
+        layout.addWidget(self.dosingDryRunButton, alignment=Qt.AlignRight)
+        layout.addWidget(self.dosingProfileButton, alignment=Qt.AlignRight)
         layout.addWidget(self.dosingControlButton, alignment=Qt.AlignRight)
+        layout.setStretch(0, 10)
 
         dosingLayout.addLayout(layout)
 
         # finally, assign the layout to the group
         dosingGroup.setLayout(dosingLayout)
         dosingGroup.setMinimumWidth(200)
-        dosingGroup.setFixedHeight(150)
+        dosingGroup.setFixedHeight(180)
 
         rightInnerGrid.addWidget(self.sensor1Group, 0, 0)
         rightInnerGrid.addWidget(self.sensor2Group, 0, 1)
@@ -981,6 +1639,17 @@ class ControllerGUITab(QWidget):
         if "qdarkstyle" in sys.modules:
             self.graph.setBackground((25, 35, 45))
 
+        # Probe temperature is drawn in its own view box with the right axis, sharing the x axis with PV
+        plotItem = self.graph.getPlotItem()
+        self.temperatureViewBox = ViewBox()
+        plotItem.scene().addItem(self.temperatureViewBox)
+        plotItem.getAxis('right').linkToView(self.temperatureViewBox)
+        plotItem.getAxis('right').setLabel("Temperature", units="℃")
+        plotItem.hideAxis('right')
+        self.temperatureViewBox.setXLink(plotItem)
+        plotItem.vb.sigResized.connect(
+            lambda: self.temperatureViewBox.setGeometry(plotItem.vb.sceneBoundingRect()))
+
         rightColumnLayout.addWidget(self.graph)
         rightColumnLayout.addLayout(rightInnerGrid)
 
@@ -992,23 +1661,29 @@ class ControllerGUITab(QWidget):
             newBufPV = RingBuffer(capacity=value, dtype=np.float16)
             newBufTotal = RingBuffer(capacity=value, dtype=np.float32)
             newTimestampBuf = RingBuffer(capacity=value, dtype=datetime)
+            newBufTemperature = RingBuffer(capacity=value, dtype=np.float32)
 
             newBufPV.extend(self.samplesPV)
             newBufTotal.extend(self.samplesTotalizer)
             newTimestampBuf.extend(self.sampleTimestamps)
+            newBufTemperature.extend(self.samplesTemperature)
 
             self.samplesPV = newBufPV
             self.samplesTotalizer = newBufTotal
             self.sampleTimestamps = newTimestampBuf
+            self.samplesTemperature = newBufTemperature
         elif value < self.sampleBufferSize:
             newBufPV = RingBuffer(capacity=value, dtype=np.float16)
             newBufTotal = RingBuffer(capacity=value, dtype=np.float32)
             newTimestampBuf = RingBuffer(capacity=value, dtype=datetime)
+            newBufTemperature = RingBuffer(capacity=value, dtype=np.float32)
 
             newBufPV.extend(self.samplesPV[:-value])
             newBufTotal.extend(self.samplesTotalizer[:-value])
             newTimestampBuf.extend(self.sampleTimestamps[:-value])
+            newBufTemperature.extend(self.samplesTemperature[:-value])
 
             self.samplesPV = newBufPV
             self.samplesTotalizer = newBufTotal
             self.sampleTimestamps = newTimestampBuf
+            self.samplesTemperature = newBufTemperature
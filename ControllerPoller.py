@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import deque
+import pyvisa
+from Controller import Controller
+
+
+# Reads the measurements of a controller every `interval` seconds in a dedicated thread, for sampling rates
+# the GUI thread could not keep up with. Deadlines are counted from the first poll, so the rate does not drift
+# with the query time; a poll that comes more than half an interval late is counted as late, and polls missed
+# entirely (the bus being too slow for the interval) are skipped instead of sent in a burst.
+# Every successful poll is stored in `readings` as a (timestamp, PV, totalizer, poll time) tuple,
+# the poll time is the monotonic time the query was sent, the time base of the GUI's own polls
+class ControllerPoller:
+    def __init__(self, controller: Controller, interval=0.1, bufferSize=65536):
+        self.controller = controller
+        self.interval = interval
+        self.readings = deque(maxlen=bufferSize)
+
+        # Statistics, written only by the polling thread
+        self.polls = 0
+        self.errors = 0
+        self.late = 0
+        self.skipped = 0
+        self.lastError = None
+        self.lastLatency = None
+
+        self.__stopEvent = threading.Event()
+        self.__wakeEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"Controller poller {controller.channel}",
+                                         daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        self.__stopEvent.set()
+        self.__wakeEvent.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    # Change the polling interval (in seconds), takes effect immediately
+    def set_interval(self, value):
+        self.interval = value
+        self.__wakeEvent.set()
+
+    # Remove and return all readings gathered since the last call
+    def drain(self):
+        readings = []
+        try:
+            while True:
+                readings.append(self.readings.popleft())
+        except IndexError:
+            return readings
+
+    def __run(self):
+        deadline = time.monotonic()
+        interval = self.interval
+        while not self.__stopEvent.is_set():
+            if self.interval != interval:
+                # Restart the timeline from the change, so the new interval is not measured from the old deadlines
+                interval = self.interval
+                deadline = time.monotonic() + interval
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                self.__wakeEvent.wait(remaining)
+                self.__wakeEvent.clear()
+                continue
+
+            now = time.monotonic()
+            if now - deadline > interval / 2:
+                self.late += 1
+            missed = int((now - deadline) / interval)
+            self.skipped += missed
+            deadline += (missed + 1) * interval
+
+            self.polls += 1
+            try:
+                measurements = self.controller.get_measurements()
+            except (pyvisa.errors.VisaIOError, IndexError, ValueError) as e:
+                self.errors += 1
+                self.lastError = e
+                continue
+            self.lastLatency = time.monotonic() - now
+            if measurements is None:
+                self.errors += 1
+                continue
+            current, total, timestamp = measurements
+            self.readings.append((timestamp, current, total, now))
@@ -0,0 +1,68 @@
+import queue
+import threading
+
+
+# Bytes written by a series of CsvWriters, e.g. every file a tab rotates through, so the total never goes down
+# when a file is closed and the next one opened. Added to by the writer threads, the files can overlap
+class ByteCounter:
+    def __init__(self):
+        self.total = 0
+        self.__lock = threading.Lock()
+
+    def add(self, count):
+        with self.__lock:
+            self.total += count
+
+
+# Text file written by a background thread, so a slow disk never stalls the GUI.
+# write() only queues the text, the thread writes it in the order it was queued. The file API used by the tabs
+# (write, tell, name, close) is kept, tell() counts the characters queued so far.
+# close() waits until everything queued was written. Written bytes are also added to `counter` if given
+class CsvWriter:
+    def __init__(self, filename, counter: ByteCounter = None):
+        self.name = filename
+        self.counter = counter
+        self.__file = open(filename, 'w')
+        self.__queue = queue.SimpleQueue()
+        self.__queued = 0
+
+        # Statistics, written only by the writer thread
+        self.bytesWritten = 0
+        # Exception that stopped the writing, None while it works
+        self.error = None
+
+        self.__thread = threading.Thread(target=self.__run, name=f"CSV writer {filename}", daemon=True)
+        self.__thread.start()
+
+    def write(self, text):
+        self.__queued += len(text)
+        self.__queue.put(text)
+
+    def tell(self):
+        return self.__queued
+
+    # Number of writes waiting for the thread
+    def queue_depth(self):
+        return self.__queue.qsize()
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            text = self.__queue.get()
+            if text is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.__file.write(text)
+                written = len(text.encode())
+                self.bytesWritten += written
+                if self.counter is not None:
+                    self.counter.add(written)
+            except OSError as e:
+                print(f"Writing {self.name} failed, the following data is lost: {e}")
+                self.error = e
+        self.__file.close()
@@ -0,0 +1,146 @@
+import threading
+import time
+import numpy as np
+
+
+# Latency histogram with a fixed number of log-linear buckets (HDR style), so it takes the same memory
+# whether it holds ten samples or ten million. Latencies are counted in microseconds: below 2 ** SUB_BITS
+# every microsecond has its own bucket, above that every power of two is split into 2 ** (SUB_BITS - 1)
+# buckets, so a recorded value is off by at most 1 / 2 ** (SUB_BITS - 1) (about 3%).
+# Latencies above HIGHEST_US are counted in the last bucket, the exact maximum is kept separately
+class LatencyHistogram:
+    SUB_BITS = 6
+    HIGHEST_US = 2 ** 27
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = np.zeros(self.bucket_index(self.HIGHEST_US) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def bucket_index(microseconds):
+        magnitude = max(microseconds.bit_length() - LatencyHistogram.SUB_BITS, 0)
+        return magnitude * 2 ** (LatencyHistogram.SUB_BITS - 1) + (microseconds >> magnitude)
+
+    # Highest latency (in microseconds) counted in bucket `index`
+    @staticmethod
+    def bucket_limit(index):
+        half = 2 ** (LatencyHistogram.SUB_BITS - 1)
+        magnitude = max(index // half - 1, 0)
+        return ((index - magnitude * half + 1) << magnitude) - 1
+
+    # Add a latency in seconds
+    def record(self, seconds):
+        index = self.bucket_index(min(max(int(seconds * 1e6), 0), self.HIGHEST_US))
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def reset(self):
+        with self.lock:
+            self.buckets[:] = 0
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else None
+
+    # Latency in seconds that `percent` percent of the samples did not exceed, None if there are no samples.
+    # The lock only keeps recording threads apart, this works on a copy of the buckets taken without it,
+    # so reading never delays a recording thread
+    def percentile(self, percent):
+        cumulative = np.cumsum(self.buckets.copy())
+        count = int(cumulative[-1])
+        if count == 0:
+            return None
+        index = np.searchsorted(cumulative, max(int(np.ceil(count * percent / 100)), 1))
+        return min(self.bucket_limit(int(index)) / 1e6, self.max)
+
+
+# Latency histograms and outcome counters of every command sent on one bus (a serial port or a shared connection).
+# Busy time adds up the latencies of all exchanges, so the share of time the bus was in use follows from it.
+# A timeout is a command that got no (complete) response, an unexpected response is one that arrived
+# but could not be used, any other failure is an error.
+# Buses that queue their commands also record how long the commands waited for the bus, per priority
+class BusDiagnostics:
+    OK = 0
+    ERROR = 1
+    TIMEOUT = 2
+    UNEXPECTED = 3
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.outcomes = {}
+        # Priority name -> LatencyHistogram of the time commands waited for the bus
+        self.waits = {}
+        self.busyTime = 0.0
+        self.resetTime = time.monotonic()
+
+    # Record one exchange of `command`, given the monotonic time it was sent at
+    def record(self, command, start, outcome=OK):
+        latency = time.monotonic() - start
+        with self.lock:
+            if command not in self.histograms:
+                self.histograms[command] = LatencyHistogram()
+                self.outcomes[command] = np.zeros(4, dtype=np.int64)
+            histogram = self.histograms[command]
+            self.outcomes[command][outcome] += 1
+            self.busyTime += latency
+        histogram.record(latency)
+
+    # Histogram of the time commands of priority `priority` (a name) waited for the bus, created on first use
+    def wait_histogram(self, priority):
+        with self.lock:
+            if priority not in self.waits:
+                self.waits[priority] = LatencyHistogram()
+            return self.waits[priority]
+
+    def reset(self):
+        with self.lock:
+            for command in self.histograms:
+                self.histograms[command].reset()
+                self.outcomes[command][:] = 0
+            for histogram in self.waits.values():
+                histogram.reset()
+            self.busyTime = 0.0
+            self.resetTime = time.monotonic()
+
+    # List of (command, histogram, copy of the outcome counters), sorted by command.
+    # Taken without the lock: commands are only ever added, and copying the keys or an array
+    # is a single operation under the GIL
+    def snapshot(self):
+        return [(command, self.histograms[command], self.outcomes[command].copy())
+                for command in sorted(list(self.histograms))]
+
+    # List of (priority, wait histogram) in the order the histograms were created
+    def wait_snapshot(self):
+        return list(self.waits.items())
+
+    # Share of the time since the last reset the bus spent on exchanges
+    def utilization(self):
+        elapsed = time.monotonic() - self.resetTime
+        return min(self.busyTime / elapsed, 1.0) if elapsed > 0 else 0.0
+
+
+_buses = {}
+_busesLock = threading.Lock()
+
+
+# Diagnostics of the bus called `name`, created on first use. Reopening a device keeps adding to its bus
+def get_bus(name):
+    with _busesLock:
+        if name not in _buses:
+            _buses[name] = BusDiagnostics(name)
+        return _buses[name]
+
+
+# Taken without the lock, buses are only ever added
+def all_buses():
+    return [_buses[name] for name in sorted(list(_buses))]
@@ -0,0 +1,243 @@
+import time
+from datetime import datetime
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QIntValidator, QIcon
+from PyQt5.QtWidgets import (
+    QVBoxLayout, QHBoxLayout, QWidget, QGroupBox, QLabel, QPushButton, QTableWidget, QTableWidgetItem, QHeaderView,
+    QLineEdit, QErrorMessage, QFileDialog
+)
+from AdaptivePolling import get_budget
+from Diagnostics import LatencyHistogram, all_buses
+from MetricsServer import MetricsServer
+from Profiler import Profiler
+from Scheduler import ScheduledTimer
+import resources
+
+
+# Live view of the bus diagnostics: latency percentiles and outcome counters of every command sent so far,
+# and how busy every bus is.
+# The lag of the GUI event loop is measured with a timer firing every LAG_INTERVAL milliseconds,
+# and the metrics can be exported to Prometheus from a local HTTP endpoint (see MetricsServer).
+# The event loop profiler (see Profiler) is off by default, it slows down all Python code of the GUI thread.
+# The bus load ceiling of adaptive polling (see AdaptivePolling) is set here too
+class DiagnosticsTab(QWidget):
+    COLUMNS = ["Bus", "Command", "Count", "Mean", "p50", "p90", "p99", "p99.9", "Max", "Errors", "Timeouts",
+               "Unexpected"]
+    PERCENTILES = [50, 90, 99, 99.9]
+    LAG_INTERVAL = 100
+
+    def __init__(self, controllerTabs, sensorBridge=None):
+        super().__init__()
+        self.controllerTabs = controllerTabs
+        self.sensorBridge = sensorBridge
+        self.metricsServer = None
+        # The last profiler is kept after it is stopped, so its report can still be saved
+        self.profiler = None
+        self.guiLag = LatencyHistogram()
+        self.lastLagTick = None
+
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+
+        busGroup = QGroupBox("Bus utilization and GUI lag")
+        busGroupLayout = QVBoxLayout()
+        busGroup.setLayout(busGroupLayout)
+        busLayout = QHBoxLayout()
+        self.utilizationLabel = QLabel("No traffic yet")
+        self.resetButton = QPushButton("Reset")
+        self.resetButton.clicked.connect(self.reset)
+        busLayout.addWidget(self.utilizationLabel)
+        busLayout.addStretch()
+        busLayout.addWidget(self.resetButton)
+        busGroupLayout.addLayout(busLayout)
+        # Time the commands of each priority waited for a queued bus
+        self.waitLabel = QLabel("")
+        busGroupLayout.addWidget(self.waitLabel)
+        layout.addWidget(busGroup)
+
+        budgetGroup = QGroupBox("Adaptive polling")
+        budgetLayout = QHBoxLayout()
+        budgetGroup.setLayout(budgetLayout)
+        self.ceilingEdit = QLineEdit(str(int(100 * get_budget().ceiling)))
+        self.ceilingEdit.setValidator(QIntValidator(1, 100))
+        self.ceilingEdit.setMaximumWidth(80)
+        self.ceilingEdit.editingFinished.connect(self.update_ceiling)
+        self.budgetLabel = QLabel("No channel polls adaptively")
+        budgetLayout.addWidget(QLabel("Brooks bus load ceiling"))
+        budgetLayout.addWidget(self.ceilingEdit)
+        budgetLayout.addWidget(QLabel("%"))
+        budgetLayout.addWidget(self.budgetLabel)
+        budgetLayout.addStretch()
+        layout.addWidget(budgetGroup)
+
+        self.metricsGroup = QGroupBox("Prometheus metrics export")
+        self.metricsGroup.setCheckable(True)
+        self.metricsGroup.setChecked(False)
+        self.metricsGroup.toggled.connect(self.update_metrics_server)
+        metricsLayout = QHBoxLayout()
+        self.metricsGroup.setLayout(metricsLayout)
+        self.metricsPortEdit = QLineEdit(str(MetricsServer.DEFAULT_PORT))
+        self.metricsPortEdit.setValidator(QIntValidator(1, 65535))
+        self.metricsPortEdit.setMaximumWidth(80)
+        self.metricsLabel = QLabel("Not serving")
+        metricsLayout.addWidget(QLabel(f"Port on {MetricsServer.HOST}"))
+        metricsLayout.addWidget(self.metricsPortEdit)
+        metricsLayout.addWidget(self.metricsLabel)
+        metricsLayout.addStretch()
+        layout.addWidget(self.metricsGroup)
+
+        self.profilerGroup = QGroupBox("Event loop profiler")
+        self.profilerGroup.setCheckable(True)
+        self.profilerGroup.setChecked(False)
+        self.profilerGroup.toggled.connect(self.update_profiler)
+        profilerLayout = QHBoxLayout()
+        self.profilerGroup.setLayout(profilerLayout)
+        self.profilerLabel = QLabel("Not profiling")
+        self.profilerReportButton = QPushButton("Save report")
+        self.profilerReportButton.setEnabled(False)
+        self.profilerReportButton.clicked.connect(self.save_profiler_report)
+        profilerLayout.addWidget(self.profilerLabel)
+        profilerLayout.addStretch()
+        profilerLayout.addWidget(self.profilerReportButton)
+        layout.addWidget(self.profilerGroup)
+
+        commandGroup = QGroupBox("Command latency")
+        commandLayout = QVBoxLayout()
+        commandGroup.setLayout(commandLayout)
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        commandLayout.addWidget(self.table)
+        layout.addWidget(commandGroup)
+
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_BACKGROUND)
+        self.timer.timeout.connect(self.update_diagnostics)
+        self.timer.start(1000)
+
+        # A QTimer of its own, it measures the event loop and not the scheduler
+        self.lagTimer = QTimer()
+        self.lagTimer.timeout.connect(self.update_lag)
+        self.lagTimer.start(self.LAG_INTERVAL)
+
+    # The delay of this timer's events is the time the event loop was busy with something else
+    def update_lag(self):
+        now = time.monotonic()
+        if self.lastLagTick is not None:
+            self.guiLag.record(max(now - self.lastLagTick - self.LAG_INTERVAL / 1000, 0.0))
+        self.lastLagTick = now
+
+    def update_ceiling(self):
+        get_budget().set_ceiling(int(self.ceilingEdit.text()) / 100)
+
+    def update_metrics_server(self, enabled):
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+            self.metricsServer = None
+        self.metricsPortEdit.setEnabled(not enabled)
+        self.metricsLabel.setText("Not serving")
+        if not enabled:
+            return
+
+        try:
+            self.metricsServer = MetricsServer(self.controllerTabs, self.guiLag, int(self.metricsPortEdit.text()),
+                                               self.sensorBridge)
+        except (OSError, ValueError) as e:
+            dg = QErrorMessage()
+            dg.setWindowIcon(QIcon(':/icon.png'))
+            dg.setWindowTitle("Error")
+            dg.showMessage(f"Could not start the metrics server: {e}")
+            dg.exec_()
+            self.metricsGroup.setChecked(False)
+            return
+        self.metricsLabel.setText(f"Serving http://{MetricsServer.HOST}:{self.metricsServer.port}/metrics")
+
+    @staticmethod
+    def format_latency(seconds):
+        if seconds is None:
+            return "-"
+        return f"{1000 * seconds:.1f} ms"
+
+    def reset(self):
+        for bus in all_buses():
+            bus.reset()
+        self.guiLag.reset()
+        self.update_diagnostics()
+
+    def update_profiler(self, enabled):
+        if enabled:
+            self.profiler = Profiler()
+            self.profiler.start()
+        elif self.profiler is not None:
+            self.profiler.stop()
+        self.profilerReportButton.setEnabled(self.profiler is not None)
+        self.update_diagnostics()
+
+    def save_profiler_report(self):
+        filename, _ = QFileDialog.getSaveFileName(self, "Save profiler report",
+                                                  datetime.now().strftime("profile_%Y-%m-%d_%H-%M-%S.txt"),
+                                                  "Text files (*.txt)")
+        if filename == "":
+            return
+        try:
+            with open(filename, 'w') as file:
+                file.write(self.profiler.report())
+        except OSError as e:
+            dg = QErrorMessage()
+            dg.setWindowIcon(QIcon(':/icon.png'))
+            dg.setWindowTitle("Error")
+            dg.showMessage(f"Could not save the profiler report: {e.strerror}")
+            dg.exec_()
+
+    def update_diagnostics(self):
+        # The last stall is shown with the stack it was captured with, the full list is in the saved report
+        if self.profiler is not None:
+            stalls = list(self.profiler.stalls)
+            if len(stalls) > 0:
+                when, duration, callback, stack = stalls[-1]
+                self.profilerLabel.setText(f"{self.profiler.summary()}, last {1000 * duration:.0f} ms in {callback} "
+                                           f"at {when.strftime('%H:%M:%S')}")
+                self.profilerLabel.setToolTip(stack.rstrip('\n'))
+            else:
+                self.profilerLabel.setText(self.profiler.summary())
+                self.profilerLabel.setToolTip("")
+
+        buses = all_buses()
+        lag = self.guiLag.percentile(99)
+        self.utilizationLabel.setText(", ".join([f"{bus.name}: {100 * bus.utilization():.1f}%" for bus in buses] +
+                                                [f"GUI lag p99: {self.format_latency(lag)}"]))
+
+        waits = []
+        for bus in buses:
+            queued = [f"{priority} {self.format_latency(histogram.percentile(99))}/"
+                      f"{self.format_latency(histogram.max if histogram.count > 0 else None)}"
+                      for priority, histogram in bus.wait_snapshot()]
+            if len(queued) > 0:
+                waits.append(f"{bus.name} queue wait p99/max: " + ", ".join(queued))
+        self.waitLabel.setText("\n".join(waits))
+
+        budget = get_budget()
+        if len(budget.policies) > 0:
+            boosted = sum(1 for policy in budget.policies if policy.is_boosted())
+            self.budgetLabel.setText(f"{boosted} of {len(budget.policies)} adaptive channels boosted, "
+                                     f"measured load {100 * budget.load:.1f}%, "
+                                     f"{100 * budget.granted:.0f}% of the requested boost granted")
+        else:
+            self.budgetLabel.setText("No channel polls adaptively")
+
+        rows = []
+        for bus in buses:
+            for command, histogram, outcomes in bus.snapshot():
+                rows.append([bus.name, command, str(histogram.count), self.format_latency(histogram.mean())] +
+                            [self.format_latency(histogram.percentile(p)) for p in self.PERCENTILES] +
+                            [self.format_latency(histogram.max if histogram.count > 0 else None)] +
+                            [str(count) for count in outcomes[1:]])
+
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 1:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
@@ -0,0 +1,116 @@
+import threading
+import time
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+# Runs the dosing processes of several channels on one timeline, in a single thread.
+# All schedulers get the same start time, and every instant at which at least one channel changes its setpoint
+# is an event. The writes due at an event are sent back-to-back while holding `busLock`
+# (the lock of the connection shared by the channels), so no other query gets between them.
+# The skew of an event is the time between the first and the last device answering to its writes,
+# it stays NaN for events with less than two writes
+class DosingCoordinator(QObject):
+    # Event index and its skew in seconds, emitted after the writes of an event with more than one channel
+    eventFinished = pyqtSignal(int, float)
+    # Emitted when the processes of all channels have ended, not when the coordinator was stopped
+    finished = pyqtSignal()
+
+    # Deadlines closer than this (in seconds) are the same instant, durations given in minutes are rarely exact
+    RESOLUTION = 0.001
+
+    def __init__(self, busLock, schedulers: list):
+        super().__init__()
+        self.busLock = busLock
+        self.schedulers = schedulers
+
+        # Offsets of the events from the start, and for each one the (scheduler, trajectory point) writes
+        # and the schedulers that end at it. The last offset of every scheduler is the end of its process
+        deadlines = [np.round(np.append(scheduler.times, scheduler.deadlines[-1]) / self.RESOLUTION).astype(np.int64)
+                     for scheduler in schedulers]
+        ticks = np.unique(np.concatenate(deadlines)) if len(deadlines) > 0 else np.zeros(0, dtype=np.int64)
+        self.events = ticks * self.RESOLUTION
+        self.writes = [[] for _ in ticks]
+        self.ends = [[] for _ in ticks]
+        for scheduler, schedulerTicks in zip(schedulers, deadlines):
+            for point, event in enumerate(np.searchsorted(ticks, schedulerTicks)):
+                if point < len(scheduler.times):
+                    self.writes[event].append((scheduler, point))
+                else:
+                    self.ends[event].append(scheduler)
+
+        self.skew = np.full(len(self.events), np.nan)
+        self.startTime = None
+
+        self.__stopEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="Dosing coordinator", daemon=True)
+
+    def start(self):
+        self.startTime = time.monotonic()
+        for scheduler in self.schedulers:
+            scheduler.attach(self, self.startTime)
+        self.__thread.start()
+
+    # Stop all channels before their next step, the current setpoints are left unchanged
+    def stop(self):
+        self.__stopEvent.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def is_running(self):
+        return self.__thread.is_alive()
+
+    # Mean and maximal skew over the events with more than one write so far, in seconds, None if there were none
+    def skew_statistics(self):
+        measured = self.skew[~np.isnan(self.skew)]
+        if len(measured) == 0:
+            return None
+        return measured.mean(), measured.max()
+
+    # Short description of the inter-channel skew
+    def summary(self):
+        statistics = self.skew_statistics()
+        if statistics is None:
+            return "no simultaneous setpoint changes"
+        return (f"{np.count_nonzero(~np.isnan(self.skew))} simultaneous changes, "
+                f"skew mean {1000 * statistics[0]:.1f} ms, max {1000 * statistics[1]:.1f} ms")
+
+    # Write the event record as csv lines: event, scheduled time, channels written and skew in seconds
+    def write_record(self, file):
+        file.write("Dosing event,Scheduled,Channels,Skew\n")
+        for i in range(len(self.events)):
+            channels = ' '.join(str(scheduler.controller.channel) for scheduler, point in self.writes[i])
+            file.write(f"{i},{self.events[i]:.3f},{channels},{self.skew[i]:.6f}\n")
+
+    # Returns True if the coordinator was stopped while waiting
+    def __wait_until(self, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.__stopEvent.wait(remaining):
+                return True
+
+    def __run(self):
+        for i in range(len(self.events)):
+            if all(scheduler.is_stopped() for scheduler in self.schedulers):
+                return
+            if self.__wait_until(self.startTime + self.events[i]):
+                return
+
+            # A channel stopped from its tab is checked under the lock, so its final setpoint is never overwritten
+            written = []
+            with self.busLock:
+                for scheduler, point in self.writes[i]:
+                    if not scheduler.is_stopped():
+                        scheduler.execute_write(point)
+                        written.append(scheduler.completed[point])
+            if len(written) > 1:
+                self.skew[i] = max(written) - min(written)
+                self.eventFinished.emit(i, float(self.skew[i]))
+
+            for scheduler in self.ends[i]:
+                if not scheduler.is_stopped():
+                    scheduler.finish()
+
+        self.finished.emit()
@@ -0,0 +1,146 @@
+import csv
+import json
+import os
+import numpy as np
+from DosingScheduler import DosingScheduler
+
+
+# Dosing process loaded from a file, compiled once into numpy arrays: setpoints, step durations in seconds
+# and ramp shapes as indices into DosingScheduler.RAMPS (17 bytes per step)
+class DosingProfile:
+    # Possible setpoint values according to the Brooks datasheet (section C-5-4)
+    SETPOINT_LIMIT = 999.999
+
+    def __init__(self, name, values, durations, ramps=None):
+        self.name = name
+        self.values = np.asarray(values, dtype=np.float64)
+        self.durations = np.asarray(durations, dtype=np.float64)
+        if ramps is None:
+            self.ramps = np.zeros(len(self.values), dtype=np.uint8)
+        else:
+            self.ramps = np.asarray(ramps, dtype=np.uint8)
+
+        if len(self.values) == 0:
+            raise ValueError(f"{name}: the profile has no steps")
+        if len(self.values) != len(self.durations) or len(self.values) != len(self.ramps):
+            raise ValueError(f"{name}: setpoints, times and ramps differ in length")
+        if not np.all(np.isfinite(self.values)) or np.any(np.abs(self.values) > self.SETPOINT_LIMIT):
+            raise ValueError(f"{name}: setpoints must be numbers between {-self.SETPOINT_LIMIT} "
+                             f"and {self.SETPOINT_LIMIT}")
+        if not np.all(np.isfinite(self.durations)) or np.any(self.durations <= 0):
+            raise ValueError(f"{name}: times must be positive numbers")
+
+    # Ramp names, in the form taken by DosingScheduler
+    def ramp_names(self):
+        return [DosingScheduler.RAMPS[ramp] for ramp in self.ramps]
+
+    def duration(self):
+        return float(self.durations.sum())
+
+    def description(self):
+        return f"{self.name}: {len(self.values)} steps, {self.duration() / 60:.1f} minutes"
+
+    @staticmethod
+    def ramp_codes(name, ramps):
+        codes = np.zeros(len(ramps), dtype=np.uint8)
+        for i, ramp in enumerate(ramps):
+            ramp = str(ramp).strip() if ramp is not None else ''
+            if ramp == '':
+                continue
+            if ramp not in DosingScheduler.RAMPS:
+                raise ValueError(f"{name}: unknown ramp '{ramp}' in step {i + 1}, "
+                                 f"expected one of {', '.join(DosingScheduler.RAMPS)}")
+            codes[i] = DosingScheduler.RAMPS.index(ramp)
+        return codes
+
+
+# Load dosing profiles from a CSV or JSON file. Returns a dictionary of channel number -> DosingProfile,
+# with the key None for a profile meant for every selected channel. Raises ValueError if the file is invalid.
+#
+# CSV files have a header and one step per line, with columns "time" (step duration in minutes), "setpoint",
+# and optionally "ramp" and "channel". Without a channel column the profile is for every channel.
+# JSON files hold either one profile, {"times": [...], "setpoints": [...], "ramps": [...]},
+# or an object of profiles keyed by channel number, {"1": {...}, "2": {...}}. Ramps are optional in both
+def load_profiles(filename):
+    name = os.path.basename(filename)
+    try:
+        if filename.lower().endswith('.json'):
+            return _load_json(name, filename)
+        return _load_csv(name, filename)
+    except OSError as e:
+        raise ValueError(f"{name}: {e.strerror}")
+
+
+def _profile(name, times, setpoints, ramps):
+    try:
+        durations = np.asarray(times, dtype=np.float64) * 60
+        values = np.asarray(setpoints, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: times and setpoints must be numbers")
+    if durations.ndim != 1 or values.ndim != 1:
+        raise ValueError(f"{name}: times and setpoints must be lists of numbers")
+    if ramps is None:
+        ramps = [''] * len(values)
+    if not isinstance(ramps, list):
+        raise ValueError(f"{name}: ramps must be a list of names")
+    if len(ramps) != len(values):
+        raise ValueError(f"{name}: setpoints, times and ramps differ in length")
+    return DosingProfile(name, values, durations, DosingProfile.ramp_codes(name, ramps))
+
+
+def _channel(name, channel):
+    try:
+        channel = int(channel)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: invalid channel '{channel}'")
+    if not 1 <= channel <= 4:
+        raise ValueError(f"{name}: channel {channel} does not exist, channels are 1 to 4")
+    return channel
+
+
+def _load_csv(name, filename):
+    steps = {}
+    with open(filename, newline='') as file:
+        reader = csv.DictReader(file, skipinitialspace=True)
+        columns = [column.strip().lower() for column in reader.fieldnames or []]
+        if 'time' not in columns or 'setpoint' not in columns:
+            raise ValueError(f"{name}: the header must name the 'time' and 'setpoint' columns")
+        reader.fieldnames = columns
+        for row in reader:
+            channel = _channel(name, row['channel']) if 'channel' in columns else None
+            times, setpoints, ramps = steps.setdefault(channel, ([], [], []))
+            times.append(row['time'])
+            setpoints.append(row['setpoint'])
+            ramps.append(row.get('ramp'))
+
+    profiles = {}
+    for channel, (times, setpoints, ramps) in steps.items():
+        profileName = name if channel is None else f"{name} channel {channel}"
+        profiles[channel] = _profile(profileName, times, setpoints, ramps)
+    if len(profiles) == 0:
+        raise ValueError(f"{name}: the profile has no steps")
+    return profiles
+
+
+def _load_json(name, filename):
+    with open(filename) as file:
+        try:
+            content = json.load(file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{name}: {e}")
+    if not isinstance(content, dict):
+        raise ValueError(f"{name}: expected an object with 'times' and 'setpoints' or objects keyed by channel")
+
+    if 'times' in content or 'setpoints' in content:
+        return {None: _profile(name, content.get('times', []), content.get('setpoints', []), content.get('ramps'))}
+
+    profiles = {}
+    for channel, profile in content.items():
+        channel = _channel(name, channel)
+        if not isinstance(profile, dict):
+            raise ValueError(f"{name}: the profile of channel {channel} must be an object")
+        profiles[channel] = _profile(f"{name} channel {channel}", profile.get('times', []),
+                                     profile.get('setpoints', []), profile.get('ramps'))
+    if len(profiles) == 0:
+        raise ValueError(f"{name}: the file holds no profiles")
+    return profiles
@@ -0,0 +1,201 @@
+import threading
+import time
+import numpy as np
+import pyvisa
+from PyQt5.QtCore import QObject, pyqtSignal
+from Controller import Controller
+
+
+# Runs a dosing process (a list of setpoints and the time each one is held, in seconds) in a dedicated thread.
+# Each step can instead ramp from its setpoint to the next one over its duration, with a linear, exponential
+# or cubic shape. The whole setpoint trajectory is computed up front, sampled at `rate` Hz on ramps
+# and rounded to the controller's decimal point, and only the points where the rounded setpoint changes are kept,
+# so a slow ramp does not send the same value over and over.
+# The deadline of every write is computed from a single monotonic start time, so a slow setpoint write
+# or a busy GUI delays only that write and never shifts the following ones.
+# Scheduled and actual times of every write are recorded, in seconds from the start:
+# `actual` is when the write was issued, `completed` is when the device answered (NaN for writes not reached yet).
+# Several schedulers can instead be run together on one timeline by a DosingCoordinator, see attach()
+class DosingScheduler(QObject):
+    # Step index and setpoint, emitted after every setpoint write
+    setpointWritten = pyqtSignal(int, float)
+    # Emitted when the last step's time is up, not when the process was stopped
+    finished = pyqtSignal()
+
+    RAMPS = ['step', 'linear', 'exp', 'cubic']
+    # Highest allowed trajectory rate in Hz, every write is a query on the bus shared by all channels
+    MAX_RATE = 10.0
+    # Steepness of exponential ramps, the setpoint moves quickly at first and then settles towards the next one
+    EXP_RATE = 4.0
+
+    def __init__(self, controller: Controller, values, durations, ramps=None, rate=5.0):
+        super().__init__()
+        self.controller = controller
+        self.values = np.asarray(values, dtype=np.float64)
+        durations = np.asarray(durations, dtype=np.float64)
+        if len(self.values) != len(durations) or len(self.values) == 0:
+            raise ValueError("Dosing needs one duration for every setpoint")
+        if not 0 < rate <= self.MAX_RATE:
+            raise ValueError(f"The trajectory rate must be above 0 and at most {self.MAX_RATE:g} Hz")
+
+        # Missing ramps are steps, the ramp of the last step is ignored since there is no setpoint to ramp to
+        ramps = list(ramps) if ramps is not None else []
+        if len(ramps) > len(self.values) or not all(ramp in self.RAMPS for ramp in ramps):
+            raise ValueError(f"Ramps must be one of {', '.join(self.RAMPS)}, at most one per setpoint")
+        self.ramps = ramps + ['step'] * (len(self.values) - len(ramps))
+        self.rate = rate
+
+        # Offsets of every step's start from the process start, the last entry is the end of the process
+        self.deadlines = np.concatenate(([0.0], np.cumsum(durations)))
+        self.times, self.setpoints, self.steps = self.trajectory(self.values, self.deadlines, self.ramps, rate,
+                                                                 controller.decimalPoint)
+        self.scheduled = self.times
+        self.actual = np.full(len(self.times), np.nan)
+        self.completed = np.full(len(self.times), np.nan)
+        self.errors = 0
+
+        self.startTime = None
+        self.coordinator = None
+        self.__done = False
+
+        self.__stopEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"Dosing {controller.channel}", daemon=True)
+
+    # Shape of a ramp, going from 0 to 1 as `u` goes from 0 to 1
+    @staticmethod
+    def ramp_shape(ramp, u):
+        if ramp == 'linear':
+            return u
+        if ramp == 'exp':
+            return (1 - np.exp(-DosingScheduler.EXP_RATE * u)) / (1 - np.exp(-DosingScheduler.EXP_RATE))
+        if ramp == 'cubic':
+            return u * u * (3 - 2 * u)
+        return np.zeros_like(u)
+
+    # Returns the offsets, setpoints and step indices of the writes needed to follow the process
+    @staticmethod
+    def trajectory(values, deadlines, ramps, rate, decimals):
+        times = []
+        steps = []
+        setpoints = []
+        for i in range(len(values)):
+            duration = deadlines[i + 1] - deadlines[i]
+            if ramps[i] == 'step' or i == len(values) - 1 or duration <= 0:
+                offsets = np.zeros(1)
+            else:
+                offsets = np.arange(0, duration, 1 / rate)
+            times.append(deadlines[i] + offsets)
+            steps.append(np.full(len(offsets), i))
+            if len(offsets) > 1:
+                change = values[i + 1] - values[i]
+                setpoints.append(values[i] + change * DosingScheduler.ramp_shape(ramps[i], offsets / duration))
+            else:
+                setpoints.append(np.full(1, values[i]))
+
+        times = np.concatenate(times)
+        steps = np.concatenate(steps)
+        setpoints = np.round(np.concatenate(setpoints), decimals)
+
+        # The first write is always kept, a step with the same setpoint as the previous one writes nothing
+        changed = np.concatenate(([True], setpoints[1:] != setpoints[:-1]))
+        return times[changed], setpoints[changed], steps[changed]
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.__thread.start()
+
+    # Leave running the writes to the thread of `coordinator`, with the process starting at `startTime`.
+    # The scheduler is not started then, the coordinator calls execute_write() and finish() at the deadlines
+    def attach(self, coordinator, startTime):
+        self.coordinator = coordinator
+        self.startTime = startTime
+
+    # Stop before the next write, the current setpoint is left unchanged
+    def stop(self):
+        self.__stopEvent.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def is_stopped(self):
+        return self.__stopEvent.is_set()
+
+    def is_running(self):
+        if self.coordinator is not None:
+            return self.coordinator.is_running() and not self.__done and not self.is_stopped()
+        return self.__thread.is_alive()
+
+    # Seconds until the next step (or the end of the process), and the next step's setpoint, None at the last step
+    def time_to_next_step(self):
+        elapsed = time.monotonic() - self.startTime
+        nextStep = min(np.searchsorted(self.deadlines, elapsed, side='right'), len(self.values))
+        remaining = self.deadlines[nextStep] - elapsed
+        return max(remaining, 0.0), self.values[nextStep] if nextStep < len(self.values) else None
+
+    # How late every executed write was issued, in seconds
+    def lateness(self):
+        reached = ~np.isnan(self.actual)
+        return self.actual[reached] - self.scheduled[reached]
+
+    # Short description of the timing of the executed writes
+    def summary(self):
+        lateness = self.lateness()
+        if len(lateness) == 0:
+            return "no setpoints written"
+        return (f"{len(lateness)} setpoints written, lateness mean {1000 * lateness.mean():.1f} ms, "
+                f"max {1000 * lateness.max():.1f} ms")
+
+    # Write the record of the writes as csv lines: step, setpoint, scheduled, actual and completed times in seconds
+    def write_record(self, file):
+        file.write("Dosing step,Setpoint,Scheduled,Actual,Completed\n")
+        for i in range(len(self.times)):
+            file.write(f"{self.steps[i]},{self.setpoints[i]},{self.scheduled[i]:.6f},{self.actual[i]:.6f},"
+                       f"{self.completed[i]:.6f}\n")
+
+    # Write the setpoint of trajectory point `i` and record its timing, called once its deadline has come
+    def execute_write(self, i):
+        value = float(self.setpoints[i])
+        self.actual[i] = time.monotonic() - self.startTime
+        try:
+            self.controller.set_setpoint(value)
+        except (pyvisa.errors.VisaIOError, IndexError) as e:
+            # The write is counted as executed, the process keeps its timeline
+            print(f"Dosing {self.controller.channel}: failed to write setpoint {value}: {e}")
+            self.errors += 1
+        except Exception as e:
+            # Anything else (a value the controller rejects) can not be skipped safely, the process is ended,
+            # so the tab sets the final setpoint and closes the valve
+            print(f"Dosing {self.controller.channel}: aborted, setpoint {value} was rejected: {type(e).__name__} {e}")
+            self.errors += 1
+            self.completed[i] = time.monotonic() - self.startTime
+            self.abort()
+            return
+        self.completed[i] = time.monotonic() - self.startTime
+        self.setpointWritten.emit(int(self.steps[i]), value)
+
+    # Called once the time of the last step is up
+    def finish(self):
+        self.__done = True
+        self.finished.emit()
+
+    # End the process early: no further writes, but finished is emitted as if its time was up
+    def abort(self):
+        self.__stopEvent.set()
+        self.finish()
+
+    # Returns True if the process was stopped while waiting
+    def __wait_until(self, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.__stopEvent.wait(remaining):
+                return True
+
+    def __run(self):
+        for i in range(len(self.times)):
+            if self.__wait_until(self.startTime + self.times[i]):
+                return
+            self.execute_write(i)
+
+        if not self.__wait_until(self.startTime + self.deadlines[-1]):
+            self.finish()
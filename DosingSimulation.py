@@ -0,0 +1,77 @@
+import numpy as np
+from DosingScheduler import DosingScheduler
+
+# Seconds in every time base of the Brooks controllers, PV is given in units per time base
+TIME_BASE_SECONDS = {
+    "sec": 1,
+    "min": 60,
+    "hrs": 3600,
+    "day": 86400
+}
+
+
+# Expected course of a dosing process, computed without a device. The setpoint follows the same trajectory
+# DosingScheduler writes (ramps, rounding and all), and the flow follows the setpoint as a first-order system
+# with time constant `timeConstant` seconds, starting from `initialFlow`. After the process the setpoint is 0,
+# as the tab sets it, and the simulation goes on for five time constants.
+# Everything is evaluated at `samples` evenly spaced times, in closed form per setpoint segment,
+# so even processes with thousands of steps take milliseconds
+class DosingSimulation:
+    def __init__(self, values, durations, ramps=None, rate=5.0, decimals=2, timeConstant=1.0, initialFlow=0.0,
+                 timeBase="sec", samples=20000):
+        values = np.asarray(values, dtype=np.float64)
+        durations = np.asarray(durations, dtype=np.float64)
+        ramps = list(ramps) if ramps is not None else []
+        ramps = ramps + ['step'] * (len(values) - len(ramps))
+        deadlines = np.concatenate(([0.0], np.cumsum(durations)))
+        writeTimes, setpoints, _ = DosingScheduler.trajectory(values, deadlines, ramps, rate, decimals)
+
+        # Segments of a constant setpoint, the last one is the closed valve after the process
+        self.endTime = deadlines[-1]
+        starts = np.append(writeTimes, self.endTime)
+        levels = np.append(setpoints, 0.0)
+        lengths = np.diff(np.append(starts, self.endTime + 5 * timeConstant))
+
+        # Flow at the start of every segment, each segment decays towards its setpoint
+        decay = np.exp(-lengths / timeConstant)
+        startFlows = np.empty(len(starts))
+        flow = initialFlow
+        for i in range(len(starts)):
+            startFlows[i] = flow
+            flow = levels[i] + (flow - levels[i]) * decay[i]
+
+        # Volume delivered in every segment (integral of the flow), PV is per time base, totalizer is not
+        perSecond = 1 / TIME_BASE_SECONDS[timeBase]
+        volumes = (levels * lengths + (startFlows - levels) * timeConstant * (1 - decay)) * perSecond
+        startTotals = np.concatenate(([0.0], np.cumsum(volumes)[:-1]))
+
+        self.times = np.linspace(0, starts[-1] + lengths[-1], samples)
+        segment = np.searchsorted(starts, self.times, side='right') - 1
+        elapsed = self.times - starts[segment]
+        sampleDecay = np.exp(-elapsed / timeConstant)
+        self.setpoints = levels[segment]
+        self.flows = levels[segment] + (startFlows[segment] - levels[segment]) * sampleDecay
+        self.totals = startTotals[segment] + (levels[segment] * elapsed + (startFlows[segment] - levels[segment]) *
+                                              timeConstant * (1 - sampleDecay)) * perSecond
+        self.totalVolume = float(np.sum(volumes))
+        self.writes = len(writeTimes)
+
+    def peak_flow(self):
+        return float(self.flows.max())
+
+    # Flow at the given times, in seconds from the start
+    def flow_at(self, times):
+        return np.interp(times, self.times, self.flows, right=0.0)
+
+    def description(self):
+        return (f"{self.totalVolume:.2f} delivered in {self.endTime / 60:.1f} minutes, "
+                f"peak flow {self.peak_flow():.2f}, {self.writes} setpoint writes")
+
+
+# Peak of the summed flow of several simulations, and the end time of the latest process in seconds.
+# The flows are added as they are, so they should be given in the same units
+def combine_simulations(simulations):
+    end = max(simulation.times[-1] for simulation in simulations)
+    times = np.linspace(0, end, max(len(simulation.times) for simulation in simulations))
+    combined = np.sum([simulation.flow_at(times) for simulation in simulations], axis=0)
+    return float(combined.max()), max(simulation.endTime for simulation in simulations)
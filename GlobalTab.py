@@ -1,21 +1,30 @@
 import sys
+from functools import partial
 from PyQt5.QtCore import Qt, QRegExp, pyqtSignal, QTimer
-from PyQt5.QtGui import QPixmap, QRegExpValidator, QIntValidator
+from PyQt5.QtGui import QPixmap, QRegExpValidator, QIntValidator, QIcon
 from PyQt5.QtWidgets import (
     QCheckBox, QVBoxLayout, QWidget, QHBoxLayout, QGridLayout, QGroupBox, QLabel,
-    QPushButton, QComboBox, QSpinBox, QDoubleSpinBox, QDialog, QFormLayout, QLineEdit
+    QPushButton, QComboBox, QSpinBox, QDoubleSpinBox, QDialog, QFormLayout, QLineEdit, QErrorMessage, QFileDialog
 )
 from numpy_ringbuffer import RingBuffer
 import numpy as np
 from pyqtgraph import mkPen, PlotWidget
 from Brooks025X import Brooks025X
-from datetime import datetime
+from datetime import datetime, timedelta
 from PyQt5 import QtCore
 from sensirion_shdlc_driver import ShdlcConnection, ShdlcSerialPort
 from sensirion_shdlc_sensorbridge import SensorBridgeShdlcDevice, SensorBridgePort
 from sensirion.SensirionSensor import SensirionSensor
 from sensirion.SHT85 import SHT85
 from sensirion.STC31 import STC31
+from sensirion.STC31Compensator import STC31Compensator
+from sensirion.BringUpSequencer import BringUpSequencer, BringUpStep, BringUpError
+from CsvWriter import CsvWriter
+from DosingCoordinator import DosingCoordinator
+from DosingScheduler import DosingScheduler
+from DosingProfile import load_profiles
+from DosingSimulation import combine_simulations
+from Scheduler import ScheduledTimer
 from serial.tools.list_ports import comports
 import resources
 
@@ -73,7 +82,7 @@ class SSBDialog(QDialog):
         self.buttonCancel = QPushButton("Cancel")
         self.buttonCancel.clicked.connect(self.cancel_pressed)
 
-        self.timer = QTimer()
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_BACKGROUND)
         self.timer.timeout.connect(self.refresh_devices)
         self.timer.start(1000)
 
@@ -123,6 +132,14 @@ class SensirionSBPlot(QWidget):
         self.buffer.append(sample)
         self.plot.plot(self.buffer, pen=self.pen, symbolPen=self.pen, symbol='o', symbolSize=5, name="symbol ='o'")
 
+    # Add many samples at once, redrawing the plot only once
+    def update_plot_batch(self, samples):
+        if len(samples) == 0:
+            return
+        self.plot.clear()
+        self.buffer.extend(samples[-self.buffer.maxlen:])
+        self.plot.plot(self.buffer, pen=self.pen, symbolPen=self.pen, symbol='o', symbolSize=5, name="symbol ='o'")
+
 
 class SensirionSB(QWidget):
     # Each plot is individually notified of a new value,
@@ -134,13 +151,34 @@ class SensirionSB(QWidget):
     stc31ConcentrationReady = pyqtSignal(float)
     stc31AnalogReady = pyqtSignal(float)
 
-    def __init__(self):
+    # Batches of samples collected from the Sensor Bridge buffers, numpy arrays
+    sht85TemperatureBatchReady = pyqtSignal(object)
+    sht85HumidityBatchReady = pyqtSignal(object)
+    stc31ConcentrationBatchReady = pyqtSignal(object)
+
+    # How often the Sensor Bridge buffers are collected when the bridge samples on its own
+    BRIDGE_DRAIN_INTERVAL = 500
+
+    def __init__(self, controllerTabs=None):
         super().__init__()
 
+        # Controller tabs, whose serial sensors can be used as the pressure source for STC31 compensation
+        self.tabs = controllerTabs if controllerTabs is not None else []
+
         self.ssbGroup = QGroupBox("Sensirion Sensorbridge control")
         self.portLabel = QLabel("Serial port: not connected")
         self.device: SensorBridgeShdlcDevice = None
 
+        # Power, configuration and self test of the sensors run in the background, one sequence per bridge port
+        self.bringUp = BringUpSequencer()
+        self.bringUp.stepStarted.connect(self.bring_up_step_started)
+        self.bringUp.stepFinished.connect(self.bring_up_step_finished)
+        self.bringUp.sequenceReady.connect(self.bring_up_port_ready)
+        self.bringUp.sequenceFailed.connect(self.bring_up_port_failed)
+        self.bringUp.finished.connect(self.bring_up_finished)
+        self.bringUpStates = {}
+        self.bringUpLabel = QLabel("Devices: not connected")
+
         self.portOnePowerEnabled = False
         self.portOnePowerButton = QPushButton("Enable supply")
         self.portOnePowerButton.clicked.connect(self.port_one_supply_clicked)
@@ -158,10 +196,52 @@ class SensirionSB(QWidget):
         self.sht85PortDropdown.setCurrentIndex(1)
         self.sht85PortDropdown.currentTextChanged.connect(self.sht85_port_changed)
 
+        # Single shot or periodic acquisition, in periodic mode the SHT85 measures on its own
+        # and every readout is only a fetch, so sub-second rates are possible
+        self.sht85ModeDropdown = QComboBox()
+        self.sht85ModeDropdown.addItems(SHT85.MEASUREMENT_MODES.keys())
+        self.sht85ModeDropdown.currentTextChanged.connect(self.sht85_mode_changed)
+
+        self.sht85RepeatabilityDropdown = QComboBox()
+        self.sht85RepeatabilityDropdown.addItems(SHT85.REPEATABILITY)
+        self.sht85RepeatabilityDropdown.currentTextChanged.connect(self.sht85_mode_changed)
+
         self.sht85compensationEnabled = False
         self.sht85compensationCheckbox = QCheckBox("Compensate STC31 on measurement")
         self.sht85compensationCheckbox.clicked.connect(self.compensate_changed)
 
+        # Compensation values are written to the STC31 by a background thread, only if they changed
+        # by more than the deadband or were last written more than the maximum age ago
+        self.compensator: STC31Compensator = None
+
+        self.compensationTemperatureDeadbandEdit = QDoubleSpinBox()
+        self.compensationTemperatureDeadbandEdit.setRange(0.0, 10.0)
+        self.compensationTemperatureDeadbandEdit.setSingleStep(0.05)
+        self.compensationTemperatureDeadbandEdit.setValue(0.1)
+        self.compensationTemperatureDeadbandEdit.setSuffix("  ℃")
+        self.compensationTemperatureDeadbandEdit.editingFinished.connect(self.update_compensation_settings)
+
+        self.compensationHumidityDeadbandEdit = QDoubleSpinBox()
+        self.compensationHumidityDeadbandEdit.setRange(0.0, 20.0)
+        self.compensationHumidityDeadbandEdit.setSingleStep(0.1)
+        self.compensationHumidityDeadbandEdit.setValue(0.5)
+        self.compensationHumidityDeadbandEdit.setSuffix("  % RH")
+        self.compensationHumidityDeadbandEdit.editingFinished.connect(self.update_compensation_settings)
+
+        self.compensationPressureDeadbandEdit = QSpinBox()
+        self.compensationPressureDeadbandEdit.setRange(0, 100)
+        self.compensationPressureDeadbandEdit.setValue(1)
+        self.compensationPressureDeadbandEdit.setSuffix("  mbar")
+        self.compensationPressureDeadbandEdit.editingFinished.connect(self.update_compensation_settings)
+
+        self.compensationMaxAgeEdit = QSpinBox()
+        self.compensationMaxAgeEdit.setRange(1, 3600)
+        self.compensationMaxAgeEdit.setValue(60)
+        self.compensationMaxAgeEdit.setSuffix("  s")
+        self.compensationMaxAgeEdit.editingFinished.connect(self.update_compensation_settings)
+
+        self.compensationStatusLabel = QLabel("Compensation writes: 0, saved: 0")
+
         self.sht85TemperatureLabel = QLabel("Temp: ? ℃")
         self.sht85HumidityLabel = QLabel("Humidity: ? % RH")
         self.sht85AnalogLabel = QLabel("Analog: ? V")
@@ -198,8 +278,12 @@ class SensirionSB(QWidget):
         self.stc31PressureEdit.setRange(0, 65535)
         self.stc31PressureEdit.setValue(1013)
         self.stc31PressureEdit.setSuffix("  mbar")
-        self.stc31PressureEdit.editingFinished.connect(
-            lambda: self.stc31device.set_pressure(self.stc31PressureEdit.value()))
+        self.stc31PressureEdit.editingFinished.connect(self.stc31_pressure_changed)
+
+        # "Manual" uses the value above, other entries are numeric columns of the controller tabs' serial sensors
+        self.stc31PressureSourceDropdown = QComboBox()
+        self.stc31PressureSourceDropdown.addItem("Manual")
+        self.stc31PressureSourceDropdown.currentTextChanged.connect(self.update_compensation_settings)
 
         self.stc31ForcedRecalibrationEdit = QSpinBox()
         self.stc31ForcedRecalibrationEdit.setRange(0, 65535)
@@ -220,19 +304,37 @@ class SensirionSB(QWidget):
         self.stc31SelfTestButton.clicked.connect(self.stc31_self_test)
 
         self.stc31SoftResetButton = QPushButton("Soft reset")
-        self.stc31SoftResetButton.clicked.connect(lambda: self.stc31device.soft_reset())
+        self.stc31SoftResetButton.clicked.connect(self.stc31_soft_reset)
 
         self.stc31BlinkButton = QPushButton("Blink")
         self.stc31BlinkButton.clicked.connect(lambda: self.stc31device.blink())
 
-        self.timer = QTimer()
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_IO, precise=True)
         self.timer.timeout.connect(self.on_timeout)
 
         self.intervalEdit = QLineEdit("1")
         self.intervalEdit.setValidator(QRegExpValidator(QRegExp("[0-9]*(|\\.[0-9]*)")))
         self.intervalEdit.setMaximumWidth(150)
-        self.intervalEdit.editingFinished.connect(
-            lambda: self.timer.setInterval(int(60 * 1000 * float(self.intervalEdit.text()))))
+        self.intervalEdit.editingFinished.connect(self.update_interval)
+
+        # Bridge sampling: the Sensor Bridge firmware triggers the measurements with repeated I2C transceives,
+        # and the timer only collects the buffered results every BRIDGE_DRAIN_INTERVAL
+        self.bridgeSamplingEnabled = False
+        self.bridgeSamplingCheckbox = QCheckBox("Sample on the Sensor Bridge")
+        self.bridgeSamplingCheckbox.clicked.connect(self.bridge_sampling_changed)
+
+        self.bridgeIntervalEdit = QSpinBox()
+        self.bridgeIntervalEdit.setRange(100, 60000)
+        self.bridgeIntervalEdit.setValue(1000)
+        self.bridgeIntervalEdit.setSuffix(" ms")
+        self.bridgeIntervalEdit.editingFinished.connect(self.restart_bridge_sampling)
+
+        self.bridgeStatusLabel = QLabel("Lost bytes: 0, I2C errors: 0, CRC errors: 0")
+        # Collections of the bridge buffers that failed, the last error is shown in the tooltip of the status
+        self.drainErrors = 0
+        # Samples acquired from each sensor, plain attributes so the metrics server can read them from its thread
+        self.sht85Samples = 0
+        self.stc31Samples = 0
 
         self.csvFile = None
         self.savingEnabled = False
@@ -256,10 +358,14 @@ class SensirionSB(QWidget):
         self.stc31ConcentrationReady.connect(self.stc31ConcentrationPlotWidget.update_plot)
         self.stc31AnalogReady.connect(self.stc31AnalogPlotWidget.update_plot)
 
+        self.sht85TemperatureBatchReady.connect(self.sht85TemperaturePlotWidget.update_plot_batch)
+        self.sht85HumidityBatchReady.connect(self.sht85HumidityPlotWidget.update_plot_batch)
+        self.stc31ConcentrationBatchReady.connect(self.stc31ConcentrationPlotWidget.update_plot_batch)
+
         self.setLayout(self.create_layout())
 
     def stc31_self_test(self):
-        result = int.from_bytes(self.stc31device.self_test(), 'big')
+        result = self.stc31device.self_test()
         if result == 0x00:
             self.stc31SelfTestButton.setText("Self test: OK")
             QTimer().singleShot(5000, lambda: self.stc31SelfTestButton.setText("Self test"))
@@ -267,6 +373,16 @@ class SensirionSB(QWidget):
             self.stc31SelfTestButton.setText("Self test: FAIL (0x{:04x})".format(result))
             QTimer().singleShot(5000, lambda: self.stc31SelfTestButton.setText("Self test"))
 
+    def stc31_soft_reset(self):
+        self.stc31device.soft_reset()
+        if self.compensator is not None:
+            self.compensator.invalidate()
+
+    def stc31_pressure_changed(self):
+        self.stc31device.set_pressure(self.stc31PressureEdit.value())
+        if self.compensator is not None:
+            self.compensator.manualPressure = self.stc31PressureEdit.value()
+
     def update_buffer_sizes(self):
         value = int(self.bufferSizeEdit.text())
         self.sht85TemperaturePlotWidget.change_capacity(value)
@@ -289,6 +405,7 @@ class SensirionSB(QWidget):
         self.ssbGroup.setFixedWidth(405)
 
         ssbLayout.addWidget(self.portLabel)
+        ssbLayout.addWidget(self.bringUpLabel)
 
         powerGroup = QGroupBox("Power supply")
         powerLayout = QHBoxLayout()
@@ -316,8 +433,24 @@ class SensirionSB(QWidget):
         layout.addWidget(self.sht85PortDropdown)
         shtLayout.addLayout(layout)
 
+        layout = QHBoxLayout()
+        layout.addWidget(QLabel("Acquisition"))
+        layout.addWidget(self.sht85ModeDropdown)
+        layout.addWidget(self.sht85RepeatabilityDropdown)
+        shtLayout.addLayout(layout)
+
         shtLayout.addWidget(self.sht85compensationCheckbox)
 
+        layout = QGridLayout()
+        layout.addWidget(QLabel("Deadband"), 0, 0)
+        layout.addWidget(self.compensationTemperatureDeadbandEdit, 0, 1)
+        layout.addWidget(self.compensationHumidityDeadbandEdit, 0, 2)
+        layout.addWidget(self.compensationPressureDeadbandEdit, 1, 1)
+        layout.addWidget(QLabel("Max age"), 2, 0)
+        layout.addWidget(self.compensationMaxAgeEdit, 2, 1)
+        shtLayout.addLayout(layout)
+        shtLayout.addWidget(self.compensationStatusLabel)
+
         shtLayout.addWidget(self.sht85TemperatureLabel)
         shtLayout.addWidget(self.sht85HumidityLabel)
         shtLayout.addWidget(self.sht85AnalogLabel)
@@ -355,6 +488,11 @@ class SensirionSB(QWidget):
         layout.addWidget(self.stc31PressureEdit)
         stcLayout.addLayout(layout)
 
+        layout = QHBoxLayout()
+        layout.addWidget(QLabel("Pressure source"))
+        layout.addWidget(self.stc31PressureSourceDropdown)
+        stcLayout.addLayout(layout)
+
         layout = QHBoxLayout()
         layout.addWidget(QLabel("Forced calibration"))
         layout.addWidget(self.stc31ForcedRecalibrationEdit)
@@ -377,6 +515,12 @@ class SensirionSB(QWidget):
         layout.setStretch(0, 10)
         ssbLayout.addLayout(layout)
 
+        layout = QHBoxLayout()
+        layout.addWidget(self.bridgeSamplingCheckbox)
+        layout.addWidget(self.bridgeIntervalEdit)
+        ssbLayout.addLayout(layout)
+        ssbLayout.addWidget(self.bridgeStatusLabel)
+
         ssbLayout.addWidget(self.savingButton)
         button = QPushButton("I2C scan")
         i2cLabel = QLabel("I2C devices: unknown")
@@ -411,56 +555,240 @@ class SensirionSB(QWidget):
 
     def sht85_port_changed(self):
         self.sht85device.bridgePort = self.sht85device.PORTS[self.sht85PortDropdown.currentText()]
+        self.restart_bridge_sampling()
 
     def stc31_port_changed(self):
         self.stc31device.bridgePort = self.stc31device.PORTS[self.stc31PortDropdown.currentText()]
+        self.restart_bridge_sampling()
+
+    # Switch the SHT85 between single shot and periodic acquisition
+    # Repeated transceives are stopped first, so the bridge does not talk to the sensor while it is reconfigured
+    def sht85_mode_changed(self):
+        if self.sht85device is None:
+            return
+        self.sht85device.configure(SHT85.MEASUREMENT_MODES[self.sht85ModeDropdown.currentText()],
+                                   self.sht85RepeatabilityDropdown.currentText())
+        self.restart_bridge_sampling()
+
+    def update_interval(self):
+        if not self.bridgeSamplingEnabled:
+            self.timer.setInterval(int(60 * 1000 * float(self.intervalEdit.text())))
+
+    def bridge_sampling_changed(self):
+        self.bridgeSamplingEnabled = self.bridgeSamplingCheckbox.isChecked()
+        self.intervalEdit.setEnabled(not self.bridgeSamplingEnabled)
+        if self.bridgeSamplingEnabled:
+            self.timer.setInterval(self.BRIDGE_DRAIN_INTERVAL)
+        else:
+            self.timer.setInterval(int(60 * 1000 * float(self.intervalEdit.text())))
+        self.restart_bridge_sampling()
+
+    # (Re)start the repeated transceives on the bridge with current settings, or stop them if disabled
+    def restart_bridge_sampling(self):
+        if self.device is None:
+            return
+        interval = self.bridgeIntervalEdit.value() / 1000
+        for device in [self.sht85device, self.stc31device]:
+            device.stop_repeated()
+            if self.bridgeSamplingEnabled:
+                device.start_repeated_measurements(interval)
 
     def port_one_supply_clicked(self):
-        if not self.portTwoPowerEnabled:
-            self.portOnePowerButton.setText("Disable supply")
-            self.portOnePowerLabel.setText("Supply state: enabled")
-            self.portOnePowerEnabled = True
-            self.device.switch_supply_on(SensorBridgePort.ONE)
-            QTimer().singleShot(200, self.stc31device.disable_crc)
-            QTimer().singleShot(300, lambda: self.stc31device.set_binary_gas(self.stc31BinaryGasDropdown.currentText()))
+        if not self.portOnePowerEnabled:
+            self.start_bring_up([SensorBridgePort.ONE])
         else:
-            self.portOnePowerButton.setText("Enable supply")
-            self.portOnePowerLabel.setText("Supply state: disabled")
-            self.portOnePowerEnabled = False
             self.device.switch_supply_off(SensorBridgePort.ONE)
+            self.set_supply_state(SensorBridgePort.ONE, False)
 
     def port_two_supply_clicked(self):
         if not self.portTwoPowerEnabled:
-            self.portTwoPowerButton.setText("Disable supply")
-            self.portTwoPowerLabel.setText("Supply state: enabled")
-            self.portTwoPowerEnabled = True
-            self.device.switch_supply_on(SensorBridgePort.TWO)
-            QTimer().singleShot(200, self.stc31device.disable_crc)
-            QTimer().singleShot(300, lambda: self.stc31device.set_binary_gas(self.stc31BinaryGasDropdown.currentText()))
+            self.start_bring_up([SensorBridgePort.TWO])
         else:
-            self.portTwoPowerButton.setText("Enable supply")
-            self.portTwoPowerLabel.setText("Supply state: disabled")
-            self.portTwoPowerEnabled = False
             self.device.switch_supply_off(SensorBridgePort.TWO)
+            self.set_supply_state(SensorBridgePort.TWO, False)
+
+    def set_supply_state(self, port, enabled):
+        if port == SensorBridgePort.ONE:
+            self.portOnePowerEnabled = enabled
+            button, label = self.portOnePowerButton, self.portOnePowerLabel
+        else:
+            self.portTwoPowerEnabled = enabled
+            button, label = self.portTwoPowerButton, self.portTwoPowerLabel
+        button.setText("Disable supply" if enabled else "Enable supply")
+        label.setText("Supply state: enabled" if enabled else "Supply state: disabled")
+
+    # Build the bring-up sequence of every given port: power on, wait for the slowest sensor on it to start,
+    # then configure and test each sensor. Settings are read from the widgets now, since the steps
+    # run outside of the GUI thread
+    def bring_up_sequences(self, ports):
+        mps = SHT85.MEASUREMENT_MODES[self.sht85ModeDropdown.currentText()]
+        repeatability = self.sht85RepeatabilityDropdown.currentText()
+        binaryGas = self.stc31BinaryGasDropdown.currentText()
+        temperature = self.stc31TemperatureEdit.value()
+        humidity = self.stc31RelativeHumidityEdit.value()
+        pressure = self.stc31PressureEdit.value()
+        autoSelfCalibration = self.stc31AutoSelfCalibrationCheckbox.isChecked()
+        sht85, stc31 = self.sht85device, self.stc31device
+
+        def configure_stc31():
+            stc31.stop_repeated()
+            stc31.set_binary_gas(binaryGas)
+            stc31.set_temperature(temperature)
+            stc31.set_relative_humidity(humidity)
+            stc31.set_pressure(pressure)
+            stc31.automatic_self_calibration(autoSelfCalibration)
+
+        def self_test_stc31():
+            result = stc31.self_test()
+            if result != 0x00:
+                raise BringUpError(f"self test result 0x{result:04x}")
+
+        sequences = {}
+        for name, port in SensirionSensor.PORTS.items():
+            if port not in ports:
+                continue
+            devices = [device for device in [sht85, stc31] if device.bridgePort == port]
+            steps = [BringUpStep("Power on", partial(self.device.switch_supply_on, port),
+                                 settle=max([device.POWER_UP_TIME for device in devices], default=0.0))]
+            if sht85 in devices:
+                steps.append(BringUpStep("SHT85 configuration", partial(sht85.configure, mps, repeatability)))
+                # The SHT85 has no self test command, a measurement with matching CRCs is the check
+                steps.append(BringUpStep("SHT85 test measurement", sht85.get_measurements, timeout=2.0))
+            if stc31 in devices:
+                steps.append(BringUpStep("STC31 configuration", configure_stc31))
+                steps.append(BringUpStep("STC31 self test", self_test_stc31, timeout=2.0))
+            sequences[name] = steps
+        return sequences
+
+    def start_bring_up(self, ports):
+        sequences = self.bring_up_sequences(ports)
+        self.bringUpStates = {name: "starting" for name in sequences}
+        self.update_bring_up_label()
+        # Supplies must not be switched while a sequence is using them
+        self.portOnePowerButton.setEnabled(False)
+        self.portTwoPowerButton.setEnabled(False)
+        self.bringUp.start(sequences)
+
+    def update_bring_up_label(self):
+        self.bringUpLabel.setText("Devices: " + ", ".join(f"{name} {state}"
+                                                          for name, state in self.bringUpStates.items()))
+
+    def bring_up_step_started(self, name, step):
+        self.bringUpStates[name] = step.lower()
+        self.update_bring_up_label()
+
+    def bring_up_step_finished(self, name, step):
+        if step == "Power on":
+            self.set_supply_state(SensirionSensor.PORTS[name], True)
+            if self.compensator is not None:
+                self.compensator.invalidate()
+
+    def bring_up_port_ready(self, name):
+        self.bringUpStates[name] = "ready"
+        self.update_bring_up_label()
+
+    def bring_up_port_failed(self, name, error):
+        self.bringUpStates[name] = "failed"
+        self.update_bring_up_label()
+        dg = QErrorMessage()
+        dg.setWindowIcon(QIcon(':/icon.png'))
+        dg.setWindowTitle("Sensor Bridge Exception")
+        dg.showMessage(f"{name} bring-up failed at {error}")
+        dg.exec_()
+
+    # Bridge sampling is only started once all sensors are configured
+    def bring_up_finished(self, success):
+        self.portOnePowerButton.setEnabled(True)
+        self.portTwoPowerButton.setEnabled(True)
+        if success:
+            self.restart_bridge_sampling()
 
     def compensate_changed(self):
         if self.sht85compensationCheckbox.isChecked():
             self.sht85compensationEnabled = True
             self.stc31TemperatureEdit.setEnabled(False)
             self.stc31RelativeHumidityEdit.setEnabled(False)
+            self.refresh_pressure_sources()
+            # The values could have been changed by hand in the meantime
+            if self.compensator is not None:
+                self.compensator.invalidate()
         else:
             self.sht85compensationEnabled = False
             self.stc31TemperatureEdit.setEnabled(True)
             self.stc31RelativeHumidityEdit.setEnabled(True)
-
+        self.update_compensation_settings()
+
+    # List parsed columns of all connected serial sensors as possible pressure sources
+    def refresh_pressure_sources(self):
+        current = self.stc31PressureSourceDropdown.currentText()
+        sources = ["Manual"]
+        for i, tab in enumerate(self.tabs):
+            if tab is None:
+                continue
+            for j, sensor in enumerate([tab.sensor1, tab.sensor2]):
+                if sensor is not None and sensor.parser is not None:
+                    sources += [f"Controller {i + 1} sensor {j + 1}: {column}" for column in sensor.parser.columns]
+
+        self.stc31PressureSourceDropdown.blockSignals(True)
+        self.stc31PressureSourceDropdown.clear()
+        self.stc31PressureSourceDropdown.addItems(sources)
+        if current in sources:
+            self.stc31PressureSourceDropdown.setCurrentText(current)
+        self.stc31PressureSourceDropdown.blockSignals(False)
+
+    # Returns a function reading the newest value of the selected sensor column, or None for manual pressure.
+    # The sensor is looked up on every call, since it can be reconnected while compensation is running
+    def pressure_source(self):
+        source = self.stc31PressureSourceDropdown.currentText()
+        if source == "Manual":
+            return None
+        controller, _, column = source.partition(": ")
+        words = controller.split()
+        tab = self.tabs[int(words[1]) - 1]
+        sensorAttribute = f"sensor{words[3]}"
+
+        def read_pressure():
+            sensor = getattr(tab, sensorAttribute)
+            return sensor.last_value(column) if sensor is not None else None
+        return read_pressure
+
+    def update_compensation_settings(self):
+        self.stc31PressureEdit.setEnabled(not self.sht85compensationEnabled or
+                                          self.stc31PressureSourceDropdown.currentText() == "Manual")
+        if self.compensator is None:
+            return
+        self.compensator.deadbands = {"temperature": self.compensationTemperatureDeadbandEdit.value(),
+                                      "humidity": self.compensationHumidityDeadbandEdit.value(),
+                                      "pressure": self.compensationPressureDeadbandEdit.value()}
+        self.compensator.maxAge = self.compensationMaxAgeEdit.value()
+        self.compensator.pressureSource = self.pressure_source()
+        self.compensator.manualPressure = self.stc31PressureEdit.value()
+
+    # Hand the newest measurement to the compensation thread, it decides whether the STC31 needs an update
     def compensate_stc31(self, temperature, humidity):
-        self.stc31TemperatureEdit.setValue(temperature)
-        self.stc31RelativeHumidityEdit.setValue(humidity)
-        # manually trigger updates
-        self.stc31device.set_temperature(temperature)
-        self.stc31device.set_relative_humidity(humidity)
+        self.compensator.submit(temperature, humidity)
+
+    # Show the values last written by the compensation thread and how many writes the deadbands saved
+    def update_compensation_status(self):
+        if self.compensator is None:
+            return
+        lastWritten = self.compensator.lastWritten
+        if self.sht85compensationEnabled:
+            if lastWritten["temperature"] is not None:
+                self.stc31TemperatureEdit.setValue(lastWritten["temperature"])
+            if lastWritten["humidity"] is not None:
+                self.stc31RelativeHumidityEdit.setValue(lastWritten["humidity"])
+            if lastWritten["pressure"] is not None and not self.stc31PressureEdit.isEnabled():
+                self.stc31PressureEdit.setValue(lastWritten["pressure"])
+        self.compensationStatusLabel.setText(f"Compensation writes: {self.compensator.writes}, "
+                                             f"saved: {self.compensator.savedWrites}, "
+                                             f"errors: {self.compensator.errors}")
 
     def on_timeout(self):
+        if self.bridgeSamplingEnabled:
+            self.drain_bridge()
+            return
+
         try:
             temperature, humidity = self.sht85device.get_measurements()
             analog1 = self.sht85device.analog_measurement()
@@ -482,19 +810,67 @@ class SensirionSB(QWidget):
             self.stc31ConcentrationReady.emit(concentration)
             self.stc31AnalogReady.emit(analog2)
         except Exception:
+            self.update_bridge_status()
             return
 
+        self.sht85Samples += 1
+        self.stc31Samples += 1
+        self.update_bridge_status()
         if self.savingEnabled:
             self.append_to_csv(temperature, humidity, concentration, analog1, analog2)
 
+    def update_bridge_status(self):
+        self.update_compensation_status()
+        self.bridgeStatusLabel.setText(
+            f"Lost bytes: {self.sht85device.lostBytes + self.stc31device.lostBytes}, "
+            f"I2C errors: {self.sht85device.i2cErrors + self.stc31device.i2cErrors}, "
+            f"CRC errors: {self.sht85device.crcErrors + self.stc31device.crcErrors}, "
+            f"read errors: {self.drainErrors}")
+
+    # Collect everything the bridge measured since the last call in two round trips,
+    # and publish it in batches. Analog inputs are not buffered by the bridge, so they are read once per call
+    def drain_bridge(self):
+        try:
+            temperatures, humidities = self.sht85device.read_repeated_measurements()
+            concentrations = self.stc31device.read_repeated_measurements()
+            analog1 = self.sht85device.analog_measurement()
+            analog2 = self.stc31device.analog_measurement()
+        except Exception as e:
+            self.drainErrors += 1
+            self.bridgeStatusLabel.setToolTip(f"Last read error: {type(e).__name__} {e}")
+            self.update_bridge_status()
+            return
+
+        self.sht85Samples += len(temperatures)
+        self.stc31Samples += len(concentrations)
+        self.update_bridge_status()
+        self.sht85AnalogLabel.setText(f"Analog: {analog1:.5f} V")
+        self.stc31AnalogLabel.setText(f"Analog: {analog2:.5f} V")
+        self.sht85AnalogReady.emit(analog1)
+        self.stc31AnalogReady.emit(analog2)
+
+        if len(temperatures) > 0:
+            self.sht85TemperatureLabel.setText(f"Temp: {temperatures[-1]:.5f} ℃")
+            self.sht85HumidityLabel.setText(f"Humidity: {humidities[-1]:.5f} % RH")
+            self.sht85TemperatureBatchReady.emit(temperatures)
+            self.sht85HumidityBatchReady.emit(humidities)
+            if self.sht85compensationEnabled:
+                self.compensate_stc31(temperatures[-1], humidities[-1])
+
+        if len(concentrations) > 0:
+            self.stc31GasConcentrationLabel.setText(f"Concentration: {concentrations[-1]:.5f} %")
+            self.stc31ConcentrationBatchReady.emit(concentrations)
+
+        if self.savingEnabled:
+            self.append_batch_to_csv(temperatures, humidities, concentrations, analog1, analog2)
+
     def saving_button_clicked(self):
         if not self.savingEnabled:
             filename = datetime.now().strftime(f"sensorbridge_%Y-%m-%d_%H-%M-%S.csv")
-            self.csvFile = open(filename, 'w')
+            self.csvFile = CsvWriter(filename)
             self.csvFile.write(
                 "{},{},{},{},{},{}\n".format("Temperature", "Humidity", "Concentration", "Analog 1", "Analog 2",
                                              "Timestamp"))
-            self.csvFile.close()
             self.savingEnabled = True
             self.savingButton.setText("Disable saving to file")
         else:
@@ -504,10 +880,31 @@ class SensirionSB(QWidget):
             self.savingButton.setText("Start saving to file")
 
     def append_to_csv(self, temperature, humidity, concentration, analog1, analog2):
-        self.csvFile = open(self.csvFile.name, 'a')
         self.csvFile.write("{},{},{},{},{},{}\n".format(temperature, humidity, concentration, analog1, analog2,
                                                         datetime.now().strftime("%Y/%m/%d-%H:%M:%S")))
-        self.csvFile.close()
+
+    # Write a batch of bridge samples. The sensors sample at their own intervals, so every sample gets a row of its own
+    # with the columns of the other sensor left empty, and the analog inputs (read once per batch) get one too.
+    # Each sensor's timestamps are counted back from now by its own interval, its newest sample taken now
+    def append_batch_to_csv(self, temperatures, humidities, concentrations, analog1, analog2):
+        now = datetime.now()
+        rows = [(now, f",,,{analog1},{analog2}")]
+        rows += [(timestamp, f"{temperature},{humidity},,,") for timestamp, temperature, humidity in
+                 zip(self.batch_timestamps(now, len(temperatures), self.sht85device.repeatedInterval),
+                     temperatures, humidities)]
+        rows += [(timestamp, f",,{concentration},,") for timestamp, concentration in
+                 zip(self.batch_timestamps(now, len(concentrations), self.stc31device.repeatedInterval),
+                     concentrations)]
+        rows.sort(key=lambda row: row[0])
+        self.csvFile.write("".join(f"{values},{timestamp.strftime('%Y/%m/%d-%H:%M:%S.%f')}\n"
+                                   for timestamp, values in rows))
+
+    # Times of `count` samples taken every `interval` seconds, the newest one at `now`.
+    # Without an interval (the repeated transceive was stopped meanwhile) all of them are stamped `now`
+    @staticmethod
+    def batch_timestamps(now, count, interval):
+        step = timedelta(seconds=interval if interval is not None else 0)
+        return [now - (count - 1 - i) * step for i in range(count)]
 
     def update_devices(self, values):
         self.portLabel.setText(f"Serial port: {values['port']}")
@@ -516,6 +913,9 @@ class SensirionSB(QWidget):
             slave_address=values['address'])
         self.sht85device = SHT85(self.device, SensirionSensor.PORTS[self.sht85PortDropdown.currentText()])
         self.stc31device = STC31(self.device, SensirionSensor.PORTS[self.stc31PortDropdown.currentText()])
+        self.compensator = STC31Compensator(self.stc31device)
+        self.update_compensation_settings()
+        self.start_bring_up({self.sht85device.bridgePort, self.stc31device.bridgePort})
 
     def update_ssb_group(self):
         if self.ssbGroup.isChecked():
@@ -524,11 +924,25 @@ class SensirionSB(QWidget):
             # if unsuccessful, disable the group
             if dg.exec_() == 0:
                 self.ssbGroup.setChecked(False)
+            elif self.bridgeSamplingEnabled:
+                self.timer.start(self.BRIDGE_DRAIN_INTERVAL)
             else:
                 self.timer.start(int(60 * 1000 * float(self.intervalEdit.text())))
         else:
             # Stop all timers, disconnect device to free up serial port
             self.timer.stop()
+            self.bringUp.cancel()
+            self.bringUpLabel.setText("Devices: not connected")
+            self.portOnePowerButton.setEnabled(True)
+            self.portTwoPowerButton.setEnabled(True)
+            if self.device is not None:
+                try:
+                    self.device.stop_repeated_i2c_transceive()
+                except Exception:
+                    pass
+            if self.compensator is not None:
+                self.compensator.close()
+                self.compensator = None
             self.device = None
             self.sht85device = None
             self.stc31device = None
@@ -594,6 +1008,16 @@ class CombinedPlot(QWidget):
         elif controllerN == 4:
             self.buffer4.append(sample)
         
+        self.redraw()
+
+    # Add the samples of a high-rate batch, redrawing the plot only once
+    def update_plot_batch(self, controllerN: int, samples):
+        buffer = [self.buffer1, self.buffer2, self.buffer3, self.buffer4][controllerN - 1]
+        buffer.extend(samples[-buffer.maxlen:])
+        self.plot.clear()
+        self.redraw()
+
+    def redraw(self):
         self.plot.plot(self.buffer1, pen=self.PLOT_PENS[0], symbolPen=self.PLOT_PENS[0], symbol='o', symbolSize=5, name="Controller 1")
         self.plot.plot(self.buffer2, pen=self.PLOT_PENS[1], symbolPen=self.PLOT_PENS[1], symbol='o', symbolSize=5, name="Controller 2")
         self.plot.plot(self.buffer3, pen=self.PLOT_PENS[2], symbolPen=self.PLOT_PENS[2], symbol='o', symbolSize=5, name="Controller 3")
@@ -638,6 +1062,8 @@ class GlobalTab(QWidget):
 
         self.brooks = brooksObject
         self.tabs = controllerTabs
+        # Sensor Bridge panel, created with the middle column
+        self.sensorBridge = None
 
         self.saving1Checkbox = QCheckBox("Controller 1")
         self.saving2Checkbox = QCheckBox("Controller 2")
@@ -663,6 +1089,13 @@ class GlobalTab(QWidget):
 
         self.saveCsvButton = None
         self.dosingControlButton = None
+        self.dosingProfileButton = None
+        self.dosingDryRunButton = None
+        # Runs the selected controllers' dosing processes on one timeline, None while no simultaneous dosing runs
+        self.dosingCoordinator = None
+        # True from starting the simultaneous dosing until it is stopped or all its processes have ended
+        self.dosingRunning = False
+        self.dosingSkewLabel = QLabel()
 
         errorImage = QPixmap(":/error.png")
 
@@ -688,21 +1121,25 @@ class GlobalTab(QWidget):
             self.tabs[0].dosingSignal.connect(self.update_dosing1)
             self.tabs[0].savingSignal.connect(self.update_saving1)
             self.tabs[0].sampleReady.connect(self.combinedPlotWidget.update_plot)
+            self.tabs[0].sampleBatchReady.connect(self.combinedPlotWidget.update_plot_batch)
 
         if self.tabs[1] is not None:
             self.tabs[1].dosingSignal.connect(self.update_dosing2)
             self.tabs[1].savingSignal.connect(self.update_saving2)
             self.tabs[1].sampleReady.connect(self.combinedPlotWidget.update_plot)
+            self.tabs[1].sampleBatchReady.connect(self.combinedPlotWidget.update_plot_batch)
             
         if self.tabs[2] is not None:
             self.tabs[2].dosingSignal.connect(self.update_dosing3)
             self.tabs[2].savingSignal.connect(self.update_saving3)
             self.tabs[2].sampleReady.connect(self.combinedPlotWidget.update_plot)
+            self.tabs[2].sampleBatchReady.connect(self.combinedPlotWidget.update_plot_batch)
             
         if self.tabs[3] is not None:
             self.tabs[3].dosingSignal.connect(self.update_dosing4)
             self.tabs[3].savingSignal.connect(self.update_saving4)
             self.tabs[3].sampleReady.connect(self.combinedPlotWidget.update_plot)
+            self.tabs[3].sampleBatchReady.connect(self.combinedPlotWidget.update_plot_batch)
             
         masterLayout = QGridLayout()
         masterLayout.addLayout(self.create_left_column(self.tabs), 0, 0)
@@ -764,6 +1201,15 @@ class GlobalTab(QWidget):
 
     # Dosing requires valid vectors for all controllers in the program
     def update_checkboxes_dosing(self):
+        # While a simultaneous dosing runs, the button stops it
+        if self.dosingRunning and (self.dosingCoordinator is not None or any([self.dosing1Enabled, self.dosing2Enabled,
+                                                                              self.dosing3Enabled, self.dosing4Enabled])):
+            self.dosingControlButton.setEnabled(True)
+            self.dosingInfoLabel.setVisible(False)
+            self.dosingErrorLabel.setVisible(False)
+            return
+        self.dosingRunning = False
+
         enabled = any([box.isChecked() for box in self.dosingCheckboxes]) and not any([self.dosing1Enabled,
                                                                                        self.dosing2Enabled,
                                                                                        self.dosing3Enabled,
@@ -777,6 +1223,8 @@ class GlobalTab(QWidget):
             self.dosing2Checkbox.setEnabled(self.tabs[1] is not None)
             self.dosing3Checkbox.setEnabled(self.tabs[2] is not None)
             self.dosing4Checkbox.setEnabled(self.tabs[3] is not None)
+            self.dosingProfileButton.setEnabled(True)
+            self.dosingDryRunButton.setEnabled(True)
 
             self.dosingControlButton.setText("Start dosing processes")
             self.dosingControlButton.clicked.disconnect()
@@ -823,34 +1271,114 @@ class GlobalTab(QWidget):
         if self.saving4Checkbox.isChecked():
             self.tabs[3].save_to_csv_stop()
 
+    # The selected controllers' processes are prepared by their tabs and run together by one coordinator,
+    # so they share a single start time and simultaneous setpoint changes are sent in one burst.
+    # Processes with volume steps have no timeline, their tabs start them right away
     def start_dosing(self):
+        self.dosingRunning = True
         for box in self.dosingCheckboxes:
             box.setEnabled(False)
+        self.dosingProfileButton.setEnabled(False)
+        self.dosingDryRunButton.setEnabled(False)
         self.dosingControlButton.setText("Stop dosing processes")
+        self.dosingControlButton.clicked.disconnect()
         self.dosingControlButton.clicked.connect(self.stop_dosing)
 
-        if self.dosing1Checkbox.isChecked():
-            self.tabs[0].dosingControlButton.setChecked(True)
-            self.tabs[0].update_dosing_state()
-        if self.dosing2Checkbox.isChecked():
-            self.tabs[1].dosingControlButton.setChecked(True)
-            self.tabs[1].update_dosing_state()
-        if self.dosing3Checkbox.isChecked():
-            self.tabs[2].dosingControlButton.setChecked(True)
-            self.tabs[2].update_dosing_state()
-        if self.dosing4Checkbox.isChecked():
-            self.tabs[3].dosingControlButton.setChecked(True)
-            self.tabs[3].update_dosing_state()
+        schedulers = []
+        for box, tab in zip(self.dosingCheckboxes, self.tabs):
+            if box.isChecked():
+                tab.start_dosing_process(coordinated=True)
+                if isinstance(tab.dosingScheduler, DosingScheduler):
+                    schedulers.append(tab.dosingScheduler)
+
+        self.dosingCoordinator = DosingCoordinator(self.brooks.get_bus_lock(), schedulers)
+        self.dosingCoordinator.eventFinished.connect(self.update_dosing_skew)
+        self.dosingCoordinator.finished.connect(self.end_dosing)
+        self.dosingSkewLabel.setText("Channel skew: waiting for a simultaneous change")
+        self.dosingCoordinator.start()
+        self.update_checkboxes_dosing()
+
+    # Load dosing profiles from a CSV or JSON file into the controllers' tabs. Profiles for given channels
+    # select those controllers, a profile without a channel goes to every selected controller
+    def load_dosing_profiles(self):
+        filename, _ = QFileDialog.getOpenFileName(self, "Load dosing profiles", "", "Dosing profiles (*.csv *.json)")
+        if filename == '':
+            return
+        try:
+            profiles = load_profiles(filename)
+            for channel in profiles:
+                if channel is not None and self.tabs[channel - 1] is None:
+                    raise ValueError(f"Controller {channel} is not connected")
+        except ValueError as e:
+            errorMessage = QErrorMessage(self)
+            errorMessage.setWindowIcon(QIcon(':/icon.png'))
+            errorMessage.setWindowTitle("Error")
+            errorMessage.showMessage(f"Loading the dosing profiles failed: {e}")
+            errorMessage.exec_()
+            return
+
+        if None not in profiles:
+            for box, tab in zip(self.dosingCheckboxes, self.tabs):
+                box.setChecked(tab is not None and tab.controller.channel in profiles)
+        for box, tab in zip(self.dosingCheckboxes, self.tabs):
+            if box.isChecked():
+                tab.set_dosing_profile(profiles.get(tab.controller.channel, profiles.get(None)))
+        self.update_checkboxes_dosing()
+
+    # Dry run of the selected controllers' processes, each tab draws its expected flow and the combined
+    # figures are shown here. Flows are added as they are, so they should be in the same units
+    def dry_run_dosing(self):
+        simulations = {}
+        for box, tab in zip(self.dosingCheckboxes, self.tabs):
+            if box.isChecked():
+                simulation = tab.dry_run_dosing()
+                if simulation is None:
+                    return
+                simulations[tab.controller.channel] = simulation
+        if len(simulations) == 0:
+            return
+
+        peak, end = combine_simulations(list(simulations.values()))
+        volumes = ', '.join(f"{channel}: {simulation.totalVolume:.2f}" for channel, simulation in simulations.items())
+        self.dosingSkewLabel.setText(f"Dry run: peak combined flow {peak:.2f}, end after {end / 60:.1f} minutes")
+        self.dosingSkewLabel.setToolTip(f"Volume per controller - {volumes}")
+
+    def update_dosing_skew(self, event, skew):
+        self.dosingSkewLabel.setText(f"Channel skew: {1000 * skew:.1f} ms, {self.dosingCoordinator.summary()}")
+
+    # Log the skew record of the finished or stopped simultaneous dosing, the tabs end their own processes
+    def end_dosing(self):
+        if self.dosingCoordinator is None:
+            return
+        self.dosingCoordinator.stop()
+        summary = self.dosingCoordinator.summary()
+        print(f"Simultaneous dosing: {summary}")
+        self.dosingSkewLabel.setText(f"Last process: {summary}")
+        for scheduler in self.dosingCoordinator.schedulers:
+            tab = self.tabs[scheduler.controller.channel - 1]
+            if tab.csvFile is not None:
+                tab.csvFile.write('\n')
+                self.dosingCoordinator.write_record(tab.csvFile)
+                tab.csvFile.write('\n')
+        self.dosingCoordinator = None
+        self.update_checkboxes_dosing()
 
     def stop_dosing(self):
         self.dosing1Checkbox.setEnabled(self.tabs[0] is not None)
         self.dosing2Checkbox.setEnabled(self.tabs[1] is not None)
         self.dosing3Checkbox.setEnabled(self.tabs[2] is not None)
         self.dosing4Checkbox.setEnabled(self.tabs[3] is not None)
+        self.dosingProfileButton.setEnabled(True)
+        self.dosingDryRunButton.setEnabled(True)
+        self.dosingRunning = False
 
         self.dosingControlButton.setText("Start dosing processes")
+        self.dosingControlButton.clicked.disconnect()
         self.dosingControlButton.clicked.connect(self.start_dosing)
 
+        # Stop the coordinator first, so no setpoint is written after the tabs end their processes
+        self.end_dosing()
+
         if self.dosing1Checkbox.isChecked():
             self.tabs[0].dosingControlButton.setChecked(False)
             self.tabs[0].update_dosing_state()
@@ -961,7 +1489,15 @@ class GlobalTab(QWidget):
         layout = QHBoxLayout()
         self.dosingControlButton = QPushButton("Start dosing processes")
         self.dosingControlButton.clicked.connect(self.start_dosing)
+        self.dosingProfileButton = QPushButton("Load profiles")
+        self.dosingProfileButton.clicked.connect(self.load_dosing_profiles)
+        self.dosingDryRunButton = QPushButton("Dry run")
+        self.dosingDryRunButton.setToolTip("Show the expected flow of the selected controllers' dosing processes")
+        self.dosingDryRunButton.clicked.connect(self.dry_run_dosing)
+        layout.addWidget(self.dosingDryRunButton, alignment=Qt.AlignTop)
+        layout.addWidget(self.dosingProfileButton, alignment=Qt.AlignTop)
         layout.addWidget(self.dosingControlButton, alignment=Qt.AlignTop)
+        layout.setStretch(2, 10)
         dosingLayout.addLayout(layout)
 
         layout = QHBoxLayout()
@@ -973,8 +1509,11 @@ class GlobalTab(QWidget):
         dosingLayout.addLayout(layout)
         dosingLayout.setStretch(1, 10)
 
+        self.dosingSkewLabel.setText("Channel skew: no simultaneous dosing yet")
+        dosingLayout.addWidget(self.dosingSkewLabel)
+
         dosingGroup.setLayout(dosingLayout)
-        dosingGroup.setFixedSize(405, 103)
+        dosingGroup.setFixedSize(405, 125)
 
         leftColumnLayout.addWidget(dosingGroup, alignment=Qt.AlignTop)
 
@@ -1000,6 +1539,7 @@ class GlobalTab(QWidget):
 
     def create_middle_column(self):
         middleColumnLayout = QVBoxLayout()
-        middleColumnLayout.addWidget(SensirionSB())
+        self.sensorBridge = SensirionSB(self.tabs)
+        middleColumnLayout.addWidget(self.sensorBridge)
 
         return middleColumnLayout
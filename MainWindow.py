@@ -1,7 +1,9 @@
 from PyQt5.QtGui import QIcon
 from ControllerGUITab import ControllerGUITab
 from Brooks025X import Brooks025X
+from BrooksTransport import BrooksTransport
 from GlobalTab import GlobalTab
+from DiagnosticsTab import DiagnosticsTab
 from PyQt5.QtWidgets import (
     QVBoxLayout,
     QWidget,
@@ -19,7 +21,7 @@ class MainWindow(QWidget):
         self.setWindowTitle("FlowController by Mirosław Wiącek")
         self.setMinimumSize(900, 730)
 
-        brooks = Brooks025X(pyvisaConnection, controllers)
+        brooks = Brooks025X(BrooksTransport(pyvisaConnection), controllers)
 
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -54,6 +56,8 @@ class MainWindow(QWidget):
         else:
             tabReferences.append(None)
 
-        tabs.addTab(GlobalTab(brooks, tabReferences), "Global controls")
+        globalTab = GlobalTab(brooks, tabReferences)
+        tabs.addTab(globalTab, "Global controls")
+        tabs.addTab(DiagnosticsTab(tabReferences, globalTab.sensorBridge), "Diagnostics")
         layout.addWidget(tabs)
 
@@ -1,9 +1,10 @@
 from PyQt5 import QtCore
-from PyQt5.QtCore import pyqtSignal, QTimer
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QDialog, QFormLayout, QPushButton, QLineEdit, QComboBox, QCheckBox
 import pyvisa
 import sys
+from Scheduler import ScheduledTimer
 import resources
 
 
@@ -71,7 +72,7 @@ class MasterControllerConfigDialog(QDialog):
         self.buttonCancel = QPushButton("Cancel")
         self.buttonCancel.clicked.connect(self.cancel_pressed)
 
-        self.timer = QTimer()
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_BACKGROUND)
         self.timer.timeout.connect(self.refresh_devices)
         self.timer.start(1000)
 
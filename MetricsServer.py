@@ -0,0 +1,155 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Diagnostics import BusDiagnostics, all_buses
+
+
+# Prometheus text format metrics of the acquisition, served over HTTP on localhost only.
+# The server runs in its own thread and never touches Qt objects or takes a lock used by the acquisition:
+# the tabs keep their counters in plain attributes, and the histograms are read from copies (see Diagnostics),
+# so a scrape can not stall the GUI or a bus, and a busy GUI does not delay a scrape
+class MetricsServer:
+    HOST = "127.0.0.1"
+    DEFAULT_PORT = 9101
+    QUANTILES = [0.5, 0.9, 0.99, 0.999]
+    OUTCOMES = {
+        BusDiagnostics.OK: "ok",
+        BusDiagnostics.ERROR: "error",
+        BusDiagnostics.TIMEOUT: "timeout",
+        BusDiagnostics.UNEXPECTED: "unexpected"
+    }
+
+    # `tabs` are the controller tabs (None for channels that are not used),
+    # `guiLag` is the LatencyHistogram of the event loop lag, `sensorBridge` the Sensor Bridge panel if there is one.
+    # Raises OSError if the port can not be bound
+    def __init__(self, tabs, guiLag, port=DEFAULT_PORT, sensorBridge=None):
+        self.tabs = [tab for tab in tabs if tab is not None]
+        self.guiLag = guiLag
+        self.sensorBridge = sensorBridge
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes would flood the console
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((self.HOST, port), Handler)
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="Metrics server", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    # Quantiles, sum and count of a histogram, `labels` are the other labels of the series as 'name="value"'
+    @staticmethod
+    def summary(lines, name, histogram, labels=""):
+        for quantile in MetricsServer.QUANTILES:
+            value = MetricsServer.value(histogram.percentile(100 * quantile))
+            lines.append(f'{name}{{{labels + "," if labels else ""}quantile="{quantile}"}} {value}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {histogram.total}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+
+    @staticmethod
+    def value(value):
+        return "NaN" if value is None else float(value)
+
+    # Label values are free text (sensor commands), quotes and backslashes are escaped
+    @staticmethod
+    def label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self):
+        lines = []
+
+        counters = [
+            ("flowcontroller_samples_total", "Samples acquired from the controller", "samplesAcquired"),
+            ("flowcontroller_polls_dropped_total", "Polls that returned no valid measurement", "droppedPolls"),
+            ("flowcontroller_polls_late_total", "Polls that came late by more than half an interval", "latePolls")
+        ]
+        for name, description, attribute in counters:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for tab in self.tabs:
+                lines.append(f'{name}{{channel="{tab.controller.channel}"}} {getattr(tab, attribute)}')
+
+        # Lines received from the serial sensors of every tab, a reconfigured sensor starts counting from 0 again
+        lines.append("# HELP flowcontroller_sensor_samples_total Lines received from the serial sensors")
+        lines.append("# TYPE flowcontroller_sensor_samples_total counter")
+        for tab in self.tabs:
+            for number, sensor in [(1, tab.sensor1), (2, tab.sensor2)]:
+                if sensor is not None:
+                    lines.append(f'flowcontroller_sensor_samples_total{{channel="{tab.controller.channel}",'
+                                 f'sensor="{number}"}} {sensor.received}')
+        if self.sensorBridge is not None:
+            lines.append("# HELP flowcontroller_bridge_samples_total Samples acquired from the Sensor Bridge sensors")
+            lines.append("# TYPE flowcontroller_bridge_samples_total counter")
+            lines.append(f'flowcontroller_bridge_samples_total{{sensor="SHT85"}} {self.sensorBridge.sht85Samples}')
+            lines.append(f'flowcontroller_bridge_samples_total{{sensor="STC31"}} {self.sensorBridge.stc31Samples}')
+
+        lines.append("# HELP flowcontroller_pv Last measured process value")
+        lines.append("# TYPE flowcontroller_pv gauge")
+        for tab in self.tabs:
+            lines.append(f'flowcontroller_pv{{channel="{tab.controller.channel}"}} {self.value(tab.lastPV)}')
+        lines.append("# HELP flowcontroller_setpoint Last setpoint the device confirmed")
+        lines.append("# TYPE flowcontroller_setpoint gauge")
+        for tab in self.tabs:
+            lines.append(f'flowcontroller_setpoint{{channel="{tab.controller.channel}"}} {self.value(tab.setpoint)}')
+
+        lines.append("# HELP flowcontroller_csv_queue_depth Writes waiting for the CSV writer thread")
+        lines.append("# TYPE flowcontroller_csv_queue_depth gauge")
+        for tab in self.tabs:
+            csvFile = tab.csvFile
+            depth = csvFile.queue_depth() if csvFile is not None else 0
+            lines.append(f'flowcontroller_csv_queue_depth{{channel="{tab.controller.channel}"}} {depth}')
+        lines.append("# HELP flowcontroller_csv_written_bytes_total Bytes written to CSV files")
+        lines.append("# TYPE flowcontroller_csv_written_bytes_total counter")
+        for tab in self.tabs:
+            lines.append(f'flowcontroller_csv_written_bytes_total{{channel="{tab.controller.channel}"}} '
+                         f'{tab.csvBytes.total}')
+
+        lines.append("# HELP flowcontroller_command_latency_seconds Round trip time of bus commands")
+        lines.append("# TYPE flowcontroller_command_latency_seconds summary")
+        buses = [(bus, bus.snapshot()) for bus in all_buses()]
+        for bus, commands in buses:
+            for command, histogram, outcomes in commands:
+                self.summary(lines, "flowcontroller_command_latency_seconds", histogram,
+                             f'bus="{self.label(bus.name)}",command="{self.label(command)}"')
+        lines.append("# HELP flowcontroller_commands_total Bus commands by outcome")
+        lines.append("# TYPE flowcontroller_commands_total counter")
+        for bus, commands in buses:
+            for command, histogram, outcomes in commands:
+                for outcome, name in self.OUTCOMES.items():
+                    lines.append(f'flowcontroller_commands_total{{bus="{self.label(bus.name)}",'
+                                 f'command="{self.label(command)}",outcome="{name}"}} {outcomes[outcome]}')
+        lines.append("# HELP flowcontroller_bus_queue_wait_seconds Time commands waited for the bus, by priority")
+        lines.append("# TYPE flowcontroller_bus_queue_wait_seconds summary")
+        for bus, commands in buses:
+            for priority, histogram in bus.wait_snapshot():
+                self.summary(lines, "flowcontroller_bus_queue_wait_seconds", histogram,
+                             f'bus="{self.label(bus.name)}",priority="{self.label(priority)}"')
+        lines.append("# HELP flowcontroller_bus_utilization Share of time the bus spent on commands")
+        lines.append("# TYPE flowcontroller_bus_utilization gauge")
+        for bus, commands in buses:
+            lines.append(f'flowcontroller_bus_utilization{{bus="{self.label(bus.name)}"}} {bus.utilization()}')
+
+        lines.append("# HELP flowcontroller_gui_lag_seconds Delay of GUI timer events")
+        lines.append("# TYPE flowcontroller_gui_lag_seconds summary")
+        self.summary(lines, "flowcontroller_gui_lag_seconds", self.guiLag)
+
+        return "\n".join(lines) + "\n"
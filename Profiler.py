@@ -0,0 +1,150 @@
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from PyQt5.QtCore import QTimer
+from Diagnostics import LatencyHistogram
+from Scheduler import Scheduler
+
+
+# Opt-in profiler of the GUI event loop, started and stopped from the GUI thread.
+# Every Python function the event loop calls directly (timer slots, signal handlers, overridden Qt methods
+# like paint events) is a callback. A profile hook set for the GUI thread only times each of them,
+# anything they call is counted in their time. The scheduler only dispatches timeouts, so the slots it calls
+# are the callbacks instead of its tick. Callbacks running a nested event loop (modal dialogs)
+# include the time the dialog was open.
+# A watchdog thread checks a heartbeat timer of the event loop, and when it falls more than `stallThreshold`
+# seconds behind, it captures the stack of the GUI thread, showing where it is blocked.
+# The stalls are kept for the report, the diagnostics tab shows the last one
+class Profiler:
+    STALL_THRESHOLD = 0.25
+    # Milliseconds
+    HEARTBEAT_INTERVAL = 50
+    MAX_STALLS = 50
+    # Functions that only call other callbacks, the calls to their own module are not callbacks
+    DISPATCHERS = [Scheduler.tick.__code__]
+
+    def __init__(self, stallThreshold=STALL_THRESHOLD):
+        self.stallThreshold = stallThreshold
+        # Callback name -> LatencyHistogram of its execution times
+        self.callbacks = {}
+        # (time, duration in seconds, callback name, stack) of the last stalls, appended by the watchdog thread
+        self.stalls = deque(maxlen=self.MAX_STALLS)
+        self.startTime = None
+        self.stopTime = None
+
+        # Name of the running callback, None between callbacks. Read by the watchdog thread
+        self.current = None
+        self.__depth = 0
+        # Depth of the callbacks, 1 inside a dispatcher
+        self.__base = 0
+        self.__dispatcherFile = None
+        self.__start = None
+        self.__names = {}
+
+        self.heartbeat = None
+        self.__heartbeatTimer = QTimer()
+        self.__heartbeatTimer.timeout.connect(self.beat)
+        self.__guiThread = None
+        self.__stopEvent = threading.Event()
+        self.__watchdog = threading.Thread(target=self.__watch, name="Event loop watchdog", daemon=True)
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.heartbeat = self.startTime
+        self.__guiThread = threading.get_ident()
+        self.__heartbeatTimer.start(self.HEARTBEAT_INTERVAL)
+        self.__watchdog.start()
+        sys.setprofile(self.__profile)
+
+    def stop(self):
+        sys.setprofile(None)
+        self.__heartbeatTimer.stop()
+        self.__stopEvent.set()
+        self.__watchdog.join()
+        self.stopTime = time.monotonic()
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+
+    # Class and function of a callback, cached by code and class since it is looked up for every call
+    def __name(self, frame):
+        owner = frame.f_locals.get('self')
+        key = (frame.f_code, type(owner))
+        if key not in self.__names:
+            if owner is not None:
+                self.__names[key] = f"{type(owner).__name__}.{frame.f_code.co_name}"
+            else:
+                self.__names[key] = f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+        return self.__names[key]
+
+    def __profile(self, frame, event, arg):
+        if event == 'call':
+            if self.__depth == self.__base:
+                if self.__depth == 0 and frame.f_code in self.DISPATCHERS:
+                    self.__base = 1
+                    self.__dispatcherFile = frame.f_code.co_filename
+                elif self.__base == 0 or frame.f_code.co_filename != self.__dispatcherFile:
+                    self.current = self.__name(frame)
+                    self.__start = time.perf_counter()
+            self.__depth += 1
+        elif event == 'return':
+            # Returns of the functions running when profiling started are not counted
+            if self.__depth == 0:
+                return
+            self.__depth -= 1
+            if self.__depth < self.__base:
+                self.__base = 0
+            elif self.__depth == self.__base and self.current is not None:
+                elapsed = time.perf_counter() - self.__start
+                if frame.f_code is not Profiler.beat.__code__:
+                    if self.current not in self.callbacks:
+                        self.callbacks[self.current] = LatencyHistogram()
+                    self.callbacks[self.current].record(elapsed)
+                self.current = None
+
+    def __watch(self):
+        stalled = None
+        while not self.__stopEvent.wait(self.stallThreshold / 4):
+            heartbeat = self.heartbeat
+            late = time.monotonic() - heartbeat - self.HEARTBEAT_INTERVAL / 1000
+            if stalled is None and late > self.stallThreshold:
+                frame = sys._current_frames().get(self.__guiThread)
+                stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                stalled = (datetime.now(), heartbeat, self.current, stack)
+            elif stalled is not None and heartbeat != stalled[1]:
+                duration = heartbeat - stalled[1] - self.HEARTBEAT_INTERVAL / 1000
+                self.stalls.append((stalled[0], duration, stalled[2], stalled[3]))
+                stalled = None
+
+    # Time spent in callbacks, as a share of the time profiled
+    def busy_share(self):
+        elapsed = (self.stopTime or time.monotonic()) - self.startTime
+        if elapsed <= 0:
+            return 0.0
+        return sum(histogram.total for histogram in self.callbacks.values()) / elapsed
+
+    def summary(self):
+        return f"{len(self.callbacks)} callbacks, event loop busy {100 * self.busy_share():.1f}%, " \
+               f"{len(self.stalls)} stalls"
+
+    # Text report: the callbacks sorted by their total time, then the stalls with the GUI thread's stack
+    def report(self):
+        elapsed = (self.stopTime or time.monotonic()) - self.startTime
+        lines = [f"Profiled for {elapsed:.1f} s, {self.summary()}", "",
+                 f"{'Callback':<48} {'Calls':>8} {'Total s':>9} {'Share':>7} {'Mean ms':>9} {'p99 ms':>9} "
+                 f"{'Max ms':>9}"]
+        for name, histogram in sorted(self.callbacks.items(), key=lambda item: item[1].total, reverse=True):
+            lines.append(f"{name:<48} {histogram.count:>8} {histogram.total:>9.3f} "
+                         f"{100 * histogram.total / elapsed:>6.1f}% {1000 * histogram.mean():>9.2f} "
+                         f"{1000 * histogram.percentile(99):>9.2f} {1000 * histogram.max:>9.2f}")
+
+        lines.append("")
+        lines.append(f"Stalls longer than {1000 * self.stallThreshold:.0f} ms: {len(self.stalls)}")
+        for when, duration, callback, stack in list(self.stalls):
+            lines.append("")
+            lines.append(f"{when.strftime('%Y/%m/%d %H:%M:%S')} blocked for {1000 * duration:.0f} ms in {callback}")
+            lines.append(stack.rstrip('\n'))
+        return "\n".join(lines) + "\n"
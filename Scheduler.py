@@ -0,0 +1,146 @@
+import math
+import time
+import weakref
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+
+# Drop-in replacement of QTimer (timeout signal, start, stop, setInterval, interval, isActive, setSingleShot)
+# whose timeouts are dispatched by the global Scheduler instead of a timer of its own.
+# Lower priorities run first when several timers are due in the same cycle. Precise timers are never run early,
+# and make the scheduler use a precise Qt timer when they are next
+class ScheduledTimer(QObject):
+    timeout = pyqtSignal()
+
+    PRIORITY_IO = 0
+    PRIORITY_DISPLAY = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, priority=PRIORITY_DISPLAY, precise=False):
+        super().__init__()
+        self.priority = priority
+        self.precise = precise
+        self.singleShot = False
+        self.deadline = None
+        # Set when the timer was picked for a cycle, cleared when it is dispatched, stopped or restarted
+        self.pending = False
+        self.__interval = 0
+
+    def setSingleShot(self, singleShot):
+        self.singleShot = singleShot
+
+    def setInterval(self, msec):
+        self.__interval = int(msec)
+        # Like QTimer, an active timer is restarted with the new interval
+        if self.isActive():
+            self.start()
+
+    def interval(self):
+        return self.__interval
+
+    def isActive(self):
+        return self.deadline is not None
+
+    def start(self, msec=None):
+        if msec is not None:
+            self.__interval = int(msec)
+        self.pending = False
+        get_scheduler().add(self)
+
+    def stop(self):
+        self.deadline = None
+        self.pending = False
+        get_scheduler().remove(self)
+
+
+# Dispatches the timeouts of all ScheduledTimers from a single single-shot QTimer, armed for the earliest deadline.
+# Periodic timers are aligned to multiples of their interval from a common epoch, so timers with the same interval
+# (the polls of all tabs, the one second label updates) come due together. Timers due within COALESCE_WINDOW
+# (and COALESCE_FRACTION of their interval) of a cycle are run in it, ordered by priority, so a cycle does
+# all its bus I/O first and then updates the display
+class Scheduler(QObject):
+    COALESCE_WINDOW = 0.05
+    COALESCE_FRACTION = 0.05
+
+    def __init__(self):
+        super().__init__()
+        self.epoch = time.monotonic()
+        # Weak references, a timer that is garbage collected (with its dialog) simply disappears like a QTimer
+        self.__timers = []
+        self.__timer = QTimer()
+        self.__timer.setSingleShot(True)
+        self.__timer.timeout.connect(self.tick)
+
+        # Statistics
+        self.cycles = 0
+        self.dispatches = 0
+
+    def add(self, timer):
+        now = time.monotonic()
+        interval = timer.interval() / 1000
+        if timer.singleShot or interval <= 0:
+            timer.deadline = now + interval
+        else:
+            # The grid point nearest to a full interval from now, never sooner than half an interval
+            timer.deadline = self.epoch + round((now + interval - self.epoch) / interval) * interval
+        if all(reference() is not timer for reference in self.__timers):
+            self.__timers.append(weakref.ref(timer))
+        self.__arm()
+
+    def remove(self, timer):
+        self.__timers = [reference for reference in self.__timers if reference() not in (None, timer)]
+        self.__arm()
+
+    def active_timers(self):
+        timers = [reference() for reference in self.__timers]
+        return [timer for timer in timers if timer is not None and timer.isActive()]
+
+    def __window(self, timer):
+        if timer.precise:
+            return 0.0
+        return min(self.COALESCE_WINDOW, self.COALESCE_FRACTION * timer.interval() / 1000)
+
+    def __arm(self):
+        timers = self.active_timers()
+        self.__timers = [weakref.ref(timer) for timer in timers]
+        if len(timers) == 0:
+            self.__timer.stop()
+            return
+        first = min(timers, key=lambda timer: timer.deadline)
+        self.__timer.setTimerType(Qt.PreciseTimer if first.precise else Qt.CoarseTimer)
+        self.__timer.start(max(int(math.ceil(1000 * (first.deadline - time.monotonic()))), 0))
+
+    def tick(self):
+        now = time.monotonic()
+        due = [timer for timer in self.active_timers() if timer.deadline <= now + self.__window(timer)]
+        due.sort(key=lambda timer: (timer.priority, timer.deadline))
+
+        # Next deadlines are set and the QTimer re-armed before dispatching, so a slot that runs a nested
+        # event loop (a modal dialog) does not hold up the other timers
+        for timer in due:
+            timer.pending = True
+            if timer.singleShot:
+                timer.deadline = None
+            else:
+                interval = timer.interval() / 1000
+                # Missed periods are skipped, not caught up
+                missed = max(math.floor((now - timer.deadline) / interval), 0) if interval > 0 else 0
+                timer.deadline += (missed + 1) * interval
+        self.__arm()
+
+        self.cycles += 1
+        for timer in due:
+            if timer.pending:
+                timer.pending = False
+                self.dispatches += 1
+                timer.timeout.emit()
+
+
+_scheduler = None
+
+
+# The scheduler of the GUI thread, created on first use
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
@@ -1,49 +1,265 @@
 import itertools
+import threading
+import time
+from datetime import datetime
 
 import numpy as np
 import serial
 from collections import deque
+from numpy_ringbuffer import RingBuffer
+from SensorParser import make_parser
+from Diagnostics import BusDiagnostics, get_bus
 
 
 # Class representing a sensor object that sends data in form of a string
 # over a serial connection. Optional header will be added to saved csv file
+# All communication with the port is done by a dedicated reader thread, so a silent sensor
+# can never block the caller. The thread polls the sensor every `interval` seconds and waits
+# at most `timeout` seconds for the response.
+# In streaming mode no command is sent, the thread reads lines as the sensor pushes them.
+# Buffer entries are (timestamp, line) tuples, timestamped when the data was received.
+# If a parser specification is given (see SensorParser.make_parser), every received batch of lines
+# is also converted to numeric columns, kept in ring buffers alongside POSIX timestamps
 class Sensor:
+    # Upper limit of a single read in streaming mode, only relevant when the sensor outpaces the thread
+    STREAM_CHUNK_LIMIT = 65536
+
     def __init__(self, comport='COM1', baudrate=9600, parity=serial.PARITY_NONE, databits=serial.EIGHTBITS,
-                 stopbits=serial.STOPBITS_ONE, dataHeader='', bufferSize=64, command=":MEAS?"):
+                 stopbits=serial.STOPBITS_ONE, dataHeader='', bufferSize=64, command=":MEAS?", interval=60.0,
+                 timeout=1.0, streaming=False, parser=None):
+        # Created first, so an invalid specification fails before the port is opened
+        self.parser = make_parser(parser)
         self.__serial = serial.Serial(baudrate=baudrate,
                                       parity=parity,
                                       bytesize=databits,
                                       stopbits=stopbits,
-                                      timeout=100,
+                                      timeout=timeout,
+                                      write_timeout=timeout,
                                       port=comport)
         self.header = dataHeader
         self.buffer = deque(maxlen=bufferSize)
         self.command = command
+        self.interval = interval
+        self.timeout = timeout
+        self.streaming = streaming
+
+        # Parsed numeric data, guarded by a lock since it is written by the reader thread
+        self.parseErrors = 0
+        self.__dataLock = threading.Lock()
+        self.__bufferSize = bufferSize
+        self.__timestamps = None
+        self.__columns = None
+        self.__create_column_buffers(bufferSize)
+
+        # Exchange statistics, written only by the reader thread
+        self.received = 0
+        self.requests = 0
+        self.timeouts = 0
+        self.lastLatency = None
+        self.maxLatency = 0.0
+        self.__totalLatency = 0.0
+        # Polls are also recorded in the diagnostics of the port, under the command
+        self.diagnostics = get_bus(f"Sensor {comport}")
+
+        # Exception that stopped the reader thread, None while it is running correctly
+        self.error = None
 
-    # Close serial connection
+        self.__stopEvent = threading.Event()
+        self.__wakeEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"Sensor reader {comport}", daemon=True)
+        self.__thread.start()
+
+    # Stop the reader thread and close serial connection
     def close(self):
+        self.__stopEvent.set()
+        self.__wakeEvent.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join(self.timeout + 1.0)
+
         if self.__serial.is_open:
             self.__serial.close()
         else:
             print(f"Tried to close port {self.__serial.port} when it was closed")
         return self.__serial.is_open
 
-    # This function reads all available data and saves it to the sensor buffer
+    # Change the polling interval (in seconds), takes effect immediately
+    def set_interval(self, value):
+        self.interval = value
+        self.__wakeEvent.set()
+
+    # Mean latency of successful exchanges, in seconds
+    def mean_latency(self):
+        successful = self.requests - self.timeouts
+        if successful == 0:
+            return None
+        return self.__totalLatency / successful
+
+    def __run(self):
+        try:
+            if self.streaming:
+                self.__stream()
+            else:
+                self.__poll()
+        except serial.SerialException as se:
+            self.error = se
+        except Exception as e:
+            # Any other failure (a broken parser) stops the thread too, the GUI has to learn about it
+            self.error = e
+
+    def __poll(self):
+        lastPoll = None
+        while not self.__stopEvent.is_set():
+            if lastPoll is not None:
+                remaining = lastPoll + self.interval - time.monotonic()
+                if remaining > 0:
+                    # Woken up early either by an interval change or by close(), re-evaluate the deadline
+                    self.__wakeEvent.wait(remaining)
+                    self.__wakeEvent.clear()
+                    continue
+
+            lastPoll = time.monotonic()
+            self.get_data()
+
+    # Read newline-delimited data as it arrives. Everything waiting in the OS buffer is read at once,
+    # decoded and split in bulk, so the cost per line stays low even for fast sensors.
+    # All lines from one read share the timestamp of that read
+    def __stream(self):
+        self.__serial.reset_input_buffer()
+        pending = b''
+        while not self.__stopEvent.is_set():
+            # Block (for at most the timeout) until at least one byte arrives, then take everything available
+            chunk = self.__serial.read(min(max(self.__serial.in_waiting, 1), self.STREAM_CHUNK_LIMIT))
+            if len(chunk) == 0:
+                continue
+            timestamp = datetime.now()
+
+            complete, separator, pending = (pending + chunk).rpartition(b'\n')
+            if len(separator) == 0:
+                continue
+
+            lines = [line.rstrip('\r') for line in complete.decode('utf-8', errors='replace').split('\n')]
+            self.buffer.extend((timestamp, line) for line in lines)
+            self.received += len(lines)
+            self.__parse(timestamp, lines)
+
+    # This function sends the command and saves the response to the sensor buffer
     # It assumes that data is passed as a newline-terminated string, and the interpretation is up to the user
+    # It is called from the reader thread; the whole exchange is bounded by the port timeout
     def get_data(self):
         assert self.__serial.is_open
-        self.__serial.write(f"{self.command}\n".encode())
-        response = self.__serial.readline()
-        if len(response) > 0:
-            self.buffer.append(response.decode('utf-8'))
+        self.__serial.reset_input_buffer()
+        start = time.monotonic()
+        try:
+            self.__serial.write(f"{self.command}\n".encode())
+            response = self.__serial.readline()
+        except serial.SerialException:
+            self.diagnostics.record(self.command, start, BusDiagnostics.ERROR)
+            raise
+        latency = time.monotonic() - start
+
+        self.requests += 1
+        # readline() returns an incomplete line (or nothing at all) only if the timeout has passed
+        if not response.endswith(b'\n'):
+            self.timeouts += 1
+            self.diagnostics.record(self.command, start, BusDiagnostics.TIMEOUT)
+            return
+        self.diagnostics.record(self.command, start)
+
+        self.received += 1
+        self.lastLatency = latency
+        self.maxLatency = max(self.maxLatency, latency)
+        self.__totalLatency += latency
+        # deque.append is atomic, so the buffer can be read from the GUI thread without locking
+        timestamp = datetime.now()
+        line = response.decode('utf-8', errors='replace').rstrip('\r\n')
+        self.buffer.append((timestamp, line))
+        self.__parse(timestamp, [line])
+
+    def __create_column_buffers(self, capacity):
+        if self.parser is None:
+            return
+        timestamps = RingBuffer(capacity=capacity, dtype=np.float64)
+        columns = {name: RingBuffer(capacity=capacity, dtype=np.float64) for name in self.parser.columns}
+        if self.__timestamps is not None:
+            timestamps.extend(np.array(self.__timestamps)[-capacity:])
+            for name in columns:
+                columns[name].extend(np.array(self.__columns[name])[-capacity:])
+        self.__timestamps = timestamps
+        self.__columns = columns
+
+    # Convert a batch of lines received at the same moment into numeric columns
+    def __parse(self, timestamp, lines):
+        if self.parser is None:
+            return
+        values, valid = self.parser.parse(lines)
+        count = int(np.count_nonzero(valid))
+        self.parseErrors += len(lines) - count
+        if count == 0:
+            return
+
+        # RingBuffer.extend() silently drops a batch longer than the capacity, so only the newest samples are kept
+        with self.__dataLock:
+            values = values[valid][-self.__bufferSize:]
+            self.__timestamps.extend(np.full(len(values), timestamp.timestamp()))
+            for i, name in enumerate(self.parser.columns):
+                self.__columns[name].extend(values[:, i])
+
+    # Snapshot of the parsed data: an array of POSIX timestamps and a dictionary of column name -> array
+    def get_columns(self):
+        if self.parser is None:
+            return None, {}
+        with self.__dataLock:
+            return np.array(self.__timestamps), {name: np.array(column) for name, column in self.__columns.items()}
+
+    # Most recent parsed value of a column, None if there is none
+    def last_value(self, name):
+        if self.parser is None or name not in self.parser.columns:
+            return None
+        with self.__dataLock:
+            column = self.__columns[name]
+            return float(column[len(column) - 1]) if len(column) > 0 else None
+
+    # Same as get_columns(), but also empties the column buffers, so consecutive calls never return the same sample
+    def drain_columns(self):
+        if self.parser is None:
+            return None, {}
+        with self.__dataLock:
+            timestamps = np.array(self.__timestamps)
+            columns = {name: np.array(column) for name, column in self.__columns.items()}
+            self.__timestamps = None
+            self.__create_column_buffers(self.__bufferSize)
+        return timestamps, columns
+
+    # Save parsed data in numpy binary format, returns False if there was nothing to save
+    def save_columns(self, filename, drain=True):
+        timestamps, columns = self.drain_columns() if drain else self.get_columns()
+        if timestamps is None or len(timestamps) == 0:
+            return False
+        np.savez(filename, timestamp=timestamps, **columns)
+        return True
+
+    # Remove and return all buffered samples. popleft() is atomic, so no sample appended
+    # by the reader thread in the meantime can be lost
+    def drain(self):
+        samples = []
+        try:
+            while True:
+                samples.append(self.buffer.popleft())
+        except IndexError:
+            return samples
 
     # function to change the amount of stored samples without losing previously gathered samples
     def change_buffer_size(self, value):
         if value > self.buffer.maxlen:
             newBuffer = deque(maxlen=value)
             newBuffer.extend(self.buffer)
+            self.buffer = newBuffer
 
         elif value < self.buffer.maxlen:
             newBuffer = deque(maxlen=value)
             newBuffer.extend(itertools.islice(self.buffer, np.clip(len(self.buffer) - value, 0, None), len(self.buffer)))
             self.buffer = newBuffer
+
+        with self.__dataLock:
+            self.__bufferSize = value
+            self.__create_column_buffers(value)
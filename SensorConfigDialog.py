@@ -1,9 +1,10 @@
 import serial
 from PyQt5 import QtCore
-from PyQt5.QtCore import QRegExp, pyqtSignal, QTimer
+from PyQt5.QtCore import QRegExp, pyqtSignal
 from PyQt5.QtGui import QRegExpValidator, QIcon
 from PyQt5.QtWidgets import QDialog, QFormLayout, QPushButton, QLineEdit, QComboBox
 from serial.tools.list_ports import comports
+from Scheduler import ScheduledTimer
 import resources
 
 
@@ -26,6 +27,10 @@ class SensorConfigDialog(QDialog):
             '6': serial.SIXBITS,
             '5': serial.FIVEBITS}
 
+    # Polling sends a command every sampling interval, streaming reads whatever the sensor pushes
+    modes = {'Polling': False,
+             'Streaming': True}
+
     # unlock OK only if all fields are set
     def unlock_ok(self):
         elements = [self.port.currentText(),
@@ -42,7 +47,9 @@ class SensorConfigDialog(QDialog):
                   'databits': self.data[self.databits.currentText()],
                   'paritybits': self.parity[self.paritybits.currentText()],
                   'stopbits': self.stop[self.stopbits.currentText()],
-                  'header': self.header.text()}
+                  'header': self.header.text(),
+                  'streaming': self.modes[self.mode.currentText()],
+                  'parser': self.parser.text()}
         self.accepted.emit(values)
         self.accept()
 
@@ -59,7 +66,7 @@ class SensorConfigDialog(QDialog):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Prepare dialog window, disable whatsthis
-        self.setFixedSize(280, 285)
+        self.setFixedSize(280, 345)
         self.setWindowIcon(QIcon(':/icon.png'))
         self.setWindowTitle("Configure serial device")
         self.setWindowFlags(QtCore.Qt.WindowSystemMenuHint | QtCore.Qt.WindowTitleHint)
@@ -89,6 +96,13 @@ class SensorConfigDialog(QDialog):
         self.header.setText("Sensor")
         self.header.textChanged.connect(self.unlock_ok)
 
+        self.mode = QComboBox()
+        self.mode.addItems(self.modes.keys())
+
+        # Optional, see SensorParser.make_parser for the format
+        self.parser = QLineEdit()
+        self.parser.setPlaceholderText("re:<pattern> or split:,:name=0,...")
+
         self.buttonOk = QPushButton("Connect")
         self.buttonOk.setEnabled(False)
         self.buttonOk.clicked.connect(self.ok_pressed)
@@ -96,7 +110,7 @@ class SensorConfigDialog(QDialog):
         self.buttonCancel = QPushButton("Cancel")
         self.buttonCancel.clicked.connect(self.cancel_pressed)
 
-        self.timer = QTimer()
+        self.timer = ScheduledTimer(ScheduledTimer.PRIORITY_BACKGROUND)
         self.timer.timeout.connect(self.refresh_devices)
         self.timer.start(1000)
 
@@ -107,5 +121,7 @@ class SensorConfigDialog(QDialog):
         form.addRow('Parity bits', self.paritybits)
         form.addRow('Stop bits', self.stopbits)
         form.addRow('Header', self.header)
+        form.addRow('Mode', self.mode)
+        form.addRow('Parser', self.parser)
         form.addRow('', self.buttonOk)
         form.addRow('', self.buttonCancel)
@@ -0,0 +1,124 @@
+import re
+import numpy as np
+
+
+# Parsers turning batches of text lines received from a Sensor into numeric columns.
+# parse() takes a list of lines and returns a (values, valid) pair, where values is a float64
+# array of shape (len(lines), len(columns)) and valid is a boolean mask of lines that parsed correctly.
+# Work is done per batch rather than per line, so fast streaming sensors stay cheap to parse
+class SensorParser:
+    def __init__(self, columns):
+        self.columns = list(columns)
+
+    def parse(self, lines):
+        raise NotImplementedError
+
+    # Convert a flat list of numeric strings to floats in one call, falling back to
+    # per-field conversion (with NaN for garbage) only if the batch contains a bad field
+    @staticmethod
+    def _to_float(fields):
+        try:
+            return np.array(fields, dtype=np.float64)
+        except ValueError:
+            values = np.empty(len(fields), dtype=np.float64)
+            for i, field in enumerate(fields):
+                try:
+                    values[i] = float(field)
+                except ValueError:
+                    values[i] = np.nan
+            return values
+
+
+# Extracts columns with a regular expression. Named groups become column names,
+# unnamed groups are called "column 1", "column 2" and so on
+class RegexParser(SensorParser):
+    def __init__(self, pattern):
+        self.regex = re.compile(pattern)
+        if self.regex.groups == 0:
+            raise ValueError(f"Pattern {pattern} has no groups to extract")
+
+        names = {index: name for name, index in self.regex.groupindex.items()}
+        super().__init__([names.get(i, f"column {i}") for i in range(1, self.regex.groups + 1)])
+
+    def parse(self, lines):
+        matches = list(map(self.regex.search, lines))
+        valid = np.fromiter((match is not None for match in matches), dtype=bool, count=len(matches))
+        values = np.full((len(lines), len(self.columns)), np.nan)
+
+        fields = [group if group is not None else 'nan'
+                  for match in matches if match is not None for group in match.groups()]
+        if len(fields) > 0:
+            values[valid] = self._to_float(fields).reshape(-1, len(self.columns))
+        return values, valid
+
+
+# Splits lines on a delimiter. `columns` maps a column name to the field index,
+# so only the interesting fields are converted
+class DelimitedParser(SensorParser):
+    def __init__(self, delimiter=',', columns=None):
+        if columns is None or len(columns) == 0:
+            raise ValueError("Delimited parser requires at least one column")
+        super().__init__(columns.keys())
+        self.delimiter = delimiter
+        self.indices = np.array(list(columns.values()), dtype=int)
+        self.__width = int(self.indices.max()) + 1
+
+    def parse(self, lines):
+        rows = [line.split(self.delimiter) for line in lines]
+        valid = np.fromiter((len(row) >= self.__width for row in rows), dtype=bool, count=len(rows))
+        values = np.full((len(lines), len(self.columns)), np.nan)
+
+        fields = [row[i] for row in rows if len(row) >= self.__width for i in self.indices]
+        if len(fields) > 0:
+            values[valid] = self._to_float(fields).reshape(-1, len(self.columns))
+        return values, valid
+
+
+# Wraps a user function taking a line and returning a sequence of numbers (or None for unparsable lines)
+class CallableParser(SensorParser):
+    def __init__(self, function, columns):
+        super().__init__(columns)
+        self.function = function
+
+    def parse(self, lines):
+        values = np.full((len(lines), len(self.columns)), np.nan)
+        valid = np.zeros(len(lines), dtype=bool)
+        for i, line in enumerate(lines):
+            # A line the function fails on, or a result with the wrong number of fields, is an invalid line
+            try:
+                result = self.function(line)
+                if result is not None:
+                    values[i] = result
+                    valid[i] = True
+            except (ValueError, IndexError, TypeError):
+                continue
+        return values, valid
+
+
+# Create a parser from a specification:
+#   - a SensorParser instance is returned as is,
+#   - a (function, columns) tuple creates a CallableParser,
+#   - "re:<pattern>" creates a RegexParser,
+#   - "split:<delimiter>:<name>=<index>,<name>=<index>..." creates a DelimitedParser,
+#   - None or an empty string means no parsing
+def make_parser(spec):
+    if spec is None or isinstance(spec, SensorParser):
+        return spec
+    if isinstance(spec, tuple):
+        return CallableParser(*spec)
+
+    spec = spec.strip()
+    if len(spec) == 0:
+        return None
+    if spec.startswith("re:"):
+        return RegexParser(spec[3:])
+    if spec.startswith("split:"):
+        delimiter, separator, columnMap = spec[6:].rpartition(':')
+        if len(separator) == 0:
+            raise ValueError(f"Missing column map in parser specification: {spec}")
+        columns = {}
+        for entry in columnMap.split(','):
+            name, _, index = entry.partition('=')
+            columns[name.strip()] = int(index)
+        return DelimitedParser(delimiter.replace('\\t', '\t'), columns)
+    raise ValueError(f"Unknown parser specification: {spec}")
@@ -0,0 +1,97 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import pyvisa
+from Brooks025X import Brooks025X
+from BrooksTransport import BrooksTransport
+from ControllerPoller import ControllerPoller
+from CsvWriter import CsvWriter
+
+
+# Stand-in for the pyvisa connection to a Brooks 0254, answering every query after `latency` seconds.
+# Like the device it handles one query at a time, K polls return a slowly rising flow and totalizer,
+# and parameter reads and writes echo a plain value
+class SimulatedBrooks:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def query(self, command):
+        with self.lock:
+            time.sleep(self.latency)
+            elapsed = time.monotonic() - self.start
+            if command.endswith('K'):
+                return f"AZ,00000.01,4,K,{elapsed:.3f},{1 + 0.001 * elapsed:.3f}"
+            return f"AZ,00000.01,4,{command.split('.')[-1][:3]},1"
+
+
+# Soak benchmark of high-rate acquisition: 1 to 4 channels are polled at `rate` Hz each by ControllerPollers
+# over one shared connection, while the readings are drained and logged to CSV in batches like the tabs do.
+# Prints the achieved rate of every run next to the requested one, and the query latency of the bus
+def benchmark(connection, rate, duration, channels, renderInterval=0.2):
+    print(f"{duration:.0f} s per run, requested {rate:g} Hz per channel")
+    print(f"{'Channels':>8} {'Requested':>10} {'Achieved':>10} {'Min ch.':>8} {'Late':>6} {'Skipped':>8} "
+          f"{'Errors':>7} {'Query ms':>9} {'Max ms':>8} {'CSV kB':>8}")
+    # The CSV files are only written to measure the logging, they are removed with their directory
+    directory = tempfile.mkdtemp()
+    try:
+        for count in channels:
+            transport = BrooksTransport(connection)
+            brooks = Brooks025X(transport, [i < count for i in range(4)])
+            controllers = [brooks.controller1, brooks.controller2, brooks.controller3, brooks.controller4][:count]
+            if any(controller is None for controller in controllers):
+                print(f"{count:>8} controllers could not be created")
+                continue
+
+            csvFiles = [CsvWriter(os.path.join(directory, f"soak_{count}_{controller.channel}.csv"))
+                        for controller in controllers]
+            pollers = [ControllerPoller(controller, 1 / rate) for controller in controllers]
+            samples = np.zeros(count, dtype=np.int64)
+            start = time.monotonic()
+            while time.monotonic() - start < duration:
+                time.sleep(renderInterval)
+                for i, poller in enumerate(pollers):
+                    readings = poller.drain()
+                    samples[i] += len(readings)
+                    csvFiles[i].write("".join(f"{current},{total},{timestamp.strftime('%H:%M:%S.%f')}\n"
+                                              for timestamp, current, total, pollTime in readings))
+            elapsed = time.monotonic() - start
+            for i, poller in enumerate(pollers):
+                poller.close()
+                samples[i] += len(poller.drain())
+            for csvFile in csvFiles:
+                csvFile.close()
+
+            histogram = next(histogram for command, histogram, outcomes in transport.diagnostics.snapshot()
+                             if command == "K poll")
+            achieved = samples / elapsed
+            print(f"{count:>8} {rate * count:>10.1f} {achieved.sum():>10.1f} {achieved.min():>8.1f} "
+                  f"{sum(poller.late for poller in pollers):>6} {sum(poller.skipped for poller in pollers):>8} "
+                  f"{sum(poller.errors for poller in pollers):>7} {1000 * histogram.mean():>9.2f} "
+                  f"{1000 * histogram.max:>8.2f} {sum(csvFile.bytesWritten for csvFile in csvFiles) / 1024:>8.1f}")
+            histogram.reset()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak benchmark of high-rate acquisition for 1 to 4 channels")
+    parser.add_argument("--rate", type=float, default=10.0, help="requested polls per second per channel")
+    parser.add_argument("--duration", type=float, default=30.0, help="length of every run, seconds")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2, 3, 4], help="channel counts to run")
+    parser.add_argument("--resource", help="VISA resource of a real device, the device is simulated without it")
+    parser.add_argument("--latency", type=float, default=0.01, help="query time of the simulated device, seconds")
+    arguments = parser.parse_args()
+
+    if arguments.resource is not None:
+        resourceManager = pyvisa.ResourceManager()
+        device = resourceManager.open_resource(arguments.resource, write_termination='\r', read_termination='\r\n')
+        device.timeout = 200
+    else:
+        device = SimulatedBrooks(arguments.latency)
+    benchmark(device, arguments.rate, arguments.duration, arguments.channels)
@@ -0,0 +1,232 @@
+import threading
+import time
+import numpy as np
+import pyvisa
+from PyQt5.QtCore import QObject, pyqtSignal
+from Controller import Controller
+
+
+# Runs a dosing process where every step delivers a given volume (in the controller's measurement units)
+# instead of lasting a given time, in a dedicated thread.
+# The totalizer is polled every `pollInterval` seconds (faster at the start of a step). The flow is estimated
+# with a least squares line through the last `window` totalizer readings, and the moment the step's volume
+# will be reached is extrapolated from it.
+# Once that moment is closer than two poll intervals, the doser sleeps until the predicted moment minus
+# the time a setpoint write takes, instead of waiting for the next poll, and then switches to the next setpoint
+# (0 after the last step). The volume targets are counted from the totalizer at the start of the process,
+# so an overshoot of one step is taken off the next one and the total stays accurate.
+# A step whose totalizer does not advance for STALL_TIMEOUT seconds (a closed valve, no supply) ends the process.
+# The API follows DosingScheduler, so the tab can show and log either of them
+class VolumeDoser(QObject):
+    # Step index and setpoint, emitted after every setpoint write
+    setpointWritten = pyqtSignal(int, float)
+    # Emitted when the last step's volume was delivered, not when the process was stopped
+    finished = pyqtSignal()
+
+    # Poll interval at the start of a step, until there are enough readings to estimate the flow
+    FAST_POLL_INTERVAL = 0.1
+    # Seconds without the totalizer advancing after which a step is given up
+    STALL_TIMEOUT = 30.0
+
+    def __init__(self, controller: Controller, values, volumes, pollInterval=1.0, window=5):
+        super().__init__()
+        self.controller = controller
+        self.values = np.asarray(values, dtype=np.float64)
+        self.volumes = np.asarray(volumes, dtype=np.float64)
+        if len(self.values) != len(self.volumes) or len(self.values) == 0:
+            raise ValueError("Volume steps need one setpoint for every volume")
+        if not np.all(self.volumes > 0) or not np.all(self.values > 0):
+            raise ValueError("Volume steps need volumes and setpoints above 0")
+        self.pollInterval = pollInterval
+
+        # Totalizer readings of the current step: seconds from the start and totals
+        self.__times = np.full(window, np.nan)
+        self.__totals = np.full(window, np.nan)
+
+        # Record of every step, in seconds from the start and the totalizer's units.
+        # Targets and cut totals are counted from the start of the process
+        self.targets = np.cumsum(self.volumes)
+        self.cutTotals = np.full(len(self.values), np.nan)
+        self.delivered = np.full(len(self.values), np.nan)
+        self.started = np.full(len(self.values), np.nan)
+        self.cut = np.full(len(self.values), np.nan)
+        self.polls = np.zeros(len(self.values), dtype=np.int64)
+        self.errors = 0
+        # Step that was given up because the totalizer stopped advancing, None if there was none
+        self.stalled = None
+
+        self.step = -1
+        self.startTime = None
+        self.startTotal = None
+        self.total = None
+        self.flow = None
+        # Duration of the last setpoint write, the setpoint is cut this much before the predicted moment
+        self.writeTime = 0.0
+
+        self.__stopEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"Volume dosing {controller.channel}", daemon=True)
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.__thread.start()
+
+    # Stop before the next setpoint change, the current setpoint is left unchanged
+    def stop(self):
+        self.__stopEvent.set()
+        if self.__thread.is_alive() and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def is_stopped(self):
+        return self.__stopEvent.is_set()
+
+    def is_running(self):
+        return self.__thread.is_alive()
+
+    # Volume delivered in the current step, the step's volume and the next step's setpoint (None at the last step)
+    def progress(self):
+        step = max(self.step, 0)
+        delivered = 0.0
+        if self.total is not None:
+            delivered = self.total - self.startTotal - (self.cutTotals[step - 1] if step > 0 else 0.0)
+        return delivered, self.volumes[step], self.values[step + 1] if step + 1 < len(self.values) else None
+
+    # Difference between the delivered and requested volume of every finished step
+    def volume_errors(self):
+        reached = ~np.isnan(self.delivered)
+        return self.delivered[reached] - self.volumes[reached]
+
+    def summary(self):
+        errors = self.volume_errors()
+        stalled = f", step {self.stalled} stalled" if self.stalled is not None else ""
+        if len(errors) == 0:
+            return f"no volumes delivered{stalled}"
+        reached = len(errors) - 1
+        return (f"{len(errors)} volumes delivered, total error {self.cutTotals[reached] - self.targets[reached]:.3f}, "
+                f"largest step error {errors[np.argmax(np.abs(errors))]:.3f}{stalled}")
+
+    # Write the step record as csv lines: step, setpoint, volume, delivered volume, start and cut times in seconds
+    # and number of totalizer polls
+    def write_record(self, file):
+        file.write("Dosing step,Setpoint,Volume,Delivered,Started,Cut,Polls\n")
+        for i in range(len(self.values)):
+            file.write(f"{i},{self.values[i]},{self.volumes[i]},{self.delivered[i]:.4f},{self.started[i]:.6f},"
+                       f"{self.cut[i]:.6f},{self.polls[i]}\n")
+
+    # Returns the totalizer reading, or None if it could not be read
+    def __read_total(self):
+        try:
+            measurements = self.controller.get_measurements()
+        except (pyvisa.errors.VisaIOError, IndexError, ValueError) as e:
+            print(f"Volume dosing {self.controller.channel}: failed to read the totalizer: {e}")
+            measurements = None
+        if measurements is None:
+            self.errors += 1
+            return None
+        return float(measurements[1])
+
+    # Returns False if the setpoint was rejected and the process was ended, finished is emitted then,
+    # so the tab sets the final setpoint and closes the valve
+    def __write_setpoint(self, value):
+        written = time.monotonic()
+        try:
+            self.controller.set_setpoint(value)
+        except (pyvisa.errors.VisaIOError, IndexError) as e:
+            print(f"Volume dosing {self.controller.channel}: failed to write setpoint {value}: {e}")
+            self.errors += 1
+        except Exception as e:
+            print(f"Volume dosing {self.controller.channel}: aborted, setpoint {value} was rejected: "
+                  f"{type(e).__name__} {e}")
+            self.errors += 1
+            self.__stopEvent.set()
+            self.finished.emit()
+            return False
+        self.writeTime = time.monotonic() - written
+        return True
+
+    # Flow from a least squares line through the readings of the current step, None if there are less than two
+    def __estimate_flow(self):
+        valid = ~np.isnan(self.__times)
+        if np.count_nonzero(valid) < 2:
+            return None
+        times = self.__times[valid]
+        totals = self.__totals[valid]
+        times = times - times.mean()
+        variance = np.dot(times, times)
+        if variance == 0:
+            return None
+        return np.dot(times, totals - totals.mean()) / variance
+
+    def __record(self, total):
+        self.__times = np.roll(self.__times, -1)
+        self.__totals = np.roll(self.__totals, -1)
+        self.__times[-1] = time.monotonic() - self.startTime
+        self.__totals[-1] = total
+        self.total = total
+
+    def __run(self):
+        while self.startTotal is None:
+            self.startTotal = self.__read_total()
+            if self.startTotal is None and self.__stopEvent.wait(self.pollInterval):
+                return
+        self.total = self.startTotal
+
+        self.started[0] = time.monotonic() - self.startTime
+        if not self.__write_setpoint(float(self.values[0])):
+            return
+        for i in range(len(self.values)):
+            self.step = i
+            self.setpointWritten.emit(i, float(self.values[i]))
+            self.__times[:] = np.nan
+            self.__totals[:] = np.nan
+            self.flow = None
+
+            if not self.__deliver(self.startTotal + self.targets[i], i):
+                return
+
+            # The next setpoint is written right at the cut, the total is read only afterwards
+            self.cut[i] = time.monotonic() - self.startTime
+            nextValue = float(self.values[i + 1]) if i + 1 < len(self.values) else 0.0
+            if not self.__write_setpoint(nextValue):
+                return
+            if i + 1 < len(self.values):
+                self.started[i + 1] = time.monotonic() - self.startTime
+
+            total = self.__read_total()
+            if total is not None:
+                self.total = total
+            self.cutTotals[i] = self.total - self.startTotal
+            self.delivered[i] = self.cutTotals[i] - (self.cutTotals[i - 1] if i > 0 else 0.0)
+
+        self.finished.emit()
+
+    # Wait until the totalizer reaches `target`, or its predicted moment. Returns False if the process was stopped,
+    # or ended because the totalizer stalled, finished is emitted then like for a rejected setpoint
+    def __deliver(self, target, step):
+        advanced = time.monotonic()
+        lastTotal = self.total
+        while True:
+            total = self.__read_total()
+            self.polls[step] += 1
+            if total is not None:
+                self.__record(total)
+                if total >= target:
+                    return True
+                self.flow = self.__estimate_flow()
+                if total > lastTotal:
+                    advanced = time.monotonic()
+                    lastTotal = total
+            if time.monotonic() - advanced >= self.STALL_TIMEOUT:
+                print(f"Volume dosing {self.controller.channel}: aborted, the totalizer did not advance for "
+                      f"{self.STALL_TIMEOUT:g} s in step {step}")
+                self.stalled = step
+                self.__stopEvent.set()
+                self.finished.emit()
+                return False
+
+            # Near the end, sleep until the predicted moment instead of the next poll
+            if total is not None and self.flow is not None and self.flow > 0:
+                remaining = (target - total) / self.flow - self.writeTime
+                if remaining < 2 * self.pollInterval:
+                    return not self.__stopEvent.wait(max(remaining, 0.0))
+            if self.__stopEvent.wait(self.pollInterval if self.flow is not None else self.FAST_POLL_INTERVAL):
+                return False
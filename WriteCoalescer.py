@@ -0,0 +1,100 @@
+import threading
+import pyvisa
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+# Sends the parameter writes of one device from a thread of its own, keeping only the newest value per parameter.
+# A write submitted while an older value of the same parameter is still pending replaces it, so rapid edits
+# send at most the value in flight and the newest one, and the GUI never waits for the bus.
+# Pending writes of different parameters are sent in the order they were first submitted.
+# `confirm` checks the value the device echoed (whatever `write` returned), without it a write is confirmed
+# when it raised no error. The outcome of every write is signalled, and kept in the counters
+class WriteCoalescer(QObject):
+    # Parameter, value written and whether the device confirmed it
+    writeFinished = pyqtSignal(str, object, bool)
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.__lock = threading.Lock()
+        # Parameter -> (write, value, confirm) of the writes not sent yet, in submission order
+        self.__pending = {}
+        self.__idleEvent = threading.Event()
+        self.__idleEvent.set()
+
+        # Statistics, `coalesced` are the writes replaced before they were sent
+        self.submitted = 0
+        self.coalesced = 0
+        self.writes = 0
+        self.failures = 0
+        # Parameter -> last value the device confirmed
+        self.confirmed = {}
+
+        self.__stopEvent = threading.Event()
+        self.__wakeEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"{name} writes", daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        self.__stopEvent.set()
+        self.__wakeEvent.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    # Drop the pending write of `parameter`, returns True if there was one. A write in flight is not affected
+    def cancel(self, parameter):
+        with self.__lock:
+            return self.__pending.pop(parameter, None) is not None
+
+    def submit(self, parameter, write, value, confirm=None):
+        with self.__lock:
+            self.submitted += 1
+            if parameter in self.__pending:
+                self.coalesced += 1
+            self.__pending[parameter] = (write, value, confirm)
+            self.__idleEvent.clear()
+        self.__wakeEvent.set()
+
+    # Whether a value of `parameter` is waiting to be sent
+    def is_pending(self, parameter):
+        with self.__lock:
+            return parameter in self.__pending
+
+    # Number of writes waiting to be sent
+    def pending_count(self):
+        return len(self.__pending)
+
+    # Wait until every submitted write was sent, returns False on timeout
+    def flush(self, timeout=None):
+        return self.__idleEvent.wait(timeout)
+
+    def __run(self):
+        while not self.__stopEvent.is_set():
+            with self.__lock:
+                if len(self.__pending) == 0:
+                    self.__idleEvent.set()
+                    parameter = None
+                else:
+                    parameter = next(iter(self.__pending))
+                    write, value, confirm = self.__pending.pop(parameter)
+            if parameter is None:
+                self.__wakeEvent.wait()
+                self.__wakeEvent.clear()
+                continue
+
+            try:
+                echo = write(value)
+                confirmed = confirm(echo) if confirm is not None else True
+            except (pyvisa.errors.VisaIOError, IOError, ValueError, IndexError) as e:
+                print(f"{self.name}: writing {parameter} = {value} failed: {e}")
+                confirmed = False
+            except Exception as e:
+                # Anything else (a value the driver rejects) fails this write only, the thread keeps running
+                print(f"{self.name}: writing {parameter} = {value} failed: {type(e).__name__} {e}")
+                confirmed = False
+            self.writes += 1
+            if confirmed:
+                self.confirmed[parameter] = value
+            else:
+                self.failures += 1
+            self.writeFinished.emit(parameter, value, confirmed)
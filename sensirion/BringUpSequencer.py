@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import namedtuple
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# One step of a bring-up sequence. `action` is retried until it succeeds or `timeout` seconds have passed,
+# it fails by raising an exception. After success the sequence waits `settle` seconds before the next step
+BringUpStep = namedtuple("BringUpStep", ["name", "action", "timeout", "settle"], defaults=[1.0, 0.0])
+
+
+# Raised by a step action when the device answered, but with a definite failure (e.g. a failed self test),
+# so there is no point in retrying
+class BringUpError(Exception):
+    pass
+
+
+# Runs named sequences of BringUpSteps, each in its own thread, so devices on different Sensor Bridge ports
+# are brought up in parallel without blocking the GUI. Progress is reported with signals,
+# which are delivered in the thread of the receiver
+class BringUpSequencer(QObject):
+    # Sequence name, step name
+    stepStarted = pyqtSignal(str, str)
+    stepFinished = pyqtSignal(str, str)
+    # Sequence name / sequence name and description of the error
+    sequenceReady = pyqtSignal(str)
+    sequenceFailed = pyqtSignal(str, str)
+    # Emitted once all sequences have ended, True if every one of them succeeded
+    finished = pyqtSignal(bool)
+
+    # Pause between attempts of a failing step
+    RETRY_INTERVAL = 0.02
+
+    def __init__(self):
+        super().__init__()
+        self.__threads = []
+        self.__cancelEvent = threading.Event()
+        self.__lock = threading.Lock()
+        self.__remaining = 0
+        self.__success = True
+
+    def is_running(self):
+        return any(thread.is_alive() for thread in self.__threads)
+
+    # Start all sequences, given as a dictionary of name -> list of steps. A running bring-up is cancelled first
+    def start(self, sequences: dict):
+        self.cancel()
+        self.__cancelEvent = threading.Event()
+        self.__remaining = len(sequences)
+        self.__success = True
+        self.__threads = [threading.Thread(target=self.__run, args=(name, steps, self.__cancelEvent),
+                                           name=f"Bring-up {name}", daemon=True)
+                          for name, steps in sequences.items()]
+        for thread in self.__threads:
+            thread.start()
+
+    # Stop the running sequences after their current attempt, cancelled sequences report nothing
+    def cancel(self):
+        self.__cancelEvent.set()
+        for thread in self.__threads:
+            if thread is not threading.current_thread():
+                thread.join(2.0)
+        self.__threads = []
+
+    def __run(self, name, steps, cancelEvent):
+        error = None
+        for step in steps:
+            if cancelEvent.is_set():
+                return
+            self.stepStarted.emit(name, step.name)
+            error = self.__run_step(step, cancelEvent)
+            if cancelEvent.is_set():
+                return
+            if error is not None:
+                self.sequenceFailed.emit(name, f"{step.name}: {error}")
+                break
+            self.stepFinished.emit(name, step.name)
+            cancelEvent.wait(step.settle)
+
+        if error is None:
+            self.sequenceReady.emit(name)
+        with self.__lock:
+            self.__success = self.__success and error is None
+            self.__remaining -= 1
+            done = self.__remaining == 0
+        if done:
+            self.finished.emit(self.__success)
+
+    # Returns None on success, or the last error if the step did not succeed before its timeout
+    def __run_step(self, step, cancelEvent):
+        deadline = time.monotonic() + step.timeout
+        while True:
+            try:
+                step.action()
+                return None
+            except BringUpError as e:
+                return e
+            except Exception as e:
+                error = e if str(e) != '' else type(e).__name__
+            if time.monotonic() + self.RETRY_INTERVAL > deadline or cancelEvent.wait(self.RETRY_INTERVAL):
+                return error
@@ -1,16 +1,107 @@
+import numpy as np
+from bidict import bidict
 from sensirion_shdlc_sensorbridge import SensorBridgeShdlcDevice
 from sensirion.SensirionSensor import SensirionSensor
 
 
 class SHT85(SensirionSensor):
 
+    # Maximum duration of a high repeatability measurement (datasheet table 4), also enough for lower ones
+    MEASUREMENT_DURATION = 0.0155
+
+    REPEATABILITY = ["High", "Medium", "Low"]
+
+    # Single shot measurement commands, clock stretching disabled
+    SINGLE_SHOT_COMMANDS = {
+        "High": 0x2400,
+        "Medium": 0x240B,
+        "Low": 0x2416
+    }
+
+    # Periodic data acquisition commands, (measurements per second, repeatability) -> command
+    PERIODIC_COMMANDS = {
+        (0.5, "High"): 0x2032, (0.5, "Medium"): 0x2024, (0.5, "Low"): 0x202F,
+        (1, "High"): 0x2130, (1, "Medium"): 0x2126, (1, "Low"): 0x212D,
+        (2, "High"): 0x2236, (2, "Medium"): 0x2220, (2, "Low"): 0x222B,
+        (4, "High"): 0x2334, (4, "Medium"): 0x2322, (4, "Low"): 0x2329,
+        (10, "High"): 0x2737, (10, "Medium"): 0x2721, (10, "Low"): 0x272A
+    }
+
+    # Wrapper dictionary for QComboBoxes, None stands for single shot measurements
+    MEASUREMENT_MODES = bidict({
+        "Single shot": None,
+        "0.5 mps": 0.5,
+        "1 mps": 1,
+        "2 mps": 2,
+        "4 mps": 4,
+        "10 mps": 10
+    })
+
+    COMMAND_FETCH_DATA = 0xE000
+    COMMAND_BREAK = 0x3093
+
+    # Maximum time after power on until the sensor accepts commands
+    POWER_UP_TIME = 0.0015
+
     def __init__(self, bridge: SensorBridgeShdlcDevice, bridgePort: int):
         super().__init__(bridge, bridgePort)
         self.i2c_address = 0x44
 
-    def get_measurements(self):
-        command = 0x2400  # 2400 for high repeatability, 240B for medium, 2416 for low
-        values = self._send_command(command, rx_length=6)
-        temperature = -45 + (175*int.from_bytes(values[0:2], 'big'))/65535
-        humidity = 100 * int.from_bytes(values[3:5], 'big')/65535
+        # Measurements per second of the running periodic acquisition, None in single shot mode
+        self.periodicMps = None
+        self.repeatability = "High"
+
+    # Convert an (n, 2) array of raw temperature and humidity words to temperature and humidity arrays
+    @staticmethod
+    def convert_words(words):
+        words = np.asarray(words, dtype=np.float64).reshape(-1, 2)
+        temperature = -45 + 175 * words[:, 0] / 65535
+        humidity = 100 * words[:, 1] / 65535
         return temperature, humidity
+
+    # In single shot mode this triggers a measurement and waits for it,
+    # in periodic mode it only fetches the latest result, so it returns without the measurement wait
+    def get_measurements(self):
+        if self.periodicMps is not None:
+            words = self._read_words(self.COMMAND_FETCH_DATA, 2)
+        else:
+            words = self._read_words(self.SINGLE_SHOT_COMMANDS[self.repeatability], 2)
+        temperature, humidity = self.convert_words(words)
+        return float(temperature[0]), float(humidity[0])
+
+    # Start periodic data acquisition, the sensor then measures on its own at the given rate
+    def start_periodic_measurements(self, mps, repeatability="High"):
+        if self.periodicMps is not None:
+            self.stop_periodic_measurements()
+        self._send_command(self.PERIODIC_COMMANDS[(mps, repeatability)])
+        self.periodicMps = mps
+        self.repeatability = repeatability
+
+    # Break command, returns the sensor to single shot mode
+    def stop_periodic_measurements(self):
+        self._send_command(self.COMMAND_BREAK)
+        self.periodicMps = None
+
+    # Apply an acquisition mode from MEASUREMENT_MODES, stopping the bridge from talking to the sensor first
+    def configure(self, mps, repeatability="High"):
+        self.stop_repeated()
+        if mps is None:
+            if self.periodicMps is not None:
+                self.stop_periodic_measurements()
+            self.repeatability = repeatability
+        else:
+            self.start_periodic_measurements(mps, repeatability)
+
+    # Let the bridge collect measurements every `interval` seconds.
+    # In single shot mode the bridge triggers every measurement and waits for it. In periodic mode it only
+    # fetches results, once per sensor measurement period, and `interval` is ignored
+    def start_repeated_measurements(self, interval):
+        if self.periodicMps is not None:
+            self._start_repeated(self.COMMAND_FETCH_DATA, 2, interval=1 / self.periodicMps)
+        else:
+            self._start_repeated(self.SINGLE_SHOT_COMMANDS[self.repeatability], 2, interval=interval,
+                                 readDelay=self.MEASUREMENT_DURATION)
+
+    # Returns arrays of all temperatures and humidities measured since the last call
+    def read_repeated_measurements(self):
+        return self.convert_words(self._read_repeated_words(2))
@@ -1,17 +1,21 @@
 from bidict import bidict
+import numpy as np
 from sensirion_shdlc_sensorbridge import SensorBridgeShdlcDevice
 from sensirion.SensirionSensor import SensirionSensor
-import time
 
 
 class STC31(SensirionSensor):
 
+    # Maximum duration of a gas concentration measurement
+    MEASUREMENT_DURATION = 0.075
+
+    # Time after power on until the sensor accepts commands
+    POWER_UP_TIME = 0.125
+
+    # The supply is not switched on here, see SensirionSB.bring_up_sequences()
     def __init__(self, bridge: SensorBridgeShdlcDevice, bridgePort: int):
         super().__init__(bridge, bridgePort)
         self.i2c_address = 0x29
-        bridge.switch_supply_on(bridgePort)
-        time.sleep(0.125)  # Give device time to power on
-        self.disable_crc()
 
     BINARY_GAS = bidict({
         "CO2 in N2, 0-100%": 0x0000,
@@ -20,8 +24,10 @@ class STC31(SensirionSensor):
         "CO2 in air, 0-25%": 0x0003
     })
 
+    # CRC is enabled after power on. Disabling it saves one byte per word, at the cost of undetected bus errors
     def disable_crc(self):
         self._send_command(command=0x3768)
+        self.crcEnabled = False
         
     def set_binary_gas(self, binaryGas):
         assert binaryGas in self.BINARY_GAS.keys()
@@ -39,10 +45,24 @@ class STC31(SensirionSensor):
         assert 0 <= pressure <= 65535
         self._send_command(command=0x362F, argument=pressure)
 
+    # Measurement response is the gas concentration word followed by the temperature word
     def measure_gas_concentration(self):
-        values = self._send_command(command=0x3639, rx_length=6)
-        concentration = 100*(int.from_bytes(values[0:2], 'big') - 16384)/32768
-        return concentration
+        words = self._read_words(command=0x3639, wordCount=2)
+        return float(self.convert_words(words)[0])
+
+    # Convert an (n, 2) array of raw measurement words to an array of gas concentrations
+    @staticmethod
+    def convert_words(words):
+        words = np.asarray(words, dtype=np.float64).reshape(-1, 2)
+        return 100 * (words[:, 0] - 16384) / 32768
+
+    # Let the bridge trigger a gas concentration measurement every `interval` seconds
+    def start_repeated_measurements(self, interval):
+        self._start_repeated(0x3639, 2, interval=interval, readDelay=self.MEASUREMENT_DURATION)
+
+    # Returns an array of all gas concentrations measured since the last call
+    def read_repeated_measurements(self):
+        return self.convert_words(self._read_repeated_words(2))
 
     def forced_recalibration(self, referenceConcentration):
         assert 0 <= referenceConcentration <= 65535
@@ -55,8 +75,9 @@ class STC31(SensirionSensor):
         else:
             self._send_command(command=0x3F6E)
 
+    # Returns the self test result word, 0 means success
     def self_test(self):
-        return self._send_command(command=0x365B, rx_length=2)
+        return int(self._read_words(command=0x365B, wordCount=1)[0])
 
     def soft_reset(self):
         self._send_command(command=0x0006)
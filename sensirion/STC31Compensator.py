@@ -0,0 +1,114 @@
+import threading
+import time
+from sensirion.STC31 import STC31
+
+
+# Keeps the STC31 compensation inputs (temperature, relative humidity, pressure) in sync with the measured conditions.
+# Every write costs an I2C transaction on the Sensor Bridge, so a value is only written when it differs
+# from the last written one by more than its deadband, or when the last write is older than `maxAge` seconds.
+# Writes are done by a dedicated thread, submit() only stores the newest values and returns immediately.
+# Pressure is taken from `pressureSource`, a callable returning mbar (or None if unavailable), called by the thread;
+# if there is no source, `manualPressure` is used
+class STC31Compensator:
+    QUANTITIES = ["temperature", "humidity", "pressure"]
+
+    def __init__(self, stc31: STC31, temperatureDeadband=0.1, humidityDeadband=0.5, pressureDeadband=1.0,
+                 maxAge=60.0, pressureSource=None, manualPressure=1013):
+        self.stc31 = stc31
+        self.deadbands = {"temperature": temperatureDeadband,
+                          "humidity": humidityDeadband,
+                          "pressure": pressureDeadband}
+        self.maxAge = maxAge
+        self.pressureSource = pressureSource
+        self.manualPressure = manualPressure
+
+        # Last values written to the sensor and the monotonic time of the write, None if never written
+        self.lastWritten = dict.fromkeys(self.QUANTITIES)
+        self.__writeTimes = dict.fromkeys(self.QUANTITIES)
+
+        # Statistics, written only by the compensation thread
+        self.submitted = 0
+        self.writes = 0
+        self.savedWrites = 0
+        self.errors = 0
+
+        self.__pending = None
+        self.__latest = None
+        self.__lock = threading.Lock()
+        self.__stopEvent = threading.Event()
+        self.__wakeEvent = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="STC31 compensation", daemon=True)
+        self.__thread.start()
+
+    # Queue new measurement results, only the newest submission is processed if the thread falls behind
+    def submit(self, temperature, humidity):
+        with self.__lock:
+            self.__pending = (float(temperature), float(humidity))
+        self.__wakeEvent.set()
+
+    # Force all values to be written with the next submission, e.g. after the sensor was reset or power cycled
+    def invalidate(self):
+        with self.__lock:
+            self.lastWritten = dict.fromkeys(self.QUANTITIES)
+            self.__writeTimes = dict.fromkeys(self.QUANTITIES)
+
+    def close(self):
+        self.__stopEvent.set()
+        self.__wakeEvent.set()
+        if self.__thread is not threading.current_thread():
+            self.__thread.join(1.0)
+
+    def __run(self):
+        while not self.__stopEvent.is_set():
+            # Also wake up after maxAge without new submissions, so the last values are still refreshed
+            self.__wakeEvent.wait(self.maxAge)
+            self.__wakeEvent.clear()
+            if self.__stopEvent.is_set():
+                return
+
+            with self.__lock:
+                pending = self.__pending
+                self.__pending = None
+            if pending is not None:
+                self.submitted += 1
+                self.__latest = pending
+            elif self.__latest is None:
+                continue
+
+            temperature, humidity = self.__latest
+            try:
+                pressure = self.pressureSource() if self.pressureSource is not None else self.manualPressure
+            except Exception as e:
+                print(f"STC31 compensation: failed to read the pressure: {type(e).__name__} {e}")
+                self.errors += 1
+                pressure = None
+            fresh = pending is not None
+            self.__update("temperature", temperature, self.stc31.set_temperature, fresh)
+            self.__update("humidity", humidity, self.stc31.set_relative_humidity, fresh)
+            if pressure is not None:
+                self.__update("pressure", int(round(pressure)), self.stc31.set_pressure, fresh)
+
+    # Write the value if it is outside the deadband or too old. Skipped writes are only counted
+    # as saved for fresh submissions, not for the periodic refresh check
+    def __update(self, quantity, value, setter, fresh):
+        now = time.monotonic()
+        with self.__lock:
+            last = self.lastWritten[quantity]
+            writeTime = self.__writeTimes[quantity]
+        if last is not None and abs(value - last) < self.deadbands[quantity] and now - writeTime < self.maxAge:
+            if fresh:
+                self.savedWrites += 1
+            return
+
+        try:
+            setter(value)
+        except Exception as e:
+            # Out of range values, bus errors and anything else are retried with the next submission,
+            # a bad value must not end the compensation
+            print(f"STC31 compensation: failed to write {quantity} = {value}: {type(e).__name__} {e}")
+            self.errors += 1
+            return
+        self.writes += 1
+        with self.__lock:
+            self.lastWritten[quantity] = value
+            self.__writeTimes[quantity] = now
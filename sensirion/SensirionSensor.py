@@ -1,6 +1,23 @@
 # Class defining the properties of all Sensirion sensors connected via Sensor Bridge
 
+import time
+import numpy as np
+from sensirion_shdlc_driver.errors import ShdlcError, ShdlcTimeoutError
 from sensirion_shdlc_sensorbridge import SensorBridgeShdlcDevice, SensorBridgePort
+from sensirion_shdlc_sensorbridge.device_errors import SensorBridgeI2cTimeoutError
+from Diagnostics import BusDiagnostics, get_bus
+
+
+# Lookup table of the Sensirion CRC-8 (polynomial 0x31, initialization 0xFF),
+# crc = table[crc ^ byte] processes one byte
+def _crc8_table():
+    table = np.zeros(256, dtype=np.uint8)
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[i] = crc
+    return table
 
 
 class SensirionSensor:
@@ -11,6 +28,11 @@ class SensirionSensor:
         'Port 2': SensorBridgePort.TWO
     }
 
+    # I2C timeout of a single transceive, also used as the margin above the read delay of repeated transceives
+    TIMEOUT_US = 100e3
+
+    CRC8_TABLE = _crc8_table()
+
     def __init__(self, bridge: SensorBridgeShdlcDevice, bridgePort: int):
         assert bridgePort in [SensorBridgePort.ONE, SensorBridgePort.TWO]
 
@@ -18,17 +40,112 @@ class SensirionSensor:
         self.bridgePort = bridgePort
         self.i2c_address = 0x00
 
+        # Handle of the repeated transceive running on the bridge, None if there is none
+        self.__repeatedHandle = None
+        self.repeatedInterval = None
+        self.lostBytes = 0
+        self.i2cErrors = 0
+
+        # Every 16 bit word sent to or received from the sensor is followed by its CRC, unless disabled
+        self.crcEnabled = True
+        self.crcErrors = 0
+
+        self.diagnostics = get_bus("Sensor Bridge")
+
+    @staticmethod
+    def crc8(data):
+        crc = 0xFF
+        for byte in bytes(data):
+            crc = SensirionSensor.CRC8_TABLE[crc ^ byte]
+        return int(crc)
+
+    # Number of bytes the sensor sends per 16 bit word
+    def _word_length(self):
+        return 3 if self.crcEnabled else 2
+
     # Wrapper around parsing 16 bit arguments into correct values for transceive_i2c function
-    def _send_command(self, command: int, argument: int = None, rx_length: int = 0):
+    # Negative arguments (e.g. STC31 temperatures below 0 ℃) are sent as 16-bit two's complement
+    def _build_tx(self, command: int, argument: int = None):
         tx_array = bytearray(int.to_bytes(command, 2, 'big'))
         if argument is not None:
-            arg = bytearray(int.to_bytes(argument, 2, 'big'))
+            arg = bytearray(int.to_bytes(argument & 0xFFFF, 2, 'big'))
             tx_array.append(arg[0])
             tx_array.append(arg[1])
-        rx_data = self.__device.transceive_i2c(self.bridgePort, address=self.i2c_address, tx_data=tx_array,
-                                               rx_length=rx_length, timeout_us=100e3)
+            if self.crcEnabled:
+                tx_array.append(self.crc8(arg))
+        return tx_array
+
+    # Split received bytes into responses of `wordCount` words and verify all CRCs at once
+    # Returns an (n, wordCount) array of words from responses where every CRC matched, the rest is counted and dropped
+    def _words_from_bytes(self, data, wordCount: int):
+        raw = np.frombuffer(bytes(data), dtype=np.uint8).reshape(-1, wordCount, self._word_length())
+        words = raw[:, :, 0].astype(np.uint16) << 8 | raw[:, :, 1]
+        if not self.crcEnabled:
+            return words
+
+        table = self.CRC8_TABLE
+        crc = table[table[0xFF ^ raw[:, :, 0]] ^ raw[:, :, 1]]
+        valid = np.all(crc == raw[:, :, 2], axis=1)
+        self.crcErrors += len(valid) - int(np.count_nonzero(valid))
+        return words[valid]
+
+    # Send a command and read `wordCount` words in response, raises ValueError if a CRC does not match
+    def _read_words(self, command: int, wordCount: int, argument: int = None):
+        data = self._send_command(command, argument, rx_length=wordCount * self._word_length())
+        words = self._words_from_bytes(data, wordCount)
+        if len(words) == 0:
+            raise ValueError(f"CRC mismatch in response to command 0x{command:04x}")
+        return words[0]
+
+    # Every transceive is recorded in the "Sensor Bridge" diagnostics, under the sensor and command
+    def _send_command(self, command: int, argument: int = None, rx_length: int = 0):
+        tx_array = self._build_tx(command, argument)
+        name = f"{type(self).__name__} 0x{command:04x}"
+        start = time.monotonic()
+        try:
+            rx_data = self.__device.transceive_i2c(self.bridgePort, address=self.i2c_address, tx_data=tx_array,
+                                                   rx_length=rx_length, timeout_us=self.TIMEOUT_US)
+        except (ShdlcTimeoutError, SensorBridgeI2cTimeoutError):
+            self.diagnostics.record(name, start, BusDiagnostics.TIMEOUT)
+            raise
+        except ShdlcError:
+            self.diagnostics.record(name, start, BusDiagnostics.ERROR)
+            raise
+        self.diagnostics.record(name, start)
         return rx_data
 
+    # Let the Sensor Bridge firmware send the command every `interval` seconds on its own,
+    # waiting `readDelay` seconds between the write and the read. The responses are buffered on the bridge
+    # until they are collected with _read_repeated_words(), so one round trip returns many samples
+    def _start_repeated(self, command: int, wordCount: int, interval: float, readDelay: float = 0.0):
+        if self.__repeatedHandle is not None:
+            self.stop_repeated()
+        self.__repeatedHandle = self.__device.start_repeated_i2c_transceive(
+            self.bridgePort, interval_us=interval * 1e6, address=self.i2c_address,
+            tx_data=self._build_tx(command), rx_length=wordCount * self._word_length(),
+            timeout_us=readDelay * 1e6 + self.TIMEOUT_US, read_delay_us=readDelay * 1e6)
+        self.repeatedInterval = interval
+
+    def stop_repeated(self):
+        if self.__repeatedHandle is not None:
+            self.__device.stop_repeated_i2c_transceive(self.__repeatedHandle)
+            self.__repeatedHandle = None
+            self.repeatedInterval = None
+
+    def is_repeated(self):
+        return self.__repeatedHandle is not None
+
+    # Collect all responses buffered on the bridge since the last call, as an (n, wordCount) array of words
+    # Responses with I2C or CRC errors are skipped, as well as those lost to a bridge buffer overrun; all are counted
+    def _read_repeated_words(self, wordCount: int):
+        if self.__repeatedHandle is None:
+            return np.zeros((0, wordCount), dtype=np.uint16)
+        response = self.__device.read_buffer(self.__repeatedHandle)
+        self.lostBytes += response.lost_bytes
+        valid = [value.raw_data for value in response.values if value.error is None]
+        self.i2cErrors += len(response.values) - len(valid)
+        return self._words_from_bytes(b''.join(valid), wordCount)
+
     def analog_measurement(self):
         return self.__device.measure_voltage(self.bridgePort)
 